@@ -0,0 +1,205 @@
+import os
+import time
+import numpy as np
+from sklearn.cluster import MiniBatchKMeans
+from local_search import LocalSearchBackend, normalize_rows
+
+class IVFIndex:
+    """
+    Inverted-file index over the rows of one feature group matrix.
+
+    Rows are assigned to the nearest of `nlist` spherical k-means centroids.
+    A query only scores the rows listed under its `nprobe` closest centroids.
+    """
+
+    def __init__(self, nlist=256, nprobe=8):
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.centroids = None
+        self.assignments = np.zeros(0, dtype=np.int32)
+        self.order = None
+        self.offsets = None
+
+    def is_trained(self):
+        return self.centroids is not None
+
+    def build(self, vectors, seed=0):
+        nlist = max(1, min(self.nlist, len(vectors)))
+        kmeans = MiniBatchKMeans(n_clusters=nlist, batch_size=4096, n_init=3, random_state=seed)
+        kmeans.fit(vectors)
+        self.centroids = np.ascontiguousarray(normalize_rows(kmeans.cluster_centers_.astype(np.float32)))
+        self.assignments = np.zeros(0, dtype=np.int32)
+        self.assign(np.arange(len(vectors)), vectors)
+
+    def assign(self, rows, vectors):
+        """Assigns (or re-assigns) rows to their nearest centroid."""
+        if len(rows) == 0:
+            return
+        if rows.max() >= len(self.assignments):
+            grown = np.full(rows.max() + 1, -1, dtype=np.int32)
+            grown[:len(self.assignments)] = self.assignments
+            self.assignments = grown
+        self.assignments[rows] = np.argmax(vectors @ self.centroids.T, axis=1)
+        self.order = None
+
+    def lists(self):
+        # The inverted lists are rebuilt lazily after assignments change
+        if self.order is None:
+            self.order = np.argsort(self.assignments, kind='stable').astype(np.int32)
+            self.offsets = np.searchsorted(self.assignments[self.order], np.arange(len(self.centroids) + 1))
+        return self.order, self.offsets
+
+    def candidates(self, vector, nprobe=None):
+        nprobe = min(nprobe or self.nprobe, len(self.centroids))
+        probes = np.argpartition(-(self.centroids @ vector), nprobe - 1)[:nprobe]
+        order, offsets = self.lists()
+        return np.concatenate([order[offsets[probe]:offsets[probe + 1]] for probe in probes])
+
+class IndexFormatError(ValueError):
+    """An ANN index file built for another layout than the backend loading it."""
+
+class ANNSearchBackend(LocalSearchBackend):
+    """
+    Local backend that answers queries through one IVF index per feature group.
+
+    Every selected group contributes its best `candidates` rows. The union of
+    those lists is then scored exactly with the weighted average cosine used
+    by the script, so only the candidate generation is approximate.
+    """
+
+    def __init__(self, feature_map, nlist=256, nprobe=8, candidates=200, binary_groups=(), weights=None, vector_format=None):
+        super().__init__(feature_map, binary_groups, weights)
+        self.candidates = candidates
+        # Recorded in the saved file, to explain a layout mismatch on load
+        self.vector_format = vector_format
+        # Bitset groups are cheap to scan and only join the exact merge
+        self.indexes = {feature: IVFIndex(nlist, nprobe) for feature in feature_map if feature not in self.binary_groups}
+
+    def build(self):
+        start = time.perf_counter()
+        for feature, index in self.indexes.items():
+            index.build(self.matrices[feature])
+        print(f"Built ANN indexes for {len(self.files)} documents in {time.perf_counter() - start:.1f}s")
+
+    def add(self, docs):
+        super().add(docs)
+        rows = np.array([self.positions[doc['file']] for doc in docs], dtype=np.int64)
+        for feature, index in self.indexes.items():
+            if index.is_trained():
+                index.assign(rows, self.matrices[feature][rows])
+
+    def remove(self, files):
+        keep = super().remove(files)
+        if keep is not None:
+            for index in self.indexes.values():
+                if index.is_trained():
+                    index.assignments = index.assignments[keep]
+                    index.order = None
+        return keep
+
+    def set_params(self, nprobe=None, candidates=None):
+        if nprobe is not None:
+            for index in self.indexes.values():
+                index.nprobe = nprobe
+        if candidates is not None:
+            self.candidates = candidates
+
+    def group_candidates(self, feature, vector):
+        rows = self.indexes[feature].candidates(vector)
+        if len(rows) <= self.candidates:
+            return rows
+        scores = self.matrices[feature][rows] @ vector
+        return rows[np.argpartition(-scores, self.candidates - 1)[:self.candidates]]
+
+    def search(self, query_features, top_n=10):
+        if not self.files:
+            return []
+        if not all(index.is_trained() for index in self.indexes.values()):
+            return super().search(query_features, top_n)
+
+        lists = [self.group_candidates(feature, vector) for feature, vector in self.query_vectors(query_features).items()]
+        if not lists:
+            return super().search(query_features, top_n)
+
+        rows = np.unique(np.concatenate(lists))
+        return self.top(self.score(query_features, rows), top_n, rows)
+
+    def search_many(self, queries, top_n=10, batch_size=32):
+        # Candidate lists differ per query, so there is no shared product
+        return [self.search(query_features, top_n) for query_features in queries]
+
+    def recall(self, queries, top_n=10, files=None):
+        """
+        Compares ANN results with the exhaustive scan for a list of query params.
+        `files` optionally names the stored document each query was taken from,
+        which is then left out of both result lists.
+        """
+        files = files or [None] * len(queries)
+        hits = 0
+        expected = 0
+        exact_time = 0.0
+        ann_time = 0.0
+        for query_features, file in zip(queries, files):
+            n = top_n + (file is not None)
+            start = time.perf_counter()
+            exact = LocalSearchBackend.search(self, query_features, n)
+            exact_time += time.perf_counter() - start
+
+            start = time.perf_counter()
+            approximate = self.search(query_features, n)
+            ann_time += time.perf_counter() - start
+
+            exact = [item['file'] for item in exact if item['file'] != file][:top_n]
+            approximate = [item['file'] for item in approximate if item['file'] != file][:top_n]
+            hits += len(set(exact) & set(approximate))
+            expected += len(exact)
+
+        count = max(len(queries), 1)
+        return {
+            'recall': hits / max(expected, 1),
+            'exact_ms': exact_time / count * 1000,
+            'ann_ms': ann_time / count * 1000,
+        }
+
+    def save(self, path):
+        arrays = {'files': np.array(self.files), 'binary_groups': np.array(sorted(self.binary_groups), dtype=str)}
+        if self.vector_format:
+            arrays['vector_format'] = np.array(self.vector_format)
+        for feature in self.binary_groups:
+            arrays[f'{feature}_bits'] = self.bits[feature]
+            arrays[f'{feature}_bit_counts'] = self.bit_counts[feature]
+        for feature, index in self.indexes.items():
+            arrays[f'{feature}_matrix'] = self.matrices[feature]
+            arrays[f'{feature}_valid'] = self.valid[feature]
+            arrays[f'{feature}_norms'] = self.norms[feature]
+            if index.is_trained():
+                arrays[f'{feature}_centroids'] = index.centroids
+                arrays[f'{feature}_assignments'] = index.assignments
+
+        # Write next to the target first so a crash never leaves a torn index
+        temp_path = path + '.tmp.npz'
+        np.savez(temp_path, **arrays)
+        os.replace(temp_path, path)
+
+    def load(self, path):
+        with np.load(path) as data:
+            # Files saved before the layout was recorded have a _bits array per bitset group
+            stored = data['binary_groups'].tolist() if 'binary_groups' in data else sorted(key[:-len('_bits')] for key in data.files if key.endswith('_bits'))
+            if set(stored) != self.binary_groups:
+                built = f" (VECTOR_FORMAT={data['vector_format']})" if 'vector_format' in data else ""
+                raise IndexFormatError(f"ANN index {path} was built{built} with bitset groups {stored or 'none'}, but VECTOR_FORMAT={self.vector_format} keeps {sorted(self.binary_groups) or 'none'}")
+            self.files = data['files'].tolist()
+            self.positions = {file: position for position, file in enumerate(self.files)}
+            for feature in self.binary_groups:
+                self.bits[feature] = data[f'{feature}_bits']
+                self.bit_counts[feature] = data[f'{feature}_bit_counts']
+            for feature, index in self.indexes.items():
+                self.matrices[feature] = data[f'{feature}_matrix']
+                self.valid[feature] = data[f'{feature}_valid']
+                # Indexes saved before norms were kept cannot rebuild raw vectors
+                self.norms[feature] = data[f'{feature}_norms'] if f'{feature}_norms' in data else None
+                if f'{feature}_centroids' in data:
+                    index.centroids = data[f'{feature}_centroids']
+                    index.assignments = data[f'{feature}_assignments']
+                    index.order = None
+        print(f"Loaded ANN index with {len(self.files)} documents from {path}")
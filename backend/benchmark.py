@@ -0,0 +1,216 @@
+"""
+Offline benchmarks for feature extraction and search scoring.
+
+Runs without Elasticsearch or network access, on synthetic images (or the
+images in --images) and synthetic vectors scored by the local backend, and
+prints the results as JSON so runs can be compared.
+
+    python benchmark.py --output before.json
+    python benchmark.py --images dataset --search-sizes 10000,100000
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import cv2
+import numpy as np
+
+from features import feature_map
+from local_search import LocalSearchBackend, normalize_rows
+from image_processing import preprocess_image, preprocessing_manifest, resize_image, denoise_image, denoise_modes, ImageContext, extract_features, color_intensity_mean, color_intensity_histogram, glcm_features_all_directions, compute_hog, compute_gist, extract_dct_features, extract_wavelet_features, harris_corners
+
+extractors = {
+    'color_intensity_mean': color_intensity_mean,
+    'color_intensity_histogram': color_intensity_histogram,
+    'glcm_features_all_directions': glcm_features_all_directions,
+    'compute_hog': compute_hog,
+    'compute_gist': compute_gist,
+    'extract_dct_features': extract_dct_features,
+    'extract_wavelet_features': extract_wavelet_features,
+    'harris_corners': harris_corners,
+}
+
+def latency_stats(samples):
+    samples = np.array(samples) * 1000
+    return {
+        'runs': len(samples),
+        'mean_ms': float(samples.mean()),
+        'p50_ms': float(np.percentile(samples, 50)),
+        'p95_ms': float(np.percentile(samples, 95)),
+        'p99_ms': float(np.percentile(samples, 99)),
+        'throughput_per_sec': float(1000 / samples.mean()) if samples.mean() > 0 else None,
+    }
+
+def measure(function, inputs, repeat, warmup=2):
+    for i in range(warmup):
+        function(inputs[i % len(inputs)])
+    samples = []
+    for i in range(repeat):
+        item = inputs[i % len(inputs)]
+        start = time.perf_counter()
+        function(item)
+        samples.append(time.perf_counter() - start)
+    return latency_stats(samples)
+
+def synthetic_images(count, size=(640, 480), seed=0):
+    """Smoothed noise with a few shapes, so denoising and texture features have something to work on."""
+    rng = np.random.default_rng(seed)
+    images = []
+    for _ in range(count):
+        image = cv2.GaussianBlur(rng.integers(0, 256, (size[1], size[0], 3), dtype=np.uint8), (7, 7), 0)
+        for _ in range(5):
+            color = [int(c) for c in rng.integers(0, 256, 3)]
+            center = (int(rng.integers(0, size[0])), int(rng.integers(0, size[1])))
+            cv2.circle(image, center, int(rng.integers(10, min(size) // 3)), color, -1)
+        images.append(image)
+    return images
+
+def load_images(folder, count):
+    images = []
+    for filename in sorted(os.listdir(folder)):
+        if filename.lower().endswith(('png', 'jpg', 'jpeg', 'bmp')):
+            image = cv2.imread(os.path.join(folder, filename))
+            if image is not None:
+                images.append(image)
+            if len(images) >= count:
+                break
+    return images
+
+def bench_extractors(images, repeat):
+    prepared = [preprocess_image(image) for image in images]
+    results = {name: measure(function, prepared, repeat) for name, function in extractors.items()}
+    # All groups from one shared context, as get_features and the query path run them
+    results['extract_features'] = measure(lambda image: extract_features(ImageContext(image)), prepared, repeat)
+    return results
+
+def bench_denoise(images, repeat):
+    resized = [resize_image(image) for image in images]
+    return {mode: measure(lambda image: denoise_image(image, mode), resized, repeat) for mode in denoise_modes}
+
+def bench_get_features(images, repeat):
+    # get_features minus the file name: decode-free preprocessing plus every extractor
+    return measure(lambda image: extract_features(ImageContext(preprocess_image(image))), images, repeat)
+
+def synthetic_backend(size, feature_keys, seed=0, chunk=50000, folder=None):
+    """Backend with `size` random rows per group; with `folder`, the matrices are memmapped .npy files in it."""
+    rng = np.random.default_rng(seed)
+    backend = LocalSearchBackend(feature_map)
+    backend.files = [f'synthetic-{i}.jpg' for i in range(size)]
+    for feature in feature_keys:
+        width = backend.matrices[feature].shape[1]
+        if folder:
+            matrix = np.lib.format.open_memmap(os.path.join(folder, f'{feature}.npy'), mode='w+', dtype=np.float32, shape=(size, width))
+        else:
+            matrix = np.empty((size, width), dtype=np.float32)
+        for start in range(0, size, chunk):
+            end = min(start + chunk, size)
+            matrix[start:end] = normalize_rows(np.abs(rng.standard_normal((end - start, width), dtype=np.float32)))
+        backend.matrices[feature] = matrix
+        backend.valid[feature] = np.ones(size, dtype=bool)
+    return backend
+
+def synthetic_queries(count, feature_keys, seed=1):
+    rng = np.random.default_rng(seed)
+    queries = []
+    for _ in range(count):
+        query = {}
+        for feature in feature_keys:
+            for item in feature_map[feature]:
+                if item['type'] == 'number':
+                    query[item['name']] = float(rng.random())
+                else:
+                    query[item['name']] = np.abs(rng.standard_normal(item['length'])).astype(np.float32)
+        queries.append(query)
+    return queries
+
+def bench_search(sizes, feature_keys, repeat, top_n, max_memory_gb, scratch=None):
+    width = sum(item.get('length', 1) for feature in feature_keys for item in feature_map[feature])
+    queries = synthetic_queries(max(repeat, 1), feature_keys)
+    results = {}
+    for size in sizes:
+        memory_gb = size * width * 4 / 1024 ** 3
+        if memory_gb <= max_memory_gb:
+            backend = synthetic_backend(size, feature_keys)
+            results[str(size)] = measure(lambda query: backend.search(query, top_n), queries, repeat)
+            results[str(size)]['vector_memory_gb'] = memory_gb
+            del backend
+            continue
+
+        # Too large for memory: the vectors are memmapped from disk, and every
+        # query pages in what the OS cannot cache, as a larger index would
+        free_gb = shutil.disk_usage(scratch or tempfile.gettempdir()).free / 1024 ** 3
+        if memory_gb > free_gb:
+            results[str(size)] = {'skipped': f'needs {memory_gb:.1f} GB of vectors, over --max-memory-gb {max_memory_gb} and the {free_gb:.1f} GB free for --scratch'}
+            continue
+        with tempfile.TemporaryDirectory(dir=scratch) as folder:
+            backend = synthetic_backend(size, feature_keys, folder=folder)
+            results[str(size)] = measure(lambda query: backend.search(query, top_n), queries, repeat)
+            results[str(size)]['vector_memory_gb'] = memory_gb
+            results[str(size)]['memmapped'] = True
+            del backend
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--images', help='folder with sample images; synthetic images are used when omitted')
+    parser.add_argument('--image-count', type=int, default=8)
+    parser.add_argument('--repeat', type=int, default=30)
+    parser.add_argument('--search-sizes', default='10000,100000,1000000')
+    parser.add_argument('--search-features', default=','.join(feature_map.keys()))
+    parser.add_argument('--search-repeat', type=int, default=20)
+    parser.add_argument('--top-n', type=int, default=10)
+    parser.add_argument('--max-memory-gb', type=float, default=4.0, help='larger search sizes are memmapped from --scratch')
+    parser.add_argument('--scratch', help='folder for memmapped vectors; the system temp folder by default')
+    parser.add_argument('--skip', default='', help='comma separated sections to skip: extractors,denoise,get_features,search')
+    parser.add_argument('--output', help='write JSON here instead of stdout')
+    args = parser.parse_args()
+
+    skip = set(filter(None, args.skip.split(',')))
+    images = load_images(args.images, args.image_count) if args.images else synthetic_images(args.image_count)
+    if not images:
+        sys.exit("Error: No images to benchmark.")
+
+    report = {
+        'environment': {
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'opencv': cv2.__version__,
+            'cpu_count': os.cpu_count(),
+            'preprocessing': preprocessing_manifest(),
+            'images': args.images or 'synthetic',
+            'image_shape': list(images[0].shape),
+        },
+    }
+
+    if 'extractors' not in skip:
+        print("Benchmarking extractors...", file=sys.stderr)
+        report['extractors'] = bench_extractors(images, args.repeat)
+    if 'denoise' not in skip:
+        print("Benchmarking denoise modes...", file=sys.stderr)
+        report['denoise'] = bench_denoise(images, args.repeat)
+    if 'get_features' not in skip:
+        print("Benchmarking get_features...", file=sys.stderr)
+        report['get_features'] = bench_get_features(images, args.repeat)
+    if 'search' not in skip:
+        print("Benchmarking search scoring...", file=sys.stderr)
+        sizes = [int(size) for size in args.search_sizes.split(',') if size]
+        feature_keys = [feature for feature in args.search_features.split(',') if feature]
+        report['search'] = {
+            'features': feature_keys,
+            'top_n': args.top_n,
+            'sizes': bench_search(sizes, feature_keys, args.search_repeat, args.top_n, args.max_memory_gb, args.scratch),
+        }
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+import hashlib
+import os
+import sqlite3
+import time
+
+image_extensions = ('png', 'jpg', 'jpeg', 'bmp')
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def scan_folder(folder_path):
+    """{filename: (size, mtime_ns)} of the images in the folder."""
+    files = {}
+    with os.scandir(folder_path) as entries:
+        for entry in entries:
+            if entry.name.lower().endswith(image_extensions) and entry.is_file():
+                stat = entry.stat()
+                files[entry.name] = (stat.st_size, stat.st_mtime_ns)
+    return files
+
+class FileCatalog:
+    """
+    SQLite record of the files the index was built from: size, mtime,
+    content hash, the feature version they were extracted with, and whether
+    they were indexed, could not be read, or were skipped as a near-duplicate
+    of another indexed file.
+
+    Comparing a folder scan with it tells which files to add, re-extract or
+    delete, so a run only pays for what changed.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS files (
+                file TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                sha256 TEXT,
+                feature_version TEXT NOT NULL,
+                status TEXT NOT NULL,
+                updated_at REAL NOT NULL,
+                duplicate_of TEXT
+            )
+        """)
+        # Catalogs from before duplicate detection
+        columns = [row[1] for row in self.connection.execute("PRAGMA table_info(files)")]
+        if 'duplicate_of' not in columns:
+            self.connection.execute("ALTER TABLE files ADD COLUMN duplicate_of TEXT")
+        self.connection.commit()
+
+    def __len__(self):
+        return self.connection.execute("SELECT COUNT(*) FROM files").fetchone()[0]
+
+    def entries(self):
+        rows = self.connection.execute("SELECT file, size, mtime_ns, sha256, feature_version, status FROM files")
+        return {row[0]: row[1:] for row in rows}
+
+    def record(self, file, size, mtime_ns, sha256, feature_version, status='indexed', duplicate_of=None):
+        self.connection.execute(
+            "INSERT OR REPLACE INTO files (file, size, mtime_ns, sha256, feature_version, status, updated_at, duplicate_of) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (file, size, mtime_ns, sha256, feature_version, status, time.time(), duplicate_of),
+        )
+
+    def touch(self, file, size, mtime_ns):
+        """Updates the stat of a file whose content did not change."""
+        self.connection.execute("UPDATE files SET size = ?, mtime_ns = ?, updated_at = ? WHERE file = ?", (size, mtime_ns, time.time(), file))
+
+    def duplicates_of(self, files):
+        """Files skipped as near-duplicates of any of `files`."""
+        rows = self.connection.execute("SELECT file, duplicate_of FROM files WHERE status = 'duplicate'")
+        files = set(files)
+        return sorted(file for file, original in rows if original in files)
+
+    def remove(self, files):
+        self.connection.executemany("DELETE FROM files WHERE file = ?", [(file,) for file in files])
+
+    def commit(self):
+        self.connection.commit()
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
+
+    def changes(self, folder_path, current, feature_version, settle_seconds=0):
+        """
+        Splits a scan_folder() result into (to_extract, removed). Files whose
+        stat changed but whose content hash did not are only touched. Files
+        modified in the last `settle_seconds` are left for a later call.
+        """
+        known = self.entries()
+        newest = time.time_ns() - int(settle_seconds * 1e9)
+        to_extract = []
+        for file, (size, mtime_ns) in current.items():
+            # Probably still being copied in
+            if settle_seconds and mtime_ns > newest:
+                continue
+            entry = known.get(file)
+            if entry is None or entry[3] != feature_version:
+                to_extract.append(file)
+            elif (size, mtime_ns) != entry[:2]:
+                if entry[2] is not None and file_sha256(os.path.join(folder_path, file)) == entry[2]:
+                    self.touch(file, size, mtime_ns)
+                else:
+                    to_extract.append(file)
+        removed = [file for file in known if file not in current]
+        self.commit()
+        return sorted(to_extract), sorted(removed)
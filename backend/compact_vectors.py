@@ -0,0 +1,103 @@
+import numpy as np
+from features import feature_map
+
+# Stored as int8 plus a per-document scale in the compact format
+quantized_fields = ['hog', 'gist', 'dct']
+# 0/255 masks stored as bitsets in the compact format
+binary_fields = ['corners']
+
+def quantize_int8(vector):
+    """Symmetric per-vector int8 quantization; returns (values, scale) with vector ~= values * scale."""
+    vector = np.asarray(vector, dtype=np.float32)
+    peak = float(np.max(np.abs(vector))) if vector.size else 0.0
+    scale = peak / 127 if peak > 0 else 1.0
+    return np.clip(np.round(vector / scale), -127, 127).astype(np.int8), scale
+
+def dequantize_int8(values, scale):
+    return np.asarray(values, dtype=np.float32) * np.float32(scale)
+
+def pack_bits(mask):
+    return np.packbits(np.asarray(mask) > 0, axis=-1)
+
+def unpack_bits(packed, length):
+    return np.unpackbits(np.asarray(packed, dtype=np.uint8), axis=-1)[..., :length].astype(np.float32) * 255
+
+if hasattr(np, 'bitwise_count'):
+    def popcount(packed):
+        return np.bitwise_count(packed).sum(axis=-1, dtype=np.int64)
+else:
+    bit_counts = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+    def popcount(packed):
+        return bit_counts[packed].sum(axis=-1, dtype=np.int64)
+
+def binary_cosine(query_bits, bits, counts):
+    """Cosine similarity of 0/1 masks from popcounts: |a & b| / sqrt(|a| * |b|)."""
+    query_count = popcount(query_bits)
+    common = popcount(bits & query_bits)
+    denominator = np.sqrt(counts.astype(np.float64) * query_count)
+    return np.divide(common, denominator, out=np.zeros(len(bits)), where=denominator > 0).astype(np.float32)
+
+def compact_document(feature):
+    """Converts extracted float fields to the compact index format, in place."""
+    for field in quantized_fields:
+        if field in feature:
+            values, scale = quantize_int8(feature[field])
+            feature[field] = values
+            feature[field + '_scale'] = scale
+    for field in binary_fields:
+        if field in feature:
+            bits = pack_bits(feature[field])
+            feature[field] = bits.tobytes().hex()
+            feature[field + '_count'] = int(popcount(bits))
+    return feature
+
+def expand_document(source, feature_map):
+    """Rebuilds float fields from a compact document (as stored in the index), in place."""
+    for field in quantized_fields:
+        if field in source and field + '_scale' in source:
+            source[field] = dequantize_int8(source.pop(field), source.pop(field + '_scale'))
+    lengths = {item['name']: item['length'] for items in feature_map.values() for item in items if item['type'] == 'vector'}
+    for field in binary_fields:
+        if isinstance(source.get(field), str):
+            source[field] = unpack_bits(np.frombuffer(bytes.fromhex(source[field]), dtype=np.uint8), lengths[field])
+            source.pop(field + '_count', None)
+    return source
+
+def compact_query(query_features):
+    """Query params for the compact format: int8 lists for byte vectors, signed bytes plus a count for bitsets."""
+    params = dict(query_features)
+    for field in quantized_fields:
+        if field in params:
+            params[field] = quantize_int8(params[field])[0].tolist()
+    for field in binary_fields:
+        if field in params:
+            bits = pack_bits(params[field])
+            params[field] = bits.view(np.int8).tolist()
+            params[field + '_count'] = int(popcount(bits))
+    return params
+
+def compact_fields(fields):
+    """Source fields to fetch for `fields` from a compact index."""
+    extra = [field + '_scale' for field in quantized_fields if field in fields]
+    extra += [field + '_count' for field in binary_fields if field in fields]
+    return list(fields) + extra
+
+def compact_mapping():
+    """Index mapping of the compact format."""
+    properties = {'file': {'type': 'keyword'}}
+    for items in feature_map.values():
+        for item in items:
+            name = item['name']
+            if item['type'] == 'number':
+                properties[name] = {'type': 'float'}
+            elif name in quantized_fields:
+                properties[name] = {'type': 'dense_vector', 'dims': item['length'], 'element_type': 'byte'}
+                properties[name + '_scale'] = {'type': 'float', 'index': False}
+            elif name in binary_fields:
+                # Scored with hamming() in the script, never searched
+                properties[name] = {'type': 'dense_vector', 'dims': item['length'], 'element_type': 'bit', 'index': False}
+                properties[name + '_count'] = {'type': 'integer'}
+            else:
+                properties[name] = {'type': 'dense_vector', 'dims': item['length']}
+    return {'properties': properties}
@@ -0,0 +1,112 @@
+import hashlib
+import json
+import os
+import pickle
+import threading
+from collections import OrderedDict
+import numpy as np
+
+def entry_size(groups):
+    size = 0
+    for fields in groups.values():
+        for value in fields.values():
+            size += value.nbytes if isinstance(value, np.ndarray) else 32
+    return size
+
+class FeatureCache:
+    """
+    LRU cache of extracted query features, keyed by the hash of the uploaded
+    bytes plus the preprocessing settings. Entries hold feature groups, so a
+    request for other groups of a known image only extracts the missing ones.
+
+    With `path` set the cache is loaded from that pickle file on start and
+    written back every `save_every` new groups (and by `save()`).
+    """
+
+    def __init__(self, feature_map, max_bytes=64 * 1024 * 1024, path=None, save_every=50, salt=None):
+        self.feature_map = feature_map
+        self.max_bytes = max_bytes
+        self.path = path
+        self.save_every = save_every
+        # Different preprocessing gives different vectors for the same bytes
+        self.salt = json.dumps(salt, sort_keys=True).encode()
+        self.lock = threading.Lock()
+        # Held from snapshot to rename, so saves neither collide nor land out of order
+        self.save_lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.unsaved = 0
+        self.hits = 0
+        self.misses = 0
+
+        if path and os.path.isfile(path):
+            self.load()
+
+    def key(self, image_data):
+        return hashlib.sha256(self.salt + image_data).hexdigest()
+
+    def get(self, key, feature_keys):
+        """Returns (query features for the cached groups, groups still to extract)."""
+        with self.lock:
+            groups = self.entries.get(key, {})
+            if groups:
+                self.entries.move_to_end(key)
+
+            features = {}
+            missing = []
+            for feature in feature_keys:
+                if feature in groups:
+                    features.update(groups[feature])
+                else:
+                    missing.append(feature)
+
+            if missing:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return features, missing
+
+    def put(self, key, features, feature_keys):
+        """Stores the given groups of an extracted feature dict."""
+        groups = {feature: {item['name']: features[item['name']] for item in self.feature_map[feature]} for feature in feature_keys}
+        with self.lock:
+            entry = self.entries.pop(key, {})
+            self.total_bytes -= entry_size(entry)
+            entry.update(groups)
+            self.entries[key] = entry
+            self.total_bytes += entry_size(entry)
+
+            while self.total_bytes > self.max_bytes and len(self.entries) > 1:
+                _, evicted = self.entries.popitem(last=False)
+                self.total_bytes -= entry_size(evicted)
+
+            self.unsaved += len(groups)
+            save = self.path is not None and self.unsaved >= self.save_every
+
+        if save:
+            self.save()
+
+    def save(self):
+        if self.path is None:
+            return
+        with self.save_lock:
+            with self.lock:
+                data = pickle.dumps(list(self.entries.items()), protocol=pickle.HIGHEST_PROTOCOL)
+                self.unsaved = 0
+            temp_path = self.path + '.tmp'
+            with open(temp_path, 'wb') as f:
+                f.write(data)
+            os.replace(temp_path, self.path)
+
+    def load(self):
+        try:
+            with open(self.path, 'rb') as f:
+                items = pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError) as e:
+            print(f"Error: Could not load feature cache {self.path}: {e}")
+            return
+
+        with self.lock:
+            self.entries = OrderedDict(items)
+            self.total_bytes = sum(entry_size(groups) for groups in self.entries.values())
+        print(f"Loaded {len(self.entries)} cached queries from {self.path}")
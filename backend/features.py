@@ -0,0 +1,136 @@
+# Feature groups and the document fields they are made of. Every search
+# backend scores a group as the mean cosine similarity of its fields, and
+# the final score as the mean over the selected groups.
+feature_map = {
+    'mean': [
+        {
+            'name': 'r_mean',
+            'type': 'number'
+        }, {
+            'name': 'g_mean',
+            'type': 'number'
+        }, {
+            'name': 'b_mean',
+            'type': 'number'
+        }, {
+            'name': 'i_mean',
+            'type': 'number'
+        }
+    ],
+    'hist': [
+        {
+            'name': 'r_hist',
+            'type': 'vector',
+            'length': 16
+        }, {
+            'name': 'g_hist',
+            'type': 'vector',
+            'length': 16
+        }, {
+            'name': 'b_hist',
+            'type': 'vector',
+            'length': 16
+        }, {
+            'name': 'i_hist',
+            'type': 'vector',
+            'length': 16
+        }
+    ],
+    'glcm': [
+        {
+            'name': 'energy',
+            'type': 'vector',
+            'length': 4
+        }, {
+            'name': 'contrast',
+            'type': 'vector',
+            'length': 4
+        }, {
+            'name': 'entropy',
+            'type': 'vector',
+            'length': 4
+        }, {
+            'name': 'dissimilarity',
+            'type': 'vector',
+            'length': 4
+        }, {
+            'name': 'homogeneity',
+            'type': 'vector',
+            'length': 4
+        }, {
+            'name': 'correlation',
+            'type': 'vector',
+            'length': 4
+        }
+    ],
+    'hog': [
+        {
+            'name': 'hog',
+            'type': 'vector',
+            'length': 1176
+        }
+    ],
+    'gist': [
+        {
+            'name': 'gist',
+            'type': 'vector',
+            'length': 1024
+        }
+    ], 
+    'dct': [
+        {
+            'name': 'dct',
+            'type': 'vector',
+            'length': 1280
+        }
+    ], 
+    'wavelet': [
+        {
+            'name': 'wavelet',
+            'type': 'vector',
+            'length': 12
+        }
+    ], 
+    'corners': [
+        {
+            'name': 'corners',
+            'type': 'vector',
+            'length': 1024
+        }
+    ]
+}
+
+feature_keys_all = list(feature_map.keys())
+# Groups searched through their own index (visual_words.py) instead of stored
+# vectors; only used when a query selects them
+keypoint_feature_map = {
+    'sift': [
+        {
+            'name': 'sift',
+            'type': 'keypoints',
+            'length': 128
+        }
+    ]
+}
+query_feature_map = {**feature_map, **keypoint_feature_map}
+query_feature_keys = list(query_feature_map.keys())
+# Low-dimensional groups that shortlist candidates in two-stage search
+cheap_feature_keys = ['mean', 'hist', 'glcm', 'wavelet']
+
+def feature_fields(feature_keys):
+    return [item['name'] for feature in feature_keys for item in feature_map[feature]]
+
+def parse_feature_weights(spec):
+    """{group: weight} from a spec like "hog=2,corners=0.5"; groups not listed weigh 1."""
+    weights = {feature: 1.0 for feature in query_feature_map}
+    for pair in spec.split(','):
+        if not pair.strip():
+            continue
+        feature, _, value = pair.partition('=')
+        feature = feature.strip()
+        if feature not in query_feature_map:
+            raise ValueError(f"Unknown feature group in weights: {feature}")
+        weights[feature] = float(value)
+        if weights[feature] < 0:
+            raise ValueError(f"Negative weight for {feature}: {value}")
+    return weights
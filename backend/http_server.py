@@ -1,18 +1,187 @@
 import os
 import json
-import cgi
 import cv2
-from http.server import BaseHTTPRequestHandler, HTTPServer
-import numpy as np
-from search import search_similar_images, search_similar_images_from_keys
+import errno
+import signal
+import sys
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from email.utils import formatdate, parsedate_to_datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, unquote, parse_qs
+from thumbnails import ThumbnailCache, formats as thumbnail_formats
+from image_processing import decode_image, extract_image_features, perceptual_hashes, preprocessing_manifest, timed
+from multipart import MultipartError, parse_header, parse_multipart
+from features import query_feature_map, query_feature_keys, feature_keys_all
+from feature_cache import FeatureCache
+from search import run_query, run_queries, result_cache, duplicate_lookup, find_duplicate, search_duplicate, search_similar_images_from_keys, search_similar_images_from_key_sets
+from metrics import Counter, Gauge, render as render_metrics, requests_total, requests_in_flight, request_seconds, stage_seconds, extractor_seconds, extractions_in_flight
 from dotenv import load_dotenv
 
 load_dotenv()
 PORT = os.getenv('PORT')
 IMAGE_URL_PREFIX = os.getenv('IMAGE_URL_PREFIX')
 IMAGE_FOLDER = os.getenv('IMAGE_FOLDER', 'images')
+# Seconds browsers may reuse an image before revalidating it with ETag / Last-Modified
+IMAGE_CACHE_MAX_AGE = int(os.getenv('IMAGE_CACHE_MAX_AGE', 7 * 24 * 3600))
+# Memory cap for cached upload features, and an optional file to persist them
+FEATURE_CACHE_MB = int(os.getenv('FEATURE_CACHE_MB', 64))
+FEATURE_CACHE_PATH = os.getenv('FEATURE_CACHE_PATH', '')
+THUMBNAIL_FOLDER = os.getenv('THUMBNAIL_FOLDER', 'thumbnails')
+THUMBNAIL_MAX_MB = int(os.getenv('THUMBNAIL_MAX_MB', 512))
+THUMBNAIL_WIDTHS = [int(w) for w in os.getenv('THUMBNAIL_WIDTHS', '128,256,512').split(',') if w]
+# Width of the thumbnail URL returned with every result, 0 to return none
+RESULT_THUMBNAIL_WIDTH = int(os.getenv('RESULT_THUMBNAIL_WIDTH', 256))
+# Processes for feature extraction; 0 extracts in the request thread
+EXTRACT_WORKERS = int(os.getenv('EXTRACT_WORKERS', os.cpu_count()))
+# Uploads allowed to wait for a worker before new ones get 503
+EXTRACT_QUEUE_DEPTH = int(os.getenv('EXTRACT_QUEUE_DEPTH', 16))
+# /batch limits: queries per request, and queries extracted and searched per step
+BATCH_MAX_QUERIES = int(os.getenv('BATCH_MAX_QUERIES', 256))
+BATCH_CHUNK_SIZE = int(os.getenv('BATCH_CHUNK_SIZE', 32))
+# Largest request bodies accepted, in MB; larger ones get 413 before anything is read
+UPLOAD_MAX_MB = int(os.getenv('UPLOAD_MAX_MB', 32))
+BATCH_MAX_MB = int(os.getenv('BATCH_MAX_MB', 512))
 
 print("IMAGE_FOLDER:", IMAGE_FOLDER)
+print("EXTRACT_WORKERS:", EXTRACT_WORKERS)
+print("EXTRACT_QUEUE_DEPTH:", EXTRACT_QUEUE_DEPTH)
+print("THUMBNAIL_FOLDER:", THUMBNAIL_FOLDER)
+print("BATCH_MAX_QUERIES:", BATCH_MAX_QUERIES)
+print("UPLOAD_MAX_MB:", UPLOAD_MAX_MB)
+
+feature_cache = FeatureCache(query_feature_map, FEATURE_CACHE_MB * 1024 * 1024, FEATURE_CACHE_PATH or None, salt=preprocessing_manifest())
+thumbnail_cache = ThumbnailCache(IMAGE_FOLDER, THUMBNAIL_FOLDER, THUMBNAIL_MAX_MB * 1024 * 1024, THUMBNAIL_WIDTHS)
+
+caches = {'feature': feature_cache, 'result': result_cache, 'thumbnail': thumbnail_cache}
+Counter('cbil_cache_hits_total', 'Cache lookups that found an entry, by cache.', function=lambda: {(('cache', name),): cache.hits for name, cache in caches.items()})
+Counter('cbil_cache_misses_total', 'Cache lookups that found no entry, by cache.', function=lambda: {(('cache', name),): cache.misses for name, cache in caches.items()})
+Gauge('cbil_cache_hit_ratio', 'Share of cache lookups that hit since start, by cache.', function=lambda: {(('cache', name),): cache.hits / max(cache.hits + cache.misses, 1) for name, cache in caches.items()})
+
+def add_image_urls(response):
+    for item in response:
+        if RESULT_THUMBNAIL_WIDTH:
+            item['thumbnail'] = f"{IMAGE_URL_PREFIX}{item['file']}?w={RESULT_THUMBNAIL_WIDTH}"
+        item['file'] = IMAGE_URL_PREFIX + item['file']
+    return response
+
+extract_pool = None
+extract_pool_lock = threading.Lock()
+extract_slots = threading.BoundedSemaphore(max(EXTRACT_WORKERS, 1) + EXTRACT_QUEUE_DEPTH)
+extract_pool_restarts = Counter('cbil_extract_pool_restarts_total', 'Extraction worker pools replaced after a worker died.')
+
+def init_extract_worker():
+    # One OpenCV thread per worker, the pool already uses every core
+    cv2.setNumThreads(1)
+
+def start_extract_pool():
+    global extract_pool
+    if EXTRACT_WORKERS > 0:
+        # fork, so workers do not re-import the server and reconnect to Elasticsearch
+        extract_pool = ProcessPoolExecutor(max_workers=EXTRACT_WORKERS, mp_context=multiprocessing.get_context('fork'), initializer=init_extract_worker)
+        # Fork every worker now, while this is the only thread, not later from a handler thread
+        for future in [extract_pool.submit(os.getpid) for _ in range(EXTRACT_WORKERS)]:
+            future.result()
+
+def replace_broken_pool(pool):
+    """
+    Starts a new pool in place of `pool` after one of its workers died, e.g.
+    killed for memory; a broken pool refuses all further work. Only the first
+    request to notice replaces it. The new workers fork from a handler thread,
+    which start_extract_pool avoids otherwise.
+    """
+    with extract_pool_lock:
+        if extract_pool is pool:
+            pool.shutdown(wait=False, cancel_futures=True)
+            start_extract_pool()
+            extract_pool_restarts.inc()
+
+def selected_feature_keys(features):
+    # The form sends the selection as a JSON string; None means every stored group
+    if features is None:
+        return feature_keys_all
+    return [feature for feature in query_feature_keys if feature in features]
+
+def extract_timed(image_data, features, check_duplicate=False):
+    """
+    extract_upload_features plus its stage timings, which would otherwise stay in the worker.
+    Returns (features, duplicate, timings). With check_duplicate, an upload that is a
+    near-duplicate of an indexed image returns that image's file instead of features;
+    its hashes come from the same decode. Forked workers share the index loaded at startup.
+    """
+    timings = {}
+    with timed(timings, 'decode'):
+        image = decode_image(image_data)
+    if image is None:
+        return None, None, timings
+    if check_duplicate:
+        with timed(timings, 'duplicate_lookup'):
+            duplicate = find_duplicate(*perceptual_hashes(image))
+        if duplicate is not None:
+            return None, duplicate, timings
+    return extract_image_features(image, features, timings), None, timings
+
+def observe_extraction(timings):
+    for name, seconds in timings.items():
+        if name in ('decode', 'duplicate_lookup', 'resize', 'denoise'):
+            stage_seconds.observe(seconds, stage=name)
+        else:
+            extractor_seconds.observe(seconds, feature=name)
+
+def extract_query_features(image_data, features, check_duplicate=False):
+    """(features, duplicate) of an upload, from extract_timed() in the worker pool."""
+    with stage_seconds.time(stage='extract'):
+        if extract_pool is None:
+            extracted, duplicate, timings = extract_timed(image_data, features, check_duplicate)
+        else:
+            pool = extract_pool
+            try:
+                extracted, duplicate, timings = pool.submit(extract_timed, image_data, features, check_duplicate).result()
+            except BrokenProcessPool:
+                replace_broken_pool(pool)
+                raise
+    observe_extraction(timings)
+    return extracted, duplicate
+
+def extract_many(images, feature_keys):
+    """Query features of every image, cached or extracted in parallel; None for images that fail to decode."""
+    results = []
+    pending = []
+    for image_data in images:
+        cache_key = feature_cache.key(image_data)
+        query_features, missing = feature_cache.get(cache_key, feature_keys)
+        results.append(query_features)
+        if missing:
+            pending.append((len(results) - 1, cache_key, image_data, missing))
+
+    with stage_seconds.time(stage='extract'):
+        if extract_pool is None:
+            extracted = [extract_timed(image_data, missing) for _, _, image_data, missing in pending]
+        else:
+            pool = extract_pool
+            try:
+                futures = [pool.submit(extract_timed, image_data, missing) for _, _, image_data, missing in pending]
+                extracted = [future.result() for future in futures]
+            except BrokenProcessPool:
+                replace_broken_pool(pool)
+                raise
+
+    for (i, cache_key, _, missing), (features, _, timings) in zip(pending, extracted):
+        observe_extraction(timings)
+        if features is None:
+            results[i] = None
+        else:
+            feature_cache.put(cache_key, features, missing)
+            results[i].update(features)
+    return results
+
+def parse_top_n(value, default=10):
+    try:
+        return min(max(int(value), 1), 100)
+    except (TypeError, ValueError):
+        return default
 
 class SimpleHTTPRequestHandler(BaseHTTPRequestHandler):
     def do_OPTIONS(self):
@@ -23,14 +192,106 @@ class SimpleHTTPRequestHandler(BaseHTTPRequestHandler):
         self.send_header("Access-Control-Allow-Headers", "Content-Type")  # Allowed headers
         self.end_headers()
 
+    def metrics_path(self):
+        # A fixed set of label values, whatever paths clients send
+        path = urlsplit(self.path).path
+        if path.startswith("/img/"):
+            return "/img"
+        return path if path in ("/upload", "/batch", "/feedback", "/metrics") else "other"
+
+    def log_request(self, code='-', size='-'):
+        requests_total.inc(path=self.metrics_path(), status=str(int(code)) if isinstance(code, int) else str(code))
+        super().log_request(code, size)
+
+    def send_busy(self, message="Server busy, try again later"):
+        """Tells the client to retry, when every extraction slot is taken or a worker was lost"""
+        self.send_response(503)
+        self.send_header("Retry-After", "1")
+        self.send_header("Content-type", "application/json")
+        self.end_headers()
+        self.wfile.write(json.dumps({"error": message}).encode())
+
+    def read_content_length(self, max_bytes):
+        """Content-Length of the request body; sends the error and returns None when it is missing or too large"""
+        try:
+            content_length = int(self.headers['Content-Length'])
+        except (TypeError, ValueError):
+            self.send_error(411, "Content-Length required")
+            return None
+        if content_length < 0:
+            self.send_error(400, "Invalid Content-Length")
+            return None
+        if content_length > max_bytes:
+            # The body is left unread, so the connection cannot be reused
+            self.close_connection = True
+            self.send_error(413, f"Request body larger than {max_bytes} bytes")
+            return None
+        return content_length
+
+    def read_form(self, max_bytes):
+        """Streams a multipart/form-data body into {name: [values]}; sends the error and returns None when it cannot"""
+        content_type, params = parse_header(self.headers['Content-Type'] or "")
+        if content_type != "multipart/form-data":
+            self.send_error(400, "Expected multipart/form-data")
+            return None
+        boundary = params.get('boundary')
+        if not boundary:
+            self.send_error(400, "Boundary not found")
+            return None
+        content_length = self.read_content_length(max_bytes)
+        if content_length is None:
+            return None
+        try:
+            with stage_seconds.time(stage='multipart_parse'):
+                return parse_multipart(self.rfile, boundary, content_length, max_bytes)
+        except MultipartError as e:
+            self.close_connection = True
+            self.send_error(e.status, str(e))
+            return None
+
+    def read_json(self, content_length):
+        """Reads a JSON object body; sends the error and returns None when it is not one"""
+        try:
+            data = json.loads(self.rfile.read(content_length))
+        except ValueError:
+            self.send_error(400, "Invalid JSON")
+            return None
+        if not isinstance(data, dict):
+            self.send_error(400, "Expected a JSON object")
+            return None
+        return data
+
     def do_GET(self):
-        """Handles GET requests for serving images"""
-        if self.path.startswith("/img/"):
-            filename = self.path[len("/img/"):]  # Extract filename
+        """Handles GET requests for serving images and metrics"""
+        path = self.metrics_path()
+        with requests_in_flight.track(path=path), request_seconds.time(path=path):
+            if urlsplit(self.path).path == "/metrics":
+                self.send_metrics()
+            else:
+                self.handle_image_request(send_body=True)
+
+    def do_HEAD(self):
+        path = self.metrics_path()
+        with requests_in_flight.track(path=path), request_seconds.time(path=path):
+            self.handle_image_request(send_body=False)
+
+    def send_metrics(self):
+        body = render_metrics().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def handle_image_request(self, send_body):
+        url = urlsplit(self.path)
+        path = unquote(url.path)
+        if path.startswith("/img/"):
+            filename = path[len("/img/"):]  # Extract filename
             file_path = os.path.join(IMAGE_FOLDER, filename)
 
-            # Validate if the file exists
-            if os.path.isfile(file_path):
+            # Validate if the file exists and stays inside IMAGE_FOLDER
+            if os.path.basename(filename) == filename and os.path.isfile(file_path):
                 # Guess MIME type
                 _, ext = os.path.splitext(filename)
                 mime_type = {
@@ -38,102 +299,349 @@ class SimpleHTTPRequestHandler(BaseHTTPRequestHandler):
                     ".jpeg": "image/jpeg",
                     ".png": "image/png",
                     ".gif": "image/gif",
+                    ".webp": "image/webp",
                 }.get(ext.lower(), "application/octet-stream")
 
-                # Serve the file
-                self.send_response(200)
-                self.send_header("Content-Type", mime_type)
-                self.end_headers()
-                with open(file_path, "rb") as f:
-                    self.wfile.write(f.read())
+                # ?w=<width>[&format=webp] serves a cached, resized copy
+                query = parse_qs(url.query)
+                if "w" in query:
+                    width = query["w"][0]
+                    fmt = query.get("format", ["jpeg"])[0]
+                    if not width.isdigit() or int(width) == 0 or fmt not in thumbnail_formats:
+                        self.send_error(400, "Invalid thumbnail width or format")
+                        return
+                    thumbnail_path = thumbnail_cache.get(filename, int(width), fmt)
+                    if thumbnail_path is not None:
+                        try:
+                            self.serve_file(thumbnail_path, thumbnail_formats[fmt][1], send_body)
+                            return
+                        except FileNotFoundError:
+                            pass  # Evicted in the meantime, the original will do
+
+                self.serve_file(file_path, mime_type, send_body)
             else:
                 self.send_error(404, "File not found")
         else:
             self.send_error(404, "Not Found")
 
+    def serve_file(self, file_path, mime_type, send_body=True):
+        """Serves a file with validators, cache headers and single byte-range support"""
+        with open(file_path, "rb") as f:
+            stat = os.fstat(f.fileno())
+            size = stat.st_size
+            etag = f'"{stat.st_mtime_ns:x}-{size:x}"'
+            last_modified = formatdate(stat.st_mtime, usegmt=True)
+
+            if self.is_not_modified(etag, stat.st_mtime):
+                self.send_response(304)
+                self.send_cache_headers(etag, last_modified)
+                self.end_headers()
+                return
+
+            byte_range = self.requested_range(etag, size)
+            if byte_range == "unsatisfiable":
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{size}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+
+            if byte_range is None:
+                start, end = 0, size - 1
+                self.send_response(200)
+            else:
+                start, end = byte_range
+                self.send_response(206)
+                self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+
+            length = end - start + 1 if size else 0
+            self.send_header("Content-Type", mime_type)
+            self.send_header("Content-Length", str(length))
+            self.send_header("Accept-Ranges", "bytes")
+            self.send_cache_headers(etag, last_modified)
+            self.end_headers()
+
+            if send_body and length:
+                self.send_file_bytes(f, start, length)
+
+    def send_cache_headers(self, etag, last_modified):
+        self.send_header("ETag", etag)
+        self.send_header("Last-Modified", last_modified)
+        self.send_header("Cache-Control", f"public, max-age={IMAGE_CACHE_MAX_AGE}")
+
+    def is_not_modified(self, etag, mtime):
+        if_none_match = self.headers.get("If-None-Match")
+        if if_none_match is not None:
+            # If-None-Match wins over If-Modified-Since when both are sent
+            tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+            return "*" in tags or etag in tags
+
+        if_modified_since = self.headers.get("If-Modified-Since")
+        if if_modified_since:
+            try:
+                return int(mtime) <= parsedate_to_datetime(if_modified_since).timestamp()
+            except (TypeError, ValueError):
+                return False
+        return False
+
+    def requested_range(self, etag, size):
+        """Returns (start, end) for a single satisfiable range, None to send everything, or 'unsatisfiable'"""
+        header = self.headers.get("Range")
+        if not header or not header.startswith("bytes=") or "," in header:
+            return None
+
+        # A stale If-Range means the client's partial copy is outdated
+        if_range = self.headers.get("If-Range")
+        if if_range and if_range.strip() != etag:
+            return None
+
+        first, _, last = header[len("bytes="):].strip().partition("-")
+        try:
+            if first:
+                start = int(first)
+                end = min(int(last), size - 1) if last else size - 1
+            else:
+                start = max(size - int(last), 0)
+                end = size - 1
+        except ValueError:
+            return None
+
+        if start >= size or start > end:
+            return "unsatisfiable"
+        return start, end
+
+    def send_file_bytes(self, f, offset, count):
+        # Zero-copy from the page cache to the socket where the OS supports it
+        if hasattr(os, "sendfile"):
+            try:
+                while count > 0:
+                    sent = os.sendfile(self.connection.fileno(), f.fileno(), offset, count)
+                    if sent == 0:
+                        return
+                    offset += sent
+                    count -= sent
+                return
+            except OSError as e:
+                if e.errno not in (errno.EINVAL, errno.ENOSYS, errno.ENOTSOCK):
+                    raise
+
+        f.seek(offset)
+        while count > 0:
+            chunk = f.read(min(count, 64 * 1024))
+            if not chunk:
+                return
+            self.wfile.write(chunk)
+            count -= len(chunk)
+
     def do_POST(self):
+        path = self.metrics_path()
+        with requests_in_flight.track(path=path), request_seconds.time(path=path):
+            self.handle_post()
+
+    def handle_post(self):
         if self.path == "/upload":
-            # Parse the content length and content type
-            content_length = int(self.headers['Content-Length'])
-            content_type = self.headers['Content-Type']
+            form_data = self.read_form(UPLOAD_MAX_MB * 1024 * 1024)
+            if form_data is None:
+                return
 
-            # Only process multipart form-data
-            if "multipart/form-data" in content_type:
-                _, params = cgi.parse_header(content_type)
-                boundary = params.get('boundary')
+            # Get image data
+            image_data = form_data.get('image', [None])[0]
+            # Get features field
+            features = form_data.get('features', [None])[0]
 
-                if boundary:
-                    # Convert boundary to bytes
-                    boundary = boundary.encode('ascii')  
+            if image_data:
+                feature_keys = selected_feature_keys(features)
+                cache_key = feature_cache.key(image_data)
+                query_features, missing = feature_cache.get(cache_key, feature_keys)
 
-                    # Parse the form data
-                    form_data = cgi.parse_multipart(self.rfile, {'boundary': boundary})
+                response = None
 
-                    # Get image data
-                    image_data = form_data.get('image', [None])[0]
-                    # Get features field
-                    features = form_data.get('features', [None])[0]
+                if missing:
+                    # Backpressure: refuse rather than queue without bound
+                    if not extract_slots.acquire(blocking=False):
+                        self.send_busy()
+                        return
+                    try:
+                        with extractions_in_flight.track():
+                            # A near-duplicate of an indexed image needs no extraction
+                            extracted, duplicate = extract_query_features(image_data, missing, duplicate_lookup)
+                            if duplicate is not None:
+                                response = search_duplicate(duplicate, feature_keys)
+                                if response is None:
+                                    extracted, _ = extract_query_features(image_data, missing)
+                    except BrokenProcessPool:
+                        self.send_busy("Extraction worker lost, try again")
+                        return
+                    finally:
+                        extract_slots.release()
 
-                    if image_data:
-                        nparr = np.frombuffer(image_data, np.uint8)
-                        image = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+                    if extracted is not None:
+                        feature_cache.put(cache_key, extracted, missing)
+                        query_features.update(extracted)
+                    else:
+                        query_features = None
 
-                        if image is not None:
-                            response = search_similar_images(image, features)
-                            for item in response:
-                                item['file'] = IMAGE_URL_PREFIX + item['file']
+                if response is None and query_features is not None:
+                    response = run_query(query_features, 10)
 
-                            self.send_response(200)
-                            self.send_header("Content-type", "application/json")
-                            self.end_headers()
-                            self.wfile.write(json.dumps(response).encode())
-                        else:
-                            self.send_error(400, "Failed to decode image")
-                    else:
-                        self.send_error(400, "No image uploaded")
+                if response is not None:
+                    add_image_urls(response)
+                    with stage_seconds.time(stage='json_serialize'):
+                        body = json.dumps(response).encode()
+
+                    self.send_response(200)
+                    self.send_header("Content-type", "application/json")
+                    self.end_headers()
+                    self.wfile.write(body)
                 else:
-                    self.send_error(400, "Boundary not found")
+                    self.send_error(400, "Failed to decode image")
             else:
-                self.send_error(400, "Expected multipart/form-data")
+                self.send_error(400, "No image uploaded")
+
+        elif self.path == "/batch":
+            self.handle_batch()
 
         elif self.path == "/feedback":
             # Parse content length and type
-            content_length = int(self.headers['Content-Length'])
+            content_length = self.read_content_length(UPLOAD_MAX_MB * 1024 * 1024)
+            if content_length is None:
+                return
             content_type = self.headers['Content-Type']
 
             if content_type == "application/json":
-                body = self.rfile.read(content_length)
-                data = json.loads(body)
+                data = self.read_json(content_length)
+                if data is None:
+                    return
 
                 # Extract file_keys and features
                 file_keys = data.get('file_keys', [])
                 features = data.get('features', None)
 
-                if not isinstance(file_keys, list):
-                    self.send_error(400, "file_keys must be a list")
+                if not isinstance(file_keys, list) or not all(isinstance(item, str) for item in file_keys):
+                    self.send_error(400, "file_keys must be a list of strings")
                     return
 
                 # Remove prefix from file keys
                 file_keys = [item.replace(IMAGE_URL_PREFIX, '') for item in file_keys]  
-                response = search_similar_images_from_keys(file_keys, features)
-                for item in response:
-                    item['file'] = IMAGE_URL_PREFIX + item['file']
+                response = search_similar_images_from_keys(file_keys, selected_feature_keys(features))
+                add_image_urls(response)
+                with stage_seconds.time(stage='json_serialize'):
+                    body = json.dumps(response).encode()
 
                 # Send JSON response
                 self.send_response(200)
                 self.send_header("Content-type", "application/json")
                 self.end_headers()
-                self.wfile.write(json.dumps(response).encode())
+                self.wfile.write(body)
             else:
                 self.send_error(400, "Expected application/json")
         else:
             self.send_error(404, "Not Found")
 
-def run(server_class=HTTPServer, handler_class=SimpleHTTPRequestHandler):
+    def handle_batch(self):
+        """
+        Answers many queries in one request, as newline-delimited JSON in
+        query order: {"index": i, "results": [...]} or {"index": i, "error": ...}.
+
+        Takes either multipart/form-data with repeated `image` parts, or JSON
+        {"file_keys": [[...], ...]}. Both accept `features` and `top_n`.
+        """
+        content_type = self.headers['Content-Type'] or ""
+
+        if "multipart/form-data" in content_type:
+            form_data = self.read_form(BATCH_MAX_MB * 1024 * 1024)
+            if form_data is None:
+                return
+            queries = form_data.get('image', [])
+            features = form_data.get('features', [None])[0]
+            top_n = parse_top_n(form_data.get('top_n', [None])[0])
+            from_images = True
+        elif content_type == "application/json":
+            content_length = self.read_content_length(BATCH_MAX_MB * 1024 * 1024)
+            if content_length is None:
+                return
+            data = self.read_json(content_length)
+            if data is None:
+                return
+            queries = data.get('file_keys', [])
+            features = data.get('features', None)
+            top_n = parse_top_n(data.get('top_n'))
+            from_images = False
+            if not isinstance(queries, list) or not all(isinstance(keys, list) and all(isinstance(item, str) for item in keys) for keys in queries):
+                self.send_error(400, "file_keys must be a list of lists of strings")
+                return
+            queries = [[item.replace(IMAGE_URL_PREFIX, '') for item in keys] for keys in queries]
+        else:
+            self.send_error(400, "Expected multipart/form-data or application/json")
+            return
+
+        if not queries:
+            self.send_error(400, "No queries")
+            return
+        if len(queries) > BATCH_MAX_QUERIES:
+            self.send_error(413, f"At most {BATCH_MAX_QUERIES} queries per batch")
+            return
+
+        feature_keys = selected_feature_keys(features)
+        # A batch holds one extraction slot, its images share the worker pool
+        if from_images and not extract_slots.acquire(blocking=False):
+            self.send_busy()
+            return
+        if from_images:
+            extractions_in_flight.inc()
+
+        try:
+            # Results are written per chunk, so the client can start on them early
+            for start in range(0, len(queries), BATCH_CHUNK_SIZE):
+                chunk = queries[start:start + BATCH_CHUNK_SIZE]
+                if from_images:
+                    try:
+                        query_features = extract_many(chunk, feature_keys)
+                    except BrokenProcessPool:
+                        if start == 0:
+                            self.send_busy("Extraction worker lost, try again")
+                        else:
+                            # Too late for a status code, the rest of the batch fails instead
+                            lines = [json.dumps({"index": i, "error": "Extraction worker lost, try again"}) for i in range(start, len(queries))]
+                            self.wfile.write(("\n".join(lines) + "\n").encode())
+                        return
+                    found = [i for i, features in enumerate(query_features) if features is not None]
+                    results = [None] * len(chunk)
+                    for i, response in zip(found, run_queries([query_features[i] for i in found], top_n) if found else []):
+                        results[i] = response
+                else:
+                    results = search_similar_images_from_key_sets(chunk, feature_keys, top_n)
+
+                if start == 0:
+                    self.send_response(200)
+                    self.send_header("Content-type", "application/x-ndjson")
+                    self.end_headers()
+
+                lines = []
+                with stage_seconds.time(stage='json_serialize'):
+                    for i, response in enumerate(results, start):
+                        if response is None:
+                            lines.append(json.dumps({"index": i, "error": "Failed to decode image"}))
+                        else:
+                            lines.append(json.dumps({"index": i, "results": add_image_urls(response)}))
+                self.wfile.write(("\n".join(lines) + "\n").encode())
+                self.wfile.flush()
+        finally:
+            if from_images:
+                extractions_in_flight.dec()
+                extract_slots.release()
+
+def run(server_class=ThreadingHTTPServer, handler_class=SimpleHTTPRequestHandler):
+    start_extract_pool()
     server_address = ('', int(PORT))
     httpd = server_class(server_address, handler_class)
     print(f"Starting server on port {int(PORT)}")
-    httpd.serve_forever()
+    # Exit through finally on docker stop as well as Ctrl+C
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    try:
+        httpd.serve_forever()
+    finally:
+        feature_cache.save()
 
 if __name__ == "__main__":
     run()
@@ -1,11 +1,14 @@
 import cv2
+import functools
 import numpy as np
 import skimage.feature as skf
 import skimage.color as skc
 from skimage.filters import sobel
 from skimage.transform import resize
 import os
+import time
 import pywt
+from contextlib import contextmanager
 
 from dotenv import load_dotenv
 load_dotenv()
@@ -13,6 +16,18 @@ bin_count = int(os.getenv('BIN_COUNT'))
 img_size_x = int(os.getenv('IMG_SIZE_X'))
 img_size_y = int(os.getenv('IMG_SIZE_Y'))
 img_size = {'x': img_size_x, 'y': img_size_y}
+# Gray levels for GLCM; fewer levels is much faster but changes the stored vectors
+glcm_levels = int(os.getenv('GLCM_LEVELS', 256))
+denoise_mode = os.getenv('DENOISE_MODE', 'nlmeans')
+denoise_modes = ['nlmeans', 'bilateral', 'gaussian', 'median', 'none']
+if denoise_mode not in denoise_modes:
+    raise ValueError(f"DENOISE_MODE must be one of {denoise_modes}, got {denoise_mode}")
+# Strongest SIFT keypoints kept per image for the visual-word index
+sift_max_keypoints = int(os.getenv('SIFT_MAX_KEYPOINTS', 500))
+# Decode large JPEGs at 1/2, 1/4 or 1/8 size when that still covers the resize target
+reduced_decode = int(os.getenv('REDUCED_DECODE', 0))
+# Shortest side a reduced decode must keep, so even a rotated image is never enlarged
+decode_side = max(img_size_x, img_size_y)
 
 # Pre-processing Functions
 def resize_image(image, size=(img_size['x'], img_size['y'])):
@@ -21,29 +36,99 @@ def resize_image(image, size=(img_size['x'], img_size['y'])):
 def convert_to_grayscale(image):
     return cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
 
-def denoise_image(image):
-    return cv2.fastNlMeansDenoisingColored(image, None, 10, 10, 7, 21)
+def denoise_image(image, mode=denoise_mode):
+    if mode == 'nlmeans':
+        return cv2.fastNlMeansDenoisingColored(image, None, 10, 10, 7, 21)
+    if mode == 'bilateral':
+        return cv2.bilateralFilter(image, 9, 75, 75)
+    if mode == 'gaussian':
+        return cv2.GaussianBlur(image, (5, 5), 0)
+    if mode == 'median':
+        return cv2.medianBlur(image, 5)
+    if mode == 'none':
+        return image
+    raise ValueError(f"Unknown denoise mode: {mode}")
+
+def preprocess_image(image):
+    return denoise_image(resize_image(image))
+
+def preprocessing_manifest():
+    """Settings that change the stored vectors; an index only matches queries made with the same ones."""
+    manifest = {
+        'denoise': denoise_mode,
+        'img_size': [img_size['x'], img_size['y']],
+        'bin_count': bin_count,
+        'glcm_levels': glcm_levels,
+    }
+    if reduced_decode:
+        manifest['reduced_decode'] = True
+    return manifest
 
 def edge_detection(image):
-    gray = convert_to_grayscale(image)
+    gray = as_context(image).gray
     return cv2.Canny(gray, 100, 200)
 
+class ImageContext:
+    """
+    Holds one preprocessed BGR image and lazily computes the variants the
+    extractors share (grayscale, float32, downscaled), so each conversion runs
+    at most once per image however many extractors ask for it.
+    """
+
+    def __init__(self, image):
+        self.image = image
+        self._cache = {}
+
+    def _memo(self, key, compute):
+        if key not in self._cache:
+            self._cache[key] = compute()
+        return self._cache[key]
+
+    @property
+    def gray(self):
+        return self._memo('gray', lambda: convert_to_grayscale(self.image))
+
+    @property
+    def gray_float32(self):
+        return self._memo('gray_float32', lambda: np.float32(self.gray) / 255.0)
+
+    @property
+    def glcm_gray(self):
+        # uint8 arithmetic wraps here; kept as is so indexed vectors stay comparable
+        return self._memo('glcm_gray', lambda: (self.gray * 255).astype(np.uint8))
+
+    def resized(self, size):
+        return self._memo(('resized', size), lambda: resize_image(self.image, size))
+
+    def resized_gray(self, size):
+        return self._memo(('resized_gray', size), lambda: convert_to_grayscale(self.resized(size)))
+
+    def resized_float(self, size):
+        # skimage resize: anti-aliased and scaled to float64 in [0, 1]
+        return self._memo(('resized_float', size), lambda: resize(self.image, size))
+
+def as_context(image):
+    return image if isinstance(image, ImageContext) else ImageContext(image)
+
 # Processing Functions
 
 # 1. RGB Color Mean
 def color_intensity_mean(image):
-    b_mean, g_mean, r_mean = cv2.mean(image)[:3]
-    gray = convert_to_grayscale(image)
+    context = as_context(image)
+    b_mean, g_mean, r_mean = cv2.mean(context.image)[:3]
+    gray = context.gray
     intensity_mean = np.mean(gray)
     return r_mean, g_mean, b_mean, intensity_mean
 
 # 2. RGB Color Histogram
 def color_intensity_histogram(image, bins=bin_count):
+    context = as_context(image)
+    image = context.image
     blue_hist = cv2.calcHist([image], [0], None, [bins], [0, 256]).flatten()
     green_hist = cv2.calcHist([image], [1], None, [bins], [0, 256]).flatten()
     red_hist = cv2.calcHist([image], [2], None, [bins], [0, 256]).flatten()
 
-    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    gray = context.gray
     intensity_hist = cv2.calcHist([gray], [0], None, [bins], [0, 256]).flatten()
     
     blue_hist /= blue_hist.sum()
@@ -54,51 +139,60 @@ def color_intensity_histogram(image, bins=bin_count):
     return red_hist, green_hist, blue_hist, intensity_hist
 
 # 3. GLCM Features
-def glcm_features(image, dx, dy):
-    gray = convert_to_grayscale(image)
-    gray = (gray * 255).astype(np.uint8)
-    glcm = skf.graycomatrix(gray, distances=[1], angles=[np.arctan2(dy, dx)], levels=256, symmetric=True, normed=True)
-    features = {
-        'energy': skf.graycoprops(glcm, 'energy')[0, 0],
-        'contrast': skf.graycoprops(glcm, 'contrast')[0, 0],
-        'entropy': -np.sum(glcm * np.log2(glcm + (glcm == 0))),
-        'dissimilarity': skf.graycoprops(glcm, 'dissimilarity')[0, 0],
-        'homogeneity': skf.graycoprops(glcm, 'homogeneity')[0, 0],
-        'correlation': skf.graycoprops(glcm, 'correlation')[0, 0]
-    }
-    return features
+glcm_directions = [(1, 0), (0, 1), (1, 1), (-1, 1)]
+
+@functools.lru_cache(maxsize=None)
+def glcm_weights(levels):
+    # Rows: i, j, i^2, j^2, i*j, (i-j)^2, |i-j|, 1/(1+(i-j)^2) over the flattened matrix
+    I, J = np.indices((levels, levels), dtype=np.float64)
+    I = I.ravel()
+    J = J.ravel()
+    diff = I - J
+    return np.stack([I, J, I ** 2, J ** 2, I * J, diff ** 2, np.abs(diff), 1.0 / (1.0 + diff ** 2)], axis=1)
 
-def glcm_features_all_directions(image):
-    directions = [(1, 0), (0, 1), (1, 1), (-1, 1)]
-
-    energy = []
-    contrast = []
-    entropy = []
-    dissimilarity = []
-    homogeneity = []
-    correlation = []
-
-    for dx, dy in directions:
-        features = glcm_features(image, dx, dy)
-        energy.append(features["energy"])
-        contrast.append(features["contrast"])
-        entropy.append(features["entropy"])
-        dissimilarity.append(features["dissimilarity"])
-        homogeneity.append(features["homogeneity"])
-        correlation.append(features["correlation"])
+def glcm_properties(glcm):
+    """Energy, contrast, entropy, dissimilarity, homogeneity and correlation of every (levels, levels, 1, angles) GLCM at once."""
+    levels = glcm.shape[0]
+    # One row per angle, so the weighted sums are a single matrix product
+    P = np.ascontiguousarray(np.moveaxis(glcm[:, :, 0, :], -1, 0)).reshape(-1, levels * levels).astype(np.float64)
+    sums = P @ glcm_weights(levels)
+    mean_i, mean_j, square_i, square_j, product, contrast, dissimilarity, homogeneity = sums.T
+
+    std_i = np.sqrt(np.clip(square_i - mean_i ** 2, 0, None))
+    std_j = np.sqrt(np.clip(square_j - mean_j ** 2, 0, None))
+    cov = product - mean_i * mean_j
+    flat = (std_i < 1e-15) | (std_j < 1e-15)
+    correlation = np.where(flat, 1.0, cov / np.where(flat, 1.0, std_i * std_j))
+
+    log_P = np.zeros_like(P)
+    np.log2(P, out=log_P, where=P > 0)
 
     return {
-        "energy": np.array(energy),
-        "contrast": np.array(contrast),
-        "entropy": np.array(entropy),
-        "dissimilarity": np.array(dissimilarity),
-        "homogeneity": np.array(homogeneity),
-        "correlation": np.array(correlation)
+        'energy': np.sqrt(np.einsum('ij,ij->i', P, P)),
+        'contrast': contrast,
+        'entropy': -np.einsum('ij,ij->i', P, log_P),
+        'dissimilarity': dissimilarity,
+        'homogeneity': homogeneity,
+        'correlation': correlation,
     }
 
+def glcm_matrix(image, directions, levels=glcm_levels):
+    gray = as_context(image).glcm_gray
+    if levels != 256:
+        gray = (gray.astype(np.uint16) * levels // 256).astype(np.uint8)
+    angles = [np.arctan2(dy, dx) for dx, dy in directions]
+    return skf.graycomatrix(gray, distances=[1], angles=angles, levels=levels, symmetric=True, normed=True)
+
+def glcm_features(image, dx, dy, levels=glcm_levels):
+    features = glcm_properties(glcm_matrix(image, [(dx, dy)], levels))
+    return {name: values[0] for name, values in features.items()}
+
+def glcm_features_all_directions(image, levels=glcm_levels):
+    return glcm_properties(glcm_matrix(image, glcm_directions, levels))
+
 # 4. HOG
 def compute_hog(image, pixel_per_cell=16, cell_per_block=2, orientations=6):
-    gray = convert_to_grayscale(image)
+    gray = as_context(image).gray
     hog = skf.hog(gray, pixels_per_cell=(pixel_per_cell, pixel_per_cell), 
         cells_per_block=(cell_per_block, cell_per_block), 
         orientations=orientations, feature_vector=True)
@@ -107,33 +201,57 @@ def compute_hog(image, pixel_per_cell=16, cell_per_block=2, orientations=6):
 
 # 5. GIST Descriptor (Simplified using Sobel)
 def compute_gist(image, size=(img_size['x']//4, img_size['y']//4)):
-    resized = resize(image, size)
+    resized = as_context(image).resized_float(size)
     gray = skc.rgb2gray(resized)
     edges = sobel(gray)
     return edges.flatten()
 
 # 6. DCT Features
-def extract_dct_features(image, block_size=16, num_coefficients=20):
-    if len(image.shape) == 3:
-        image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-    
-    image = np.float32(image) / 255.0
-    
-    dct_features = []
+@functools.lru_cache(maxsize=None)
+def dct_matrix(size):
+    # Orthonormal DCT-II basis, the same transform cv2.dct applies
+    k = np.arange(size)[:, None]
+    x = np.arange(size)[None, :]
+    basis = np.cos(np.pi * (2 * x + 1) * k / (2 * size)) * np.sqrt(2.0 / size)
+    basis[0] /= np.sqrt(2.0)
+    return basis.astype(np.float32)
+
+@functools.lru_cache(maxsize=None)
+def dct_coefficient_index(block_height, block_width, num_coefficients, zigzag=False):
+    """Flat indices of the coefficients kept from a block_height x block_width DCT block."""
+    if not zigzag:
+        return np.arange(min(num_coefficients, block_height * block_width))
+    # JPEG order: walk the anti-diagonals, alternating direction
+    cells = [(i, j) for i in range(block_height) for j in range(block_width)]
+    cells.sort(key=lambda cell: (cell[0] + cell[1], cell[0] if (cell[0] + cell[1]) % 2 else -cell[0]))
+    return np.array([i * block_width + j for i, j in cells[:num_coefficients]])
+
+def extract_dct_features(image, block_size=16, num_coefficients=20, zigzag=False):
+    context = as_context(image)
+    if len(context.image.shape) == 3:
+        image = context.gray_float32
+    else:
+        image = np.float32(context.image) / 255.0
 
     height, width = image.shape
-    for i in range(0, height, block_size):
-        for j in range(0, width, block_size):
-            block = image[i:i+block_size, j:j+block_size]
-            
-            dct_block = cv2.dct(block)
-            
-            dct_features.extend(dct_block.flatten()[:num_coefficients])
+    if height % block_size or width % block_size:
+        # Edge blocks have other shapes, transform them one at a time
+        dct_features = []
+        for i in range(0, height, block_size):
+            for j in range(0, width, block_size):
+                dct_block = cv2.dct(np.ascontiguousarray(image[i:i+block_size, j:j+block_size]))
+                dct_features.extend(dct_block.flatten()[dct_coefficient_index(*dct_block.shape, num_coefficients, zigzag)])
+        return np.array(dct_features)
 
-    return np.array(dct_features)
+    # (blocks, block_size, block_size) view in row-major block order
+    blocks = image.reshape(height // block_size, block_size, width // block_size, block_size).swapaxes(1, 2).reshape(-1, block_size, block_size)
+    basis = dct_matrix(block_size)
+    coefficients = (basis @ blocks @ basis.T).reshape(len(blocks), -1)
+    return coefficients[:, dct_coefficient_index(block_size, block_size, num_coefficients, zigzag)].ravel()
 
 # 7. Wavelet Features
 def extract_wavelet_features(image, wavelet='db1', level=3):
+    image = as_context(image).image
     coeffs2 = pywt.dwt2(image, wavelet, level)
     
     cA, (cH, cV, cD) = coeffs2
@@ -151,10 +269,7 @@ def extract_wavelet_features(image, wavelet='db1', level=3):
 
 # 8. Harris Corner Detector
 def harris_corners(image, block_size=2, ksize=3, k=0.04, threshold=0.1):
-    image2 = image.copy()
-    image2 = resize_image(image2, (32, 32))
-
-    gray = convert_to_grayscale(image2)
+    gray = as_context(image).resized_gray((32, 32))
     gray = np.float32(gray)
     
     corners = cv2.cornerHarris(gray, block_size, ksize, k)
@@ -163,3 +278,166 @@ def harris_corners(image, block_size=2, ksize=3, k=0.04, threshold=0.1):
     corners_1d = corners.flatten()
     
     return corners_1d
+
+# 9. SIFT keypoint descriptors, quantized into visual words by visual_words.py
+def compute_sift(image, max_keypoints=sift_max_keypoints):
+    gray = as_context(image).gray
+    _, descriptors = cv2.SIFT_create(nfeatures=max_keypoints).detectAndCompute(gray, None)
+    if descriptors is None:
+        return np.zeros((0, 128), dtype=np.uint8)
+    # Descriptor entries are clamped to 0..255 by OpenCV, uint8 holds them at a quarter of the size
+    return descriptors.astype(np.uint8)
+
+# 10. Perceptual hashes for near-duplicate detection (near_duplicates.py). They
+# are taken from the raw image so they do not depend on the preprocessing settings
+def hash_bits(bits):
+    return int.from_bytes(np.packbits(bits).tobytes(), 'big')
+
+def perceptual_hashes(image):
+    """(pHash, dHash) of a BGR image as 64-bit integers."""
+    gray = convert_to_grayscale(image) if image.ndim == 3 else image
+    # pHash: low DCT frequencies above or below their median, without the DC term
+    small = cv2.resize(gray, (32, 32), interpolation=cv2.INTER_AREA).astype(np.float32)
+    low = cv2.dct(small)[:8, :8].flatten()[1:]
+    # dHash: whether each pixel is brighter than its left neighbour
+    tiny = cv2.resize(gray, (9, 8), interpolation=cv2.INTER_AREA).astype(np.int16)
+    return hash_bits(low > np.median(low)), hash_bits((tiny[:, 1:] > tiny[:, :-1]).flatten())
+
+# Single-pass extraction of the requested feature groups
+@contextmanager
+def timed(timings, name):
+    """Adds the seconds spent in the block to timings[name]; does nothing when timings is None."""
+    if timings is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[name] = timings.get(name, 0.0) + time.perf_counter() - start
+
+def extract_features(image, feature_keys=['mean', 'hist', 'glcm', 'hog', 'gist', 'dct', 'wavelet', 'corners'], timings=None):
+    context = as_context(image)
+    features = {}
+
+    if 'mean' in feature_keys:
+        with timed(timings, 'mean'):
+            r_mean, g_mean, b_mean, i_mean = color_intensity_mean(context)
+            features['r_mean'] = r_mean
+            features['g_mean'] = g_mean
+            features['b_mean'] = b_mean
+            features['i_mean'] = i_mean
+
+    if 'hist' in feature_keys:
+        with timed(timings, 'hist'):
+            r_hist, g_hist, b_hist, i_hist = color_intensity_histogram(context)
+            features['r_hist'] = r_hist
+            features['g_hist'] = g_hist
+            features['b_hist'] = b_hist
+            features['i_hist'] = i_hist
+
+    if 'glcm' in feature_keys:
+        with timed(timings, 'glcm'):
+            glcm = glcm_features_all_directions(context)
+            features['energy'] = glcm['energy']
+            features['contrast'] = glcm['contrast']
+            features['entropy'] = glcm['entropy']
+            features['dissimilarity'] = glcm['dissimilarity']
+            features['homogeneity'] = glcm['homogeneity']
+            features['correlation'] = glcm['correlation']
+
+    if 'hog' in feature_keys:
+        with timed(timings, 'hog'):
+            features['hog'] = compute_hog(context)
+
+    if 'gist' in feature_keys:
+        with timed(timings, 'gist'):
+            features['gist'] = compute_gist(context)
+
+    if 'dct' in feature_keys:
+        with timed(timings, 'dct'):
+            features['dct'] = extract_dct_features(context)
+
+    if 'wavelet' in feature_keys:
+        with timed(timings, 'wavelet'):
+            features['wavelet'] = extract_wavelet_features(context)
+
+    if 'corners' in feature_keys:
+        with timed(timings, 'corners'):
+            features['corners'] = harris_corners(context)
+
+    if 'sift' in feature_keys:
+        with timed(timings, 'sift'):
+            features['sift'] = compute_sift(context)
+
+    return features
+
+def jpeg_size(image_data):
+    """(width, height) from the frame header of JPEG bytes; None for anything else."""
+    if image_data[:2] != b'\xff\xd8':
+        return None
+    i = 2
+    while i + 9 < len(image_data):
+        if image_data[i] != 0xff:
+            return None
+        marker = image_data[i + 1]
+        if marker == 0xff:
+            i += 1
+            continue
+        # SOF0-SOF15, other than DHT, JPG and DAC
+        if 0xc0 <= marker <= 0xcf and marker not in (0xc4, 0xc8, 0xcc):
+            return int.from_bytes(image_data[i + 7:i + 9], 'big'), int.from_bytes(image_data[i + 5:i + 7], 'big')
+        if marker == 0x01 or 0xd0 <= marker <= 0xd7:
+            i += 2
+            continue
+        i += 2 + int.from_bytes(image_data[i + 2:i + 4], 'big')
+    return None
+
+reduced_flags = [(8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4), (2, cv2.IMREAD_REDUCED_COLOR_2)]
+
+def decode_flag(image_data, min_side=decode_side):
+    """The largest JPEG reduction that keeps both sides at least `min_side`, so the image is only ever shrunk afterwards."""
+    dimensions = jpeg_size(image_data)
+    if dimensions is None:
+        return cv2.IMREAD_COLOR
+    for factor, flag in reduced_flags:
+        if min(dimensions) // factor >= min_side:
+            return flag
+    return cv2.IMREAD_COLOR
+
+def decode_image(image_data, reduce=True, min_side=decode_side):
+    """
+    Decodes encoded image bytes; with REDUCED_DECODE set, large JPEGs are
+    decoded at reduced size. Pass reduce=False for the full resolution.
+    """
+    flag = decode_flag(image_data, min_side) if reduce and reduced_decode else cv2.IMREAD_COLOR
+    return cv2.imdecode(np.frombuffer(image_data, np.uint8), flag)
+
+def read_image(path, reduce=True, min_side=decode_side):
+    """decode_image() of an image file; None if it cannot be read, like cv2.imread."""
+    try:
+        with open(path, 'rb') as f:
+            image_data = f.read()
+    except OSError:
+        return None
+    return decode_image(image_data, reduce, min_side) if image_data else None
+
+def extract_upload_features(image_data, feature_keys=['mean', 'hist', 'glcm', 'hog', 'gist', 'dct', 'wavelet', 'corners'], timings=None):
+    """
+    Decodes, preprocesses and extracts an uploaded image; None if it cannot be decoded. Safe to run in a worker process.
+    A `timings` dict receives the seconds spent decoding, resizing, denoising and in each feature group.
+    """
+    with timed(timings, 'decode'):
+        image = decode_image(image_data)
+    if image is None:
+        return None
+    return extract_image_features(image, feature_keys, timings)
+
+def extract_image_features(image, feature_keys=['mean', 'hist', 'glcm', 'hog', 'gist', 'dct', 'wavelet', 'corners'], timings=None):
+    """Preprocesses and extracts an already decoded upload, timed as in extract_upload_features()."""
+    # preprocess_image(), split up so both steps are timed
+    with timed(timings, 'resize'):
+        image = resize_image(image)
+    with timed(timings, 'denoise'):
+        image = denoise_image(image)
+    return extract_features(ImageContext(image), feature_keys, timings)
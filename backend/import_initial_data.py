@@ -1,8 +1,24 @@
+import argparse
 import cv2
+import hashlib
+import json
+import multiprocessing
 import numpy as np
 import os
-from elasticsearch import Elasticsearch
-from image_processing import resize_image, denoise_image, color_intensity_mean, color_intensity_histogram, glcm_features_all_directions, compute_hog, compute_gist, extract_dct_features, extract_wavelet_features, harris_corners
+import queue
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from elasticsearch import Elasticsearch, helpers
+from features import feature_map, feature_keys_all
+from ann_index import ANNSearchBackend, IndexFormatError
+from visual_words import VisualWordIndex
+from near_duplicates import HashIndex
+from image_processing import preprocess_image, preprocessing_manifest, ImageContext, extract_features, compute_sift, perceptual_hashes, decode_image, jpeg_size
+from thumbnails import ThumbnailCache
+from index_meta import check_preprocessing, check_vector_format, update_index_meta, bump_generation
+from vector_formats import stored_document, bitset_groups, index_mapping
+from catalog import FileCatalog, scan_folder, file_sha256
 
 from dotenv import load_dotenv
 load_dotenv()
@@ -11,12 +27,42 @@ ELASTIC_USERNAME = os.getenv('ELASTIC_USERNAME')
 ELASTIC_PASSWORD = os.getenv('ELASTIC_PASSWORD')
 ELASTIC_INDEX = os.getenv('ELASTIC_INDEX')
 IMAGE_FOLDER = os.getenv('IMAGE_FOLDER', 'images')
+ANN_INDEX_PATH = os.getenv('ANN_INDEX_PATH', 'ann_index.npz')
+SIFT_INDEX_PATH = os.getenv('SIFT_INDEX_PATH', 'sift_index.npz')
+# Perceptual hashes of the indexed images; with INGEST_DEDUP=1, of two images within
+# DUPLICATE_DISTANCE bits only the one whose name sorts first is indexed
+DUPLICATE_INDEX_PATH = os.getenv('DUPLICATE_INDEX_PATH', 'duplicate_index.npz')
+DUPLICATE_DISTANCE = int(os.getenv('DUPLICATE_DISTANCE', 4))
+INGEST_DEDUP = int(os.getenv('INGEST_DEDUP', 0))
+INGEST_WORKERS = int(os.getenv('INGEST_WORKERS', os.cpu_count()))
+INGEST_CHUNK_SIZE = int(os.getenv('INGEST_CHUNK_SIZE', 200))
+INGEST_QUEUE_SIZE = int(os.getenv('INGEST_QUEUE_SIZE', 1000))
+INGEST_BULK_THREADS = int(os.getenv('INGEST_BULK_THREADS', 2))
+# Size, mtime, hash and feature version of every indexed file
+INGEST_CATALOG = os.getenv('INGEST_CATALOG', 'ingest_catalog.sqlite3')
+# Only read to seed a new catalog from the file list of earlier imports
+INGEST_CHECKPOINT = os.getenv('INGEST_CHECKPOINT', 'ingest_checkpoint.txt')
+# Watch mode: seconds between folder scans, and how long a file must be unmodified
+INGEST_WATCH_INTERVAL = float(os.getenv('INGEST_WATCH_INTERVAL', 10))
+INGEST_WATCH_SETTLE = float(os.getenv('INGEST_WATCH_SETTLE', 5))
+THUMBNAIL_FOLDER = os.getenv('THUMBNAIL_FOLDER', 'thumbnails')
+THUMBNAIL_MAX_MB = int(os.getenv('THUMBNAIL_MAX_MB', 512))
+THUMBNAIL_WIDTHS = [int(w) for w in os.getenv('THUMBNAIL_WIDTHS', '128,256,512').split(',') if w]
+# Thumbnail widths written during import; the server makes the rest on first request
+THUMBNAIL_PREGENERATE = [int(w) for w in os.getenv('THUMBNAIL_PREGENERATE', '').split(',') if w]
+VECTOR_FORMAT = os.getenv('VECTOR_FORMAT', 'float')
 
 print("ELASTIC_URL:", ELASTIC_URL)
 print("ELASTIC_USERNAME:", ELASTIC_USERNAME)
 print("ELASTIC_PASSWORD:", ELASTIC_PASSWORD)
 print("ELASTIC_INDEX:", ELASTIC_INDEX)
 print("IMAGE_FOLDER:", IMAGE_FOLDER)
+print("ANN_INDEX_PATH:", ANN_INDEX_PATH)
+print("SIFT_INDEX_PATH:", SIFT_INDEX_PATH)
+print("INGEST_DEDUP:", INGEST_DEDUP)
+print("INGEST_WORKERS:", INGEST_WORKERS)
+print("INGEST_CATALOG:", INGEST_CATALOG)
+print("VECTOR_FORMAT:", VECTOR_FORMAT)
 
 es = Elasticsearch(ELASTIC_URL,
     basic_auth=(ELASTIC_USERNAME, ELASTIC_PASSWORD)
@@ -28,66 +74,317 @@ def index_feature_to_elasticsearch(feature_dict):
     es.options(request_timeout=30).index(index=ELASTIC_INDEX, id=file_name, body=feature_dict)
 
 def get_features (image, image_path):
-    image = resize_image(image)
-    image = denoise_image(image)
-
-    r_mean, g_mean, b_mean, i_mean = color_intensity_mean(image)
-    r_hist, g_hist, b_hist, i_hist = color_intensity_histogram(image)
-    features = glcm_features_all_directions(image)
-    hog = compute_hog(image)
-    gist = compute_gist(image)
-    dct = extract_dct_features(image)
-    wavelet = extract_wavelet_features(image)
-    corners = harris_corners(image)
-
-    feature = {
-        'file': image_path,
-        'r_mean': r_mean,
-        'g_mean': g_mean,
-        'b_mean': b_mean,
-        'i_mean': i_mean,
-        'r_hist': r_hist,
-        'g_hist': g_hist,
-        'b_hist': b_hist,
-        'i_hist': i_hist,
-        'energy': features['energy'],
-        'contrast': features['contrast'],
-        'entropy': features['entropy'],
-        'dissimilarity': features['dissimilarity'],
-        'homogeneity': features['homogeneity'],
-        'correlation': features['correlation'],
-        'hog': hog,
-        'gist': gist,
-        'dct': dct,
-        'wavelet': wavelet,
-        'corners': corners,
-    }
+    image = preprocess_image(image)
+
+    feature = {'file': image_path}
+    context = ImageContext(image)
+    feature.update(extract_features(context))
+    if sift_vocabulary is not None:
+        # Visual-word histogram for the SIFT index, never sent to Elasticsearch
+        feature['sift'] = sift_vocabulary.word_counts(compute_sift(context))
 
     return feature
 
 
-def process_images_in_folder_to_elastic(folder_path):
-    i = 1
-    process_files = True
-    start_from = 0
-    files = os.listdir(folder_path)
-    files.sort()
-
-    for filename in files:
-        print(f"{i} {process_files} - File to Process: {filename}               ", end="\r")
-        if (process_files):
-            if filename.lower().endswith(('png', 'jpg', 'jpeg', 'bmp')):
-                image_path = os.path.join(folder_path, filename)
-                image = cv2.imread(image_path)
-                if image is None:
-                    continue
-                
-                feature = get_features(image, filename)
-
-                index_feature_to_elasticsearch(feature)
-        elif i == start_from:
-            process_files = True
-            
-        i += 1
-
-process_images_in_folder_to_elastic(IMAGE_FOLDER)
\ No newline at end of file
+def open_ann_index():
+    # Only keep an ANN index current if one has already been built
+    if not os.path.isfile(ANN_INDEX_PATH):
+        return None
+    ann_backend = ANNSearchBackend(feature_map, binary_groups=bitset_groups(VECTOR_FORMAT), vector_format=VECTOR_FORMAT)
+    try:
+        ann_backend.load(ANN_INDEX_PATH)
+    except IndexFormatError as e:
+        # The search server rebuilds it from the whole index on its next start
+        print(f"{e}; not updating it")
+        return None
+    return ann_backend
+
+def open_duplicate_index():
+    # Always kept, so deduplication also works on the first import
+    if not os.path.isfile(DUPLICATE_INDEX_PATH):
+        return HashIndex(DUPLICATE_DISTANCE)
+    return HashIndex.load(DUPLICATE_INDEX_PATH, DUPLICATE_DISTANCE)
+
+def open_sift_index():
+    # Likewise only kept current once visual_words.py has built it
+    if not os.path.isfile(SIFT_INDEX_PATH):
+        return None
+    return VisualWordIndex.load(SIFT_INDEX_PATH)
+
+def read_checkpoint(checkpoint_path):
+    if not os.path.isfile(checkpoint_path):
+        return set()
+    with open(checkpoint_path) as f:
+        return {line.rstrip("\n") for line in f if line.strip()}
+
+def feature_version():
+    """Changes whenever re-extracting would give different stored vectors."""
+    settings = {'preprocessing': preprocessing_manifest(), 'features': feature_keys_all, 'vector_format': VECTOR_FORMAT}
+    return hashlib.sha1(json.dumps(settings, sort_keys=True).encode()).hexdigest()[:16]
+
+def open_catalog(folder_path, catalog_path, version):
+    is_new = not os.path.isfile(catalog_path)
+    catalog = FileCatalog(catalog_path)
+    if is_new and os.path.isfile(INGEST_CHECKPOINT):
+        # Files of an earlier checkpoint-based import count as indexed; without a
+        # hash they are re-extracted as soon as their size or mtime changes
+        current = scan_folder(folder_path)
+        seeded = [file for file in read_checkpoint(INGEST_CHECKPOINT) if file in current]
+        for file in seeded:
+            catalog.record(file, *current[file], None, version)
+        catalog.commit()
+        print(f"Seeded catalog with {len(seeded)} files from {INGEST_CHECKPOINT}")
+    return catalog
+
+def open_thumbnail_cache(folder_path):
+    return ThumbnailCache(folder_path, THUMBNAIL_FOLDER, THUMBNAIL_MAX_MB * 1024 * 1024, THUMBNAIL_WIDTHS)
+
+# Set before the pool starts so forked workers inherit them
+thumbnail_cache = None
+sift_vocabulary = None
+
+def init_worker():
+    # One OpenCV thread per worker, the pool already uses every core
+    cv2.setNumThreads(1)
+
+def extract_file_features(image_path):
+    """Runs in a pool worker: reads one image and returns (filename, sha256, feature, error)."""
+    filename = os.path.basename(image_path)
+    try:
+        sha256 = file_sha256(image_path)
+        with open(image_path, 'rb') as f:
+            image_data = f.read()
+        # Decoded exactly as an upload of the same file, so the image finds itself
+        image = decode_image(image_data) if image_data else None
+        if image is None:
+            return filename, sha256, None, None
+        if thumbnail_cache is not None:
+            widest = max(THUMBNAIL_PREGENERATE)
+            size = jpeg_size(image_data)
+            thumbnail_image = image
+            # A reduced decode too small for the widest thumbnail; those get their own
+            if size is not None and min(image.shape[:2]) < min(size) and min(image.shape[:2]) < widest:
+                thumbnail_image = decode_image(image_data, min_side=widest)
+            for width in THUMBNAIL_PREGENERATE:
+                thumbnail_cache.store(filename, thumbnail_image, width)
+        feature = get_features(image, filename)
+        feature['hashes'] = perceptual_hashes(image)
+        return filename, sha256, feature, None
+    except Exception as e:
+        return filename, None, None, str(e)
+
+def extract_in_pool(image_paths, workers, queue_size, ordered=False):
+    """
+    Yields (filename, sha256, feature, error) as pool workers finish them, or in
+    the order of `image_paths` when `ordered`. At most `queue_size` images are in
+    flight or waiting, so a slow bulk consumer holds the workers back instead of
+    piling results up in memory.
+    """
+    results = queue.Queue()
+    slots = threading.BoundedSemaphore(queue_size)
+
+    def submit_all():
+        # Forked, so workers inherit thumbnail_cache and sift_vocabulary; under
+        # spawn or forkserver they would re-import this module without them
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('fork'), initializer=init_worker) as executor:
+            for image_path in image_paths:
+                slots.acquire()
+                future = executor.submit(extract_file_features, image_path)
+                if ordered:
+                    results.put(future)
+                else:
+                    future.add_done_callback(results.put)
+        results.put(None)
+
+    threading.Thread(target=submit_all, daemon=True).start()
+    while True:
+        future = results.get()
+        if future is None:
+            return
+        slots.release()
+        yield future.result()
+
+def process_images_in_folder_to_elastic(folder_path, workers=INGEST_WORKERS, chunk_size=INGEST_CHUNK_SIZE, queue_size=INGEST_QUEUE_SIZE, catalog_path=INGEST_CATALOG, ann_batch_size=500, settle_seconds=0):
+    """
+    Brings the index in line with the folder: extracts new and changed files
+    and deletes the documents of removed ones. Returns the number of changes.
+    """
+    version = feature_version()
+    catalog = open_catalog(folder_path, catalog_path, version)
+    current = scan_folder(folder_path)
+    to_extract, removed = catalog.changes(folder_path, current, version, settle_seconds)
+    # Duplicates of removed files get their own chance to be indexed
+    to_extract = sorted(set(to_extract) | {file for file in catalog.duplicates_of(removed) if file in current})
+    if not to_extract and not removed:
+        catalog.close()
+        return 0
+
+    if not es.indices.exists(index=ELASTIC_INDEX):
+        es.indices.create(index=ELASTIC_INDEX, mappings=index_mapping(VECTOR_FORMAT))
+    # Never mix vectors from different preprocessing settings in one index
+    update_index_meta(es, ELASTIC_INDEX, preprocessing=check_preprocessing(es, ELASTIC_INDEX), vector_format=check_vector_format(es, ELASTIC_INDEX, VECTOR_FORMAT))
+
+    ann_backend = open_ann_index()
+    ann_pending = []
+
+    sift_index = open_sift_index()
+    duplicate_index = open_duplicate_index()
+
+    global thumbnail_cache, sift_vocabulary
+    thumbnail_cache = open_thumbnail_cache(folder_path) if THUMBNAIL_PREGENERATE else None
+    sift_vocabulary = sift_index.vocabulary if sift_index is not None else None
+
+    print(f"{len(current)} images, {len(to_extract)} new or changed, {len(removed)} removed, processing with {workers} workers")
+
+    # Hashes, features and visual words waiting on their bulk response
+    in_flight = {}
+    # Filled from the bulk helper's thread, recorded from this one
+    unreadable = []
+    # {filename: (sha256, the indexed file it duplicates)}; sha256 is None for a
+    # file indexed by an earlier run, which is looked up in the catalog at the end
+    duplicates = {}
+    # Only changed in actions(), on the bulk helper's thread; failures are applied after it
+    failed_files = []
+    pending = set(to_extract)
+
+    def actions():
+        for filename in removed:
+            duplicate_index.remove([filename])
+            yield {"_op_type": "delete", "_index": ELASTIC_INDEX, "_id": filename}
+        # With dedup, results come in file order, so a match from this run always sorts first
+        for filename, sha256, feature, error in extract_in_pool([os.path.join(folder_path, f) for f in to_extract], workers, queue_size, ordered=bool(INGEST_DEDUP)):
+            pending.discard(filename)
+            if error is not None:
+                # Left out of the catalog, so the next run retries it
+                print(f"Error: Failed to process {filename}: {error}")
+                continue
+            if feature is None:
+                # Unreadable images are not retried until they change
+                unreadable.append((filename, sha256))
+                continue
+            sift_words = feature.pop('sift', None)
+            hashes = feature.pop('hashes')
+            # Hashes go in before the bulk response, so duplicates within this run are caught too
+            original = None
+            if INGEST_DEDUP:
+                matches = [match for match, _ in duplicate_index.find(*hashes) if match != filename]
+                # Of two near-duplicates the file whose name sorts first is kept
+                original = next((match for match in matches if match < filename), None)
+                if original is None:
+                    for match in matches:
+                        # One still to come in this run finds this file itself
+                        if match not in pending:
+                            duplicate_index.remove([match])
+                            duplicates[match] = (None, filename)
+                            yield {"_op_type": "delete", "_index": ELASTIC_INDEX, "_id": match}
+            if original is not None:
+                duplicates[filename] = (sha256, original)
+                if filename in duplicate_index:
+                    # Changed into a duplicate: its old document goes
+                    duplicate_index.remove([filename])
+                    yield {"_op_type": "delete", "_index": ELASTIC_INDEX, "_id": filename}
+                continue
+            duplicate_index.add(filename, *hashes)
+            in_flight[filename] = (sha256, feature if ann_backend is not None else None, sift_words)
+            yield {"_index": ELASTIC_INDEX, "_id": filename, "_source": stored_document(feature, VECTOR_FORMAT)}
+
+    start = time.perf_counter()
+    indexed = 0
+    deleted = []
+    failed = 0
+    for ok, info in helpers.parallel_bulk(es.options(request_timeout=60), actions(), thread_count=INGEST_BULK_THREADS, chunk_size=chunk_size, raise_on_error=False, raise_on_exception=False):
+        op, item = next(iter(info.items()))
+        filename = item["_id"]
+
+        if op == "delete":
+            # Already missing from the index is as good as deleted
+            if ok or item.get("status") == 404:
+                deleted.append(filename)
+            else:
+                failed += 1
+                print(f"Error: Failed to delete {filename}: {item.get('error')}")
+            continue
+
+        sha256, feature, sift_words = in_flight.pop(filename, (None, None, None))
+        if not ok:
+            failed_files.append(filename)
+            failed += 1
+            print(f"Error: Failed to index {filename}: {item.get('error')}")
+            continue
+
+        catalog.record(filename, *current[filename], sha256, version)
+        indexed += 1
+        if indexed % chunk_size == 0:
+            catalog.commit()
+            bump_generation(es, ELASTIC_INDEX)
+            elapsed = time.perf_counter() - start
+            print(f"{indexed}/{len(to_extract)} indexed, {indexed / elapsed:.1f} images/sec               ", end="\r")
+
+        if sift_words is not None:
+            sift_index.add([(filename, sift_words)])
+
+        if feature is not None:
+            ann_pending.append(feature)
+            if len(ann_pending) >= ann_batch_size:
+                ann_backend.add(ann_pending)
+                ann_pending = []
+
+    # Removed in one go, as each removal rebuilds the in-memory indexes
+    catalog.remove([filename for filename in deleted if filename not in duplicates])
+    if ann_backend is not None:
+        ann_backend.remove(deleted)
+    if sift_index is not None:
+        sift_index.remove(deleted)
+
+    duplicate_index.remove(failed_files)
+    # Duplicates of a file that failed are extracted again on the next run
+    failed_files = set(failed_files)
+    retry = [filename for filename, (_, original) in duplicates.items() if original in failed_files]
+    catalog.remove(retry)
+    for filename in retry:
+        del duplicates[filename]
+
+    for filename, sha256 in unreadable:
+        catalog.record(filename, *current[filename], sha256, version, status='unreadable')
+    known = catalog.entries() if any(sha256 is None for sha256, _ in duplicates.values()) else {}
+    for filename, (sha256, original) in duplicates.items():
+        if sha256 is None and filename in known:
+            sha256 = known[filename][2]
+        catalog.record(filename, *current[filename], sha256, version, status='duplicate', duplicate_of=original)
+    catalog.close()
+    duplicate_index.save(DUPLICATE_INDEX_PATH)
+
+    if indexed or deleted:
+        bump_generation(es, ELASTIC_INDEX)
+
+    elapsed = time.perf_counter() - start
+    print(f"Indexed {indexed} images, deleted {len(deleted)} ({failed} failed, {len(unreadable)} unreadable, {len(duplicates)} duplicates) in {elapsed:.1f}s, {indexed / max(elapsed, 1e-9):.1f} images/sec")
+
+    if ann_backend is not None:
+        ann_backend.add(ann_pending)
+        ann_backend.save(ANN_INDEX_PATH)
+    if sift_index is not None:
+        sift_index.save(SIFT_INDEX_PATH)
+
+    if thumbnail_cache is not None:
+        # Workers wrote the files, so re-scan before enforcing the size limit
+        open_thumbnail_cache(folder_path).evict()
+
+    return indexed + len(deleted) + len(unreadable) + len(duplicates)
+
+def watch_folder(folder_path, interval=INGEST_WATCH_INTERVAL, settle_seconds=INGEST_WATCH_SETTLE):
+    """Re-scans the folder every `interval` seconds and indexes what changed, until interrupted."""
+    print(f"Watching {folder_path} every {interval}s")
+    while True:
+        process_images_in_folder_to_elastic(folder_path, settle_seconds=settle_seconds)
+        time.sleep(interval)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Indexes the images of IMAGE_FOLDER that are new, changed or removed since the last run.")
+    parser.add_argument('--watch', action='store_true', help='keep running and index files as they land')
+    args = parser.parse_args()
+
+    if args.watch:
+        watch_folder(IMAGE_FOLDER)
+    else:
+        process_images_in_folder_to_elastic(IMAGE_FOLDER)
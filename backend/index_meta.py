@@ -0,0 +1,61 @@
+from image_processing import preprocessing_manifest, img_size, bin_count
+from vector_formats import vector_formats
+
+def legacy_preprocessing():
+    """
+    Settings of an index created before the manifest was recorded. Denoising
+    and GLCM levels were fixed then; the image size and bin count already came
+    from .env, so the current values are the ones that index was built with.
+    """
+    return {
+        'denoise': 'nlmeans',
+        'img_size': [img_size['x'], img_size['y']],
+        'bin_count': bin_count,
+        'glcm_levels': 256,
+    }
+
+def read_index_meta(es, index):
+    mapping = es.indices.get_mapping(index=index)
+    # The response is keyed by the concrete index name, which differs for aliases
+    mappings = next(iter(mapping.values()))['mappings']
+    return dict(mappings.get('_meta', {}))
+
+def update_index_meta(es, index, **values):
+    # _meta is replaced as a whole, so merge with what is already there
+    meta = read_index_meta(es, index)
+    meta.update(values)
+    es.indices.put_mapping(index=index, meta=meta)
+    return meta
+
+def bump_generation(es, index):
+    """Marks the index as changed, so search result caches drop their entries."""
+    generation = read_index_meta(es, index).get('generation', 0) + 1
+    update_index_meta(es, index, generation=generation)
+    return generation
+
+def stored_preprocessing(es, index):
+    meta = read_index_meta(es, index)
+    if 'preprocessing' in meta:
+        return meta['preprocessing']
+    if es.count(index=index)['count'] == 0:
+        return None
+    return legacy_preprocessing()
+
+def check_preprocessing(es, index):
+    """Raises if the index was built with other preprocessing than the current settings."""
+    current = preprocessing_manifest()
+    stored = stored_preprocessing(es, index)
+    if stored is not None and stored != current:
+        raise ValueError(f"Index {index} was built with preprocessing {stored}, but the current settings are {current}. Re-index or change .env to match.")
+    return current
+
+def check_vector_format(es, index, current):
+    """Raises if the index stores vectors in another format than `current`."""
+    if current not in vector_formats:
+        raise ValueError(f"Unknown vector format {current}, use one of {vector_formats}")
+    meta = read_index_meta(es, index)
+    # Indexes without the key predate the compact format
+    stored = meta.get('vector_format', 'float' if es.count(index=index)['count'] else None)
+    if stored is not None and stored != current:
+        raise ValueError(f"Index {index} stores {stored} vectors, but VECTOR_FORMAT is {current}. Re-index or change .env to match.")
+    return current
@@ -0,0 +1,280 @@
+import numpy as np
+from elasticsearch import helpers
+from compact_vectors import pack_bits, unpack_bits, popcount, binary_cosine
+
+def normalize_rows(matrix):
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return np.divide(matrix, norms, out=np.zeros_like(matrix), where=norms > 0)
+
+class LocalSearchBackend:
+    """
+    In-process alternative to the Elasticsearch script_score scan.
+
+    Each feature group is held as one contiguous float32 matrix. Every field
+    block inside a group is L2-normalized and scaled by 1/sqrt(fields), so a
+    single matrix-vector product yields the mean cosine similarity of the
+    group, which is what the Painless script computes per document.
+    """
+
+    def __init__(self, feature_map, binary_groups=(), weights=None):
+        self.feature_map = feature_map
+        # Weight of each group in the average, as passed to the script; 1 by default
+        self.weights = {feature: 1.0 for feature in feature_map}
+        self.weights.update(weights or {})
+        # Single-field 0/255 mask groups kept as bitsets and scored with popcounts
+        self.binary_groups = set(binary_groups)
+        self.bits = {}
+        self.bit_counts = {}
+        self.files = []
+        self.positions = {}
+        self.matrices = {}
+        self.valid = {}
+        # Raw L2 norm of every field block, so stored vectors can be rebuilt
+        self.norms = {}
+        for feature, items in feature_map.items():
+            width = sum(item.get('length', 1) for item in items)
+            self.matrices[feature] = np.zeros((0, width), dtype=np.float32)
+            self.valid[feature] = np.zeros(0, dtype=bool)
+            self.norms[feature] = np.zeros((0, 1 if self.is_scalar_group(feature) else len(items)), dtype=np.float32)
+            if feature in self.binary_groups:
+                self.bits[feature] = np.zeros((0, (width + 7) // 8), dtype=np.uint8)
+                self.bit_counts[feature] = np.zeros(0, dtype=np.int32)
+
+    def __len__(self):
+        return len(self.files)
+
+    def is_scalar_group(self, feature):
+        return self.feature_map[feature][0]['type'] == 'number'
+
+    def field_blocks(self, feature, rows):
+        """Raw (len(rows), width) matrices of the group's fields; scalar groups form one block."""
+        items = self.feature_map[feature]
+        if self.is_scalar_group(feature):
+            return [np.array([[row[item['name']] for item in items] for row in rows], dtype=np.float32)]
+        return [np.array([row[item['name']] for row in rows], dtype=np.float32).reshape(len(rows), -1) for item in items]
+
+    def group_vectors(self, feature, rows, with_norms=False):
+        """Builds the scaled, normalized group matrix for documents or query params."""
+        blocks = self.field_blocks(feature, rows)
+        norms = np.stack([np.linalg.norm(block, axis=1) for block in blocks], axis=1)
+        vectors = np.hstack([normalize_rows(block) for block in blocks])
+        if len(blocks) > 1:
+            vectors /= np.float32(np.sqrt(len(blocks)))
+        vectors = np.ascontiguousarray(vectors)
+        return (vectors, norms) if with_norms else vectors
+
+    def has_vectors(self):
+        return all(norms is not None for norms in self.norms.values())
+
+    def get_vectors(self, files, fields):
+        """Rebuilds the stored raw field values of the known files, as a list of dicts."""
+        rows = [self.positions[file] for file in files if file in self.positions]
+        docs = [{} for _ in rows]
+        for feature, items in self.feature_map.items():
+            wanted = [item for item in items if item['name'] in fields]
+            if not wanted or not rows:
+                continue
+            if feature in self.binary_groups:
+                for doc, value in zip(docs, unpack_bits(self.bits[feature][rows], items[0]['length'])):
+                    doc[items[0]['name']] = value
+                continue
+            matrix = self.matrices[feature][rows]
+            norms = self.norms[feature][rows]
+            if self.is_scalar_group(feature):
+                values = matrix * norms
+                for index, item in enumerate(items):
+                    if item in wanted:
+                        for doc, value in zip(docs, values[:, index]):
+                            doc[item['name']] = float(value)
+                continue
+
+            scale = np.float32(np.sqrt(len(items)))
+            start = 0
+            for index, item in enumerate(items):
+                end = start + item['length']
+                if item in wanted:
+                    values = matrix[:, start:end] * (norms[:, index:index + 1] * scale)
+                    for doc, value in zip(docs, values):
+                        doc[item['name']] = value
+                start = end
+        return docs
+
+    def add(self, docs):
+        """Adds or replaces documents, keyed by their 'file' field."""
+        if not docs:
+            return
+
+        # Later duplicates of a file win, as they would in the index
+        latest = {}
+        for doc in docs:
+            latest[doc['file']] = doc
+        docs = list(latest.values())
+
+        updates = [(self.positions[doc['file']], doc) for doc in docs if doc['file'] in self.positions]
+        inserts = [doc for doc in docs if doc['file'] not in self.positions]
+
+        for feature in self.feature_map:
+            if feature in self.binary_groups:
+                self.add_bits(feature, updates, inserts)
+                continue
+            if updates:
+                rows = [position for position, _ in updates]
+                vectors, norms = self.group_vectors(feature, [doc for _, doc in updates], with_norms=True)
+                self.matrices[feature][rows] = vectors
+                self.valid[feature][rows] = np.any(vectors != 0, axis=1)
+                if self.norms[feature] is not None:
+                    self.norms[feature][rows] = norms
+            if inserts:
+                vectors, norms = self.group_vectors(feature, inserts, with_norms=True)
+                self.matrices[feature] = np.ascontiguousarray(np.vstack([self.matrices[feature], vectors]))
+                self.valid[feature] = np.concatenate([self.valid[feature], np.any(vectors != 0, axis=1)])
+                if self.norms[feature] is not None:
+                    self.norms[feature] = np.vstack([self.norms[feature], norms])
+
+        for doc in inserts:
+            self.positions[doc['file']] = len(self.files)
+            self.files.append(doc['file'])
+
+    def add_bits(self, feature, updates, inserts):
+        if updates:
+            rows = [position for position, _ in updates]
+            bits = pack_bits(self.field_blocks(feature, [doc for _, doc in updates])[0])
+            self.bits[feature][rows] = bits
+            self.bit_counts[feature][rows] = popcount(bits)
+        if inserts:
+            bits = pack_bits(self.field_blocks(feature, inserts)[0])
+            self.bits[feature] = np.vstack([self.bits[feature], bits])
+            self.bit_counts[feature] = np.concatenate([self.bit_counts[feature], popcount(bits).astype(np.int32)])
+
+    def keep_rows(self, keep):
+        """Drops the rows where the boolean mask `keep` is False."""
+        for feature in self.feature_map:
+            if feature in self.binary_groups:
+                self.bits[feature] = self.bits[feature][keep]
+                self.bit_counts[feature] = self.bit_counts[feature][keep]
+                continue
+            self.matrices[feature] = np.ascontiguousarray(self.matrices[feature][keep])
+            self.valid[feature] = self.valid[feature][keep]
+            if self.norms[feature] is not None:
+                self.norms[feature] = self.norms[feature][keep]
+        self.files = [file for file, kept in zip(self.files, keep) if kept]
+        self.positions = {file: position for position, file in enumerate(self.files)}
+
+    def remove(self, files):
+        """Removes documents by file; unknown files are ignored."""
+        rows = [self.positions[file] for file in files if file in self.positions]
+        if not rows:
+            return None
+        keep = np.ones(len(self.files), dtype=bool)
+        keep[rows] = False
+        self.keep_rows(keep)
+        return keep
+
+    def load_batches(self, batches):
+        """Adds documents from an iterable of lists, e.g. snapshot.iter_snapshot_docs()."""
+        for docs in batches:
+            self.add(docs)
+        print(f"Loaded {len(self.files)} documents into the local search backend")
+
+    def load_from_elastic(self, es, index, batch_size=5000, fields=None, transform=None):
+        """Loads every document; `fields` / `transform` adapt to other stored formats."""
+        fields = fields or ['file'] + [item['name'] for items in self.feature_map.values() for item in items]
+        batch = []
+        for hit in helpers.scan(es, index=index, query={"query": {"match_all": {}}}, _source=fields, size=batch_size):
+            batch.append(transform(hit['_source']) if transform else hit['_source'])
+            if len(batch) >= batch_size:
+                self.add(batch)
+                batch = []
+        self.add(batch)
+        print(f"Loaded {len(self.files)} documents into the local search backend")
+
+    def query_vectors(self, query_features):
+        """Returns {feature: normalized group vector} for the matrix groups present in the query."""
+        vectors = {}
+        for feature, items in self.feature_map.items():
+            if items[0]['name'] in query_features and feature not in self.binary_groups:
+                vectors[feature] = self.group_vectors(feature, [query_features])[0]
+        return vectors
+
+    def score(self, query_features, rows=None):
+        """Scores every document (or only `rows`) against the query params."""
+        count = len(self.files) if rows is None else len(rows)
+        total = np.zeros(count, dtype=np.float32)
+        weight = np.zeros(count, dtype=np.float32)
+
+        for feature, vector in self.query_vectors(query_features).items():
+            matrix = self.matrices[feature] if rows is None else self.matrices[feature][rows]
+            group_weight = np.float32(self.weights[feature])
+            total += group_weight * (matrix @ vector)
+            if self.is_scalar_group(feature):
+                # Mirrors the script: a zero norm on either side adds no weight
+                if np.any(vector):
+                    weight += group_weight * (self.valid[feature] if rows is None else self.valid[feature][rows])
+            else:
+                weight += group_weight
+
+        for feature in self.binary_groups:
+            field = self.feature_map[feature][0]['name']
+            if field in query_features:
+                bits = self.bits[feature] if rows is None else self.bits[feature][rows]
+                counts = self.bit_counts[feature] if rows is None else self.bit_counts[feature][rows]
+                total += self.weights[feature] * binary_cosine(pack_bits(query_features[field]), bits, counts)
+                weight += self.weights[feature]
+
+        return np.divide(total, weight, out=np.zeros_like(total), where=weight > 0)
+
+    def score_many(self, queries):
+        """Scores every document against several queries at once; returns a (documents, queries) matrix."""
+        total = np.zeros((len(self.files), len(queries)), dtype=np.float32)
+        weight = np.zeros_like(total)
+
+        for feature, items in self.feature_map.items():
+            columns = [i for i, query_features in enumerate(queries) if items[0]['name'] in query_features]
+            if not columns:
+                continue
+            group_weight = np.float32(self.weights[feature])
+            if feature in self.binary_groups:
+                for i in columns:
+                    total[:, i] += group_weight * binary_cosine(pack_bits(queries[i][items[0]['name']]), self.bits[feature], self.bit_counts[feature])
+                    weight[:, i] += group_weight
+                continue
+
+            # One matrix-matrix product per group instead of a product per query
+            vectors = self.group_vectors(feature, [queries[i] for i in columns])
+            total[:, columns] += group_weight * (self.matrices[feature] @ vectors.T)
+            if self.is_scalar_group(feature):
+                weight[:, columns] += group_weight * (self.valid[feature][:, None] & np.any(vectors, axis=1)[None, :])
+            else:
+                weight[:, columns] += group_weight
+
+        return np.divide(total, weight, out=np.zeros_like(total), where=weight > 0)
+
+    def search_many(self, queries, top_n=10, batch_size=32):
+        """Answers a list of queries; `batch_size` bounds the score matrix held at once."""
+        results = []
+        for start in range(0, len(queries), batch_size):
+            scores = self.score_many(queries[start:start + batch_size])
+            results += [self.top(np.ascontiguousarray(scores[:, i]), top_n) for i in range(scores.shape[1])]
+        return results
+
+    def top(self, scores, top_n, rows=None):
+        top_n = min(top_n, len(scores))
+        if top_n <= 0:
+            return []
+
+        best = np.argpartition(-scores, top_n - 1)[:top_n]
+        best = best[np.argsort(-scores[best], kind='stable')]
+        if rows is not None:
+            return [{'file': self.files[rows[i]], '_score': float(scores[i])} for i in best]
+        return [{'file': self.files[i], '_score': float(scores[i])} for i in best]
+
+    def search(self, query_features, top_n=10):
+        return self.top(self.score(query_features), top_n)
+
+    def two_stage_search(self, cheap_query, query_features, top_n=10, shortlist=1000):
+        """Shortlists `shortlist` documents with `cheap_query`, then ranks only those with the full query."""
+        scores = self.score(cheap_query)
+        if shortlist >= len(scores):
+            return self.search(query_features, top_n)
+        rows = np.sort(np.argpartition(-scores, shortlist - 1)[:shortlist])
+        return self.top(self.score(query_features, rows), top_n, rows)
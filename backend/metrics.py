@@ -0,0 +1,129 @@
+import threading
+import time
+from contextlib import contextmanager
+
+# Prometheus' default buckets, in seconds
+default_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    pairs = []
+    for name, value in labels:
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append(f'{name}="{value}"')
+    return '{' + ','.join(pairs) + '}'
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+class Metric:
+    """
+    Base of the metric types rendered in the Prometheus text format. Values
+    are kept per label set; with `function` set, the values are read from it
+    at render time instead, as one number or {label tuple: number}.
+    """
+
+    type = 'untyped'
+
+    def __init__(self, name, help, function=None):
+        self.name = name
+        self.help = help
+        self.function = function
+        self.lock = threading.Lock()
+        self.values = {}
+        registry.append(self)
+
+    def samples(self):
+        if self.function is None:
+            with self.lock:
+                return [(self.name, key, value) for key, value in self.values.items()]
+        values = self.function()
+        if not isinstance(values, dict):
+            values = {(): values}
+        return [(self.name, key, value) for key, value in values.items()]
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.type}']
+        for name, key, value in self.samples():
+            lines.append(f'{name}{format_labels(key)} {format_value(value)}')
+        return lines
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    @contextmanager
+    def track(self, **labels):
+        self.inc(**labels)
+        try:
+            yield
+        finally:
+            self.dec(**labels)
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, help, buckets=default_buckets):
+        super().__init__(name, help)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            counts, total = self.values.get(key, ([0] * len(self.buckets), 0.0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self.values[key] = (counts, total + value)
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self):
+        samples = []
+        with self.lock:
+            items = [(key, list(counts), total) for key, (counts, total) in self.values.items()]
+        for key, counts, total in items:
+            for bound, count in zip(self.buckets, counts):
+                samples.append((self.name + '_bucket', key + (('le', format_value(bound)),), count))
+            samples.append((self.name + '_count', key, counts[-1]))
+            samples.append((self.name + '_sum', key, total))
+        return samples
+
+registry = []
+
+def render():
+    lines = []
+    for metric in registry:
+        lines += metric.render()
+    return '\n'.join(lines) + '\n'
+
+requests_total = Counter('cbil_http_requests_total', 'HTTP requests by path and status code.')
+requests_in_flight = Gauge('cbil_http_requests_in_flight', 'HTTP requests being handled, by path.')
+request_seconds = Histogram('cbil_http_request_duration_seconds', 'Time to handle an HTTP request, by path.')
+stage_seconds = Histogram('cbil_stage_duration_seconds', 'Time spent per request stage: multipart_parse, duplicate_lookup, decode, resize, denoise, extract, search, search_batch, feature_fetch, json_serialize.')
+extractor_seconds = Histogram('cbil_extractor_duration_seconds', 'Time per feature extractor, by feature group.')
+extractions_in_flight = Gauge('cbil_extractions_in_flight', 'Upload and batch requests holding an extraction slot.')
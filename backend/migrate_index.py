@@ -0,0 +1,79 @@
+"""
+Rewrites every document of ELASTIC_INDEX into a new index in another
+vector format, without touching the images. A missing target index is
+created with the mapping of its format.
+
+    python migrate_index.py cbil_db_v2
+    python migrate_index.py cbil_db_v2 --alias cbil
+
+Then set ELASTIC_INDEX (to the new index or the alias) and VECTOR_FORMAT.
+"""
+import argparse
+import os
+import time
+from elasticsearch import Elasticsearch, helpers
+from features import feature_map, feature_fields
+from vector_formats import vector_formats, stored_document, stored_fields, read_document, index_mapping
+from index_meta import read_index_meta, stored_preprocessing, update_index_meta
+
+def migrate_index(es, source_index, target_index, vector_format='normalized', chunk_size=500, threads=2):
+    source_meta = read_index_meta(es, source_index)
+    source_format = source_meta.get('vector_format', 'float')
+
+    if not es.indices.exists(index=target_index):
+        es.indices.create(index=target_index, mappings=index_mapping(vector_format))
+    update_index_meta(es, target_index, preprocessing=stored_preprocessing(es, source_index), vector_format=vector_format)
+
+    fields = ['file'] + stored_fields(feature_fields(feature_map.keys()), source_format)
+
+    def actions():
+        for hit in helpers.scan(es, index=source_index, query={"query": {"match_all": {}}}, _source=fields, size=chunk_size):
+            feature = read_document(hit['_source'], source_format)
+            source = stored_document(feature, vector_format)
+            source = {field: value.tolist() if hasattr(value, 'tolist') else value for field, value in source.items()}
+            yield {"_index": target_index, "_id": hit['_id'], "_source": source}
+
+    start = time.perf_counter()
+    migrated = 0
+    failed = 0
+    for ok, info in helpers.parallel_bulk(es.options(request_timeout=60), actions(), thread_count=threads, chunk_size=chunk_size, raise_on_error=False, raise_on_exception=False):
+        if ok:
+            migrated += 1
+            if migrated % 10000 == 0:
+                print(f"{migrated} migrated", end="\r")
+        else:
+            failed += 1
+            print(f"Error: Failed to migrate {info['index']['_id']}: {info['index'].get('error')}")
+
+    update_index_meta(es, target_index, generation=source_meta.get('generation', 0) + 1)
+    print(f"Migrated {migrated} documents ({failed} failed) from {source_index} ({source_format}) to {target_index} ({vector_format}) in {time.perf_counter() - start:.1f}s")
+    return migrated
+
+def move_alias(es, alias, target_index):
+    """Points `alias` at the target index only, in one atomic update."""
+    actions = []
+    if es.indices.exists_alias(name=alias):
+        actions = [{"remove": {"index": index, "alias": alias}} for index in es.indices.get_alias(name=alias)]
+    actions.append({"add": {"index": target_index, "alias": alias}})
+    es.indices.update_aliases(actions=actions)
+    print(f"Alias {alias} now points to {target_index}")
+
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+    load_dotenv()
+    ELASTIC_URL = os.getenv('ELASTIC_URL')
+    ELASTIC_USERNAME = os.getenv('ELASTIC_USERNAME')
+    ELASTIC_PASSWORD = os.getenv('ELASTIC_PASSWORD')
+    ELASTIC_INDEX = os.getenv('ELASTIC_INDEX')
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('target_index')
+    parser.add_argument('--format', choices=vector_formats, default='normalized')
+    parser.add_argument('--alias', help='point this alias at the new index when done')
+    parser.add_argument('--chunk-size', type=int, default=500)
+    args = parser.parse_args()
+
+    es = Elasticsearch(ELASTIC_URL, basic_auth=(ELASTIC_USERNAME, ELASTIC_PASSWORD))
+    migrate_index(es, ELASTIC_INDEX, args.target_index, args.format, args.chunk_size)
+    if args.alias:
+        move_alias(es, args.alias, args.target_index)
@@ -0,0 +1,108 @@
+from email.message import Message
+from email.utils import collapse_rfc2231_value
+
+class MultipartError(ValueError):
+    """A request body that cannot be read; `status` is the HTTP status to answer with."""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+def parse_header(value):
+    """('main/value', {param: value}) of a header such as Content-Type, as cgi.parse_header gave."""
+    message = Message()
+    message['x'] = value
+    params = message.get_params(header='x') or [('', '')]
+    return params[0][0].lower(), {key.lower(): collapse_rfc2231_value(param) for key, param in params[1:]}
+
+def parse_multipart(stream, boundary, content_length, max_bytes, max_parts=1000, max_header_bytes=16 * 1024, chunk_size=64 * 1024):
+    """
+    Reads a multipart/form-data body of `content_length` bytes from `stream`
+    in chunks and returns {name: [values]}: bytes for file parts and str for
+    other fields, as cgi.parse_multipart did.
+
+    Only the part contents are kept, never a second copy of the raw body, and
+    a body longer than `max_bytes` is refused before any of it is read.
+    """
+    if content_length > max_bytes:
+        raise MultipartError(f"Request body larger than {max_bytes} bytes", 413)
+    try:
+        delimiter = b'\r\n--' + boundary.encode('ascii')
+    except UnicodeEncodeError:
+        raise MultipartError("Boundary must be ASCII")
+
+    # The first boundary has no line break in front of it
+    buffer = bytearray(b'\r\n')
+    remaining = content_length
+
+    def read_more():
+        nonlocal remaining
+        if remaining <= 0:
+            return False
+        chunk = stream.read(min(chunk_size, remaining))
+        if not chunk:
+            raise MultipartError("Request body ended before Content-Length")
+        remaining -= len(chunk)
+        buffer.extend(chunk)
+        return True
+
+    def read_exactly(count):
+        while len(buffer) < count:
+            if not read_more():
+                raise MultipartError("Truncated multipart body")
+        data = bytes(buffer[:count])
+        del buffer[:count]
+        return data
+
+    def read_until(marker, sink=None, limit=None):
+        """Consumes the buffer through `marker`; the bytes before it go to `sink`."""
+        while True:
+            index = buffer.find(marker)
+            if index >= 0:
+                if sink is not None:
+                    sink.extend(buffer[:index])
+                del buffer[:index + len(marker)]
+                return
+            # Everything but a tail that may be the start of the marker
+            done = max(len(buffer) - len(marker) + 1, 0)
+            if sink is not None:
+                sink.extend(buffer[:done])
+                if limit is not None and len(sink) > limit:
+                    raise MultipartError("Multipart part headers too long")
+            del buffer[:done]
+            if not read_more():
+                raise MultipartError("Multipart boundary not found")
+
+    form = {}
+    parts = 0
+    read_until(delimiter)
+    while True:
+        ending = read_exactly(2)
+        if ending == b'--':
+            break
+        if ending != b'\r\n':
+            raise MultipartError("Malformed multipart boundary")
+        parts += 1
+        if parts > max_parts:
+            raise MultipartError(f"More than {max_parts} multipart parts", 413)
+
+        # Put the line break back, so a part without headers ends at once
+        buffer[:0] = b'\r\n'
+        header_bytes = bytearray()
+        read_until(b'\r\n\r\n', header_bytes, max_header_bytes)
+        headers = {}
+        for line in header_bytes.decode('latin-1').split('\r\n'):
+            name, _, value = line.partition(':')
+            if name:
+                headers[name.strip().lower()] = value.strip()
+        _, params = parse_header(headers.get('content-disposition', ''))
+
+        value = bytearray()
+        read_until(delimiter, value)
+        if 'name' in params:
+            form.setdefault(params['name'], []).append(bytes(value) if 'filename' in params else value.decode('utf-8', 'replace'))
+
+    # Drain the epilogue, so the connection stays usable
+    while read_more():
+        buffer.clear()
+    return form
@@ -0,0 +1,160 @@
+"""
+Near-duplicate detection with perceptual hashes. Every indexed image has a
+64-bit pHash and dHash; two images are near-duplicates when both hashes are
+within `max_distance` bits of each other.
+
+Lookups use multi-index hashing: each hash is split into max_distance + 1
+chunks, and by the pigeonhole principle a hash within max_distance bits
+shares at least one chunk exactly, so a query is a handful of dict lookups
+plus a popcount per candidate.
+
+    python near_duplicates.py build     # hashes every indexed image of the catalog into DUPLICATE_INDEX_PATH
+    python near_duplicates.py report    # prints the groups of near-duplicates in the index
+"""
+import argparse
+import os
+import time
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from image_processing import perceptual_hashes, read_image
+
+def hamming(a, b):
+    return (a ^ b).bit_count()
+
+class HashIndex:
+    def __init__(self, max_distance=4):
+        self.max_distance = max_distance
+        chunks = max_distance + 1
+        widths = [64 // chunks + (i < 64 % chunks) for i in range(chunks)]
+        self.chunks = [(sum(widths[:i]), (1 << width) - 1) for i, width in enumerate(widths)]
+        self.tables = [{} for _ in self.chunks]
+        self.hashes = {}
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def __contains__(self, file):
+        return file in self.hashes
+
+    def keys(self, phash):
+        return [(phash >> shift) & mask for shift, mask in self.chunks]
+
+    def add(self, file, phash, dhash):
+        self.remove([file])
+        self.hashes[file] = (phash, dhash)
+        for table, key in zip(self.tables, self.keys(phash)):
+            table.setdefault(key, set()).add(file)
+
+    def remove(self, files):
+        for file in files:
+            hashes = self.hashes.pop(file, None)
+            if hashes is None:
+                continue
+            for table, key in zip(self.tables, self.keys(hashes[0])):
+                bucket = table[key]
+                bucket.discard(file)
+                if not bucket:
+                    del table[key]
+
+    def find(self, phash, dhash, max_distance=None):
+        """[(file, pHash distance)] of the near-duplicates of the given hashes, closest first."""
+        max_distance = self.max_distance if max_distance is None else max_distance
+        if max_distance > self.max_distance:
+            raise ValueError(f"Index was built for distances up to {self.max_distance}, got {max_distance}")
+        candidates = set()
+        for table, key in zip(self.tables, self.keys(phash)):
+            candidates.update(table.get(key, ()))
+        matches = []
+        for file in candidates:
+            stored_phash, stored_dhash = self.hashes[file]
+            distance = hamming(phash, stored_phash)
+            if distance <= max_distance and hamming(dhash, stored_dhash) <= max_distance:
+                matches.append((file, distance))
+        matches.sort(key=lambda match: (match[1], match[0]))
+        return matches
+
+    def are_duplicates(self, a, b, max_distance=None):
+        max_distance = self.max_distance if max_distance is None else max_distance
+        if a not in self.hashes or b not in self.hashes:
+            return False
+        return all(hamming(x, y) <= max_distance for x, y in zip(self.hashes[a], self.hashes[b]))
+
+    def save(self, path):
+        files = list(self.hashes)
+        hashes = np.array([self.hashes[file] for file in files], dtype=np.uint64).reshape(-1, 2)
+        temp_path = path + '.tmp.npz'
+        np.savez(temp_path, files=np.array(files), phash=hashes[:, 0], dhash=hashes[:, 1])
+        os.replace(temp_path, path)
+
+    @classmethod
+    def load(cls, path, max_distance=4):
+        # The chunk tables depend on max_distance, so they are rebuilt rather than saved
+        index = cls(max_distance)
+        with np.load(path) as data:
+            for file, phash, dhash in zip(data['files'].tolist(), data['phash'].tolist(), data['dhash'].tolist()):
+                index.add(file, phash, dhash)
+        print(f"Loaded {len(index)} image hashes from {path}")
+        return index
+
+def file_hashes(image_path):
+    image = read_image(image_path)
+    return None if image is None else perceptual_hashes(image)
+
+def build_index(folder_path, files, max_distance=4, workers=None):
+    index = HashIndex(max_distance)
+    start = time.perf_counter()
+    paths = [os.path.join(folder_path, file) for file in files]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for file, hashes in zip(files, executor.map(file_hashes, paths, chunksize=64)):
+            if hashes is None:
+                print(f"Error: Unable to read {file}")
+                continue
+            index.add(file, *hashes)
+    print(f"Hashed {len(index)} images in {time.perf_counter() - start:.1f}s")
+    return index
+
+def duplicate_groups(index):
+    """Groups of files connected by near-duplicate pairs, largest first."""
+    parent = {file: file for file in index.hashes}
+
+    def root(file):
+        while parent[file] != file:
+            parent[file] = parent[parent[file]]
+            file = parent[file]
+        return file
+
+    for file, (phash, dhash) in index.hashes.items():
+        for match, _ in index.find(phash, dhash):
+            parent[root(match)] = root(file)
+    groups = {}
+    for file in index.hashes:
+        groups.setdefault(root(file), []).append(file)
+    return sorted((sorted(group) for group in groups.values() if len(group) > 1), key=len, reverse=True)
+
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+    load_dotenv()
+    IMAGE_FOLDER = os.getenv('IMAGE_FOLDER', 'images')
+    INGEST_CATALOG = os.getenv('INGEST_CATALOG', 'ingest_catalog.sqlite3')
+    INGEST_WORKERS = int(os.getenv('INGEST_WORKERS', os.cpu_count()))
+    DUPLICATE_INDEX_PATH = os.getenv('DUPLICATE_INDEX_PATH', 'duplicate_index.npz')
+    DUPLICATE_DISTANCE = int(os.getenv('DUPLICATE_DISTANCE', 4))
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('command', choices=['build', 'report'])
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        from catalog import FileCatalog, scan_folder
+        if os.path.isfile(INGEST_CATALOG):
+            catalog = FileCatalog(INGEST_CATALOG)
+            files = sorted(file for file, entry in catalog.entries().items() if entry[4] == 'indexed')
+            catalog.close()
+        else:
+            files = sorted(scan_folder(IMAGE_FOLDER))
+        build_index(IMAGE_FOLDER, files, DUPLICATE_DISTANCE, INGEST_WORKERS).save(DUPLICATE_INDEX_PATH)
+    else:
+        groups = duplicate_groups(HashIndex.load(DUPLICATE_INDEX_PATH, DUPLICATE_DISTANCE))
+        for group in groups:
+            print(' '.join(group))
+        print(f"{len(groups)} groups, {sum(len(group) - 1 for group in groups)} removable duplicates")
@@ -0,0 +1,92 @@
+import numpy as np
+from features import feature_map
+
+# The normalized format stores one vector per feature group, named after the
+# group. Every field block is L2-normalized and scaled by 1/sqrt(fields), as
+# in the local backend, so a single dot product gives the group's mean cosine
+# similarity and Elasticsearch never recomputes a norm. The raw norm of every
+# block is kept next to it in <group>_norms, so the raw fields can be rebuilt.
+
+def group_width(feature):
+    return sum(item.get('length', 1) for item in feature_map[feature])
+
+def norms_field(feature):
+    return f"{feature}_norms"
+
+def group_vector(feature, values, with_norms=False):
+    """Normalized group vector from a dict holding the group's fields, and optionally the raw block norms."""
+    items = feature_map[feature]
+    if items[0]['type'] == 'number':
+        blocks = [np.array([values[item['name']] for item in items], dtype=np.float32)]
+    else:
+        blocks = [np.asarray(values[item['name']], dtype=np.float32).ravel() for item in items]
+
+    parts = []
+    norms = np.array([np.linalg.norm(block) for block in blocks], dtype=np.float32)
+    for block, norm in zip(blocks, norms):
+        parts.append(block / norm if norm > 0 else np.zeros_like(block))
+    vector = np.concatenate(parts)
+    if len(blocks) > 1:
+        vector /= np.float32(np.sqrt(len(blocks)))
+    return (vector, norms) if with_norms else vector
+
+def normalize_document(feature):
+    """Converts an extracted feature dict to the normalized index format."""
+    document = {'file': feature['file']} if 'file' in feature else {}
+    for group, items in feature_map.items():
+        if items[0]['name'] in feature:
+            document[group], document[norms_field(group)] = group_vector(group, feature, with_norms=True)
+    return document
+
+def expand_normalized(source):
+    """
+    Splits the stored group vectors back into the raw fields, using the stored
+    block norms. Documents indexed before the norms were kept come back as
+    unit-length fields; they score the same, as cosine similarity ignores
+    length, but feedback centroids then average normalized vectors.
+    """
+    for group, items in feature_map.items():
+        if group not in source:
+            continue
+        vector = np.asarray(source.pop(group), dtype=np.float32)
+        blocks = 1 if items[0]['type'] == 'number' else len(items)
+        norms = source.pop(norms_field(group), None)
+        norms = np.ones(blocks, dtype=np.float32) if norms is None else np.asarray(norms, dtype=np.float32)
+        if items[0]['type'] == 'number':
+            for item, value in zip(items, vector * norms[0]):
+                source[item['name']] = float(value)
+            continue
+        scale = np.float32(np.sqrt(len(items)))
+        start = 0
+        for item, norm in zip(items, norms):
+            source[item['name']] = vector[start:start + item['length']] * (scale * norm)
+            start += item['length']
+    return source
+
+def normalized_fields(fields):
+    """Stored group fields, and their norms, to fetch for the given feature fields."""
+    groups = [group for group, items in feature_map.items() if any(item['name'] in fields for item in items)]
+    return groups + [norms_field(group) for group in groups]
+
+def normalized_query(query_features):
+    """{group: normalized vector} of the groups in the query."""
+    vectors = {}
+    for group, items in feature_map.items():
+        if items[0]['name'] in query_features:
+            vector = group_vector(group, query_features)
+            # Zero means add no weight in the script, so they are left out
+            if items[0]['type'] == 'number' and not np.any(vector):
+                continue
+            vectors[group] = vector
+    return vectors
+
+def normalized_mapping():
+    """Index mapping of the normalized format."""
+    properties = {'file': {'type': 'keyword'}}
+    for group in feature_map:
+        # max_inner_product, not dot_product: a group with an all-zero field
+        # block (e.g. GLCM contrast of a flat image) is shorter than unit length
+        properties[group] = {'type': 'dense_vector', 'dims': group_width(group), 'index': True, 'similarity': 'max_inner_product'}
+        # Only read back from _source, never searched
+        properties[norms_field(group)] = {'type': 'float', 'index': False, 'doc_values': False}
+    return {'properties': properties}
@@ -0,0 +1,132 @@
+"""
+Recall of two-stage search, and of the ann backend, against the exhaustive scan.
+
+Loads the configured index into the local backend (with the .env settings
+of the search server), queries it with a sample of the stored documents,
+and prints JSON with the share of the exhaustive top-n that each shortlist
+size recovers, plus the latency of both. The query document itself is left
+out of both result lists.
+
+With --nprobe or --candidates, the ann backend is loaded instead and every
+combination of the listed ANN_NPROBE and ANN_CANDIDATES values is measured
+as well; an unset list keeps the configured value.
+
+With --compact, every document and query is also converted to the compact
+format and back, and scored as the compact score script scores it (int8
+hog/gist/dct, bitset corners). The report then gives the mean and lowest
+share of the float top-n that the compact top-n keeps. It needs an index in
+the float or normalized format.
+
+    python recall_report.py --shortlists 250,500,1000,2000 --queries 200
+    python recall_report.py --nprobe 4,8,16,32 --candidates 100,200,500
+    python recall_report.py --shortlists '' --compact
+"""
+import argparse
+import json
+import os
+import sys
+import time
+import numpy as np
+
+from features import feature_map, feature_fields, cheap_feature_keys
+from local_search import LocalSearchBackend
+from compact_vectors import binary_fields, compact_document, expand_document
+
+def without(results, file, top_n):
+    return [item['file'] for item in results if item['file'] != file][:top_n]
+
+def compact_round_trip(feature):
+    """The float fields a compact index gives back for `feature`."""
+    return expand_document(compact_document(dict(feature)), feature_map)
+
+def compact_copy(backend, fields, batch_size=5000):
+    """The documents of `backend` as stored in the compact format, in a backend that scores bitsets like the script."""
+    compact = LocalSearchBackend(backend.feature_map, binary_fields, backend.weights)
+    for start in range(0, len(backend.files), batch_size):
+        files = backend.files[start:start + batch_size]
+        compact.add([compact_round_trip(dict(doc, file=file)) for file, doc in zip(files, backend.get_vectors(files, fields))])
+    return compact
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--shortlists', default='250,500,1000,2000')
+    parser.add_argument('--features', default=','.join(feature_map.keys()))
+    parser.add_argument('--queries', type=int, default=100)
+    parser.add_argument('--top-n', type=int, default=10)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--nprobe', default='', help='ANN_NPROBE values to sweep, e.g. 4,8,16')
+    parser.add_argument('--candidates', default='', help='ANN_CANDIDATES values to sweep, e.g. 100,200,500')
+    parser.add_argument('--compact', action='store_true', help='compare compact-format with float top-n')
+    args = parser.parse_args()
+
+    nprobes = [int(value) for value in args.nprobe.split(',') if value]
+    candidate_counts = [int(value) for value in args.candidates.split(',') if value]
+    # Must be set before search reads its settings; load_dotenv keeps existing values
+    os.environ['SEARCH_BACKEND'] = 'ann' if nprobes or candidate_counts else 'local'
+    import search
+    if args.compact and search.VECTOR_FORMAT == 'compact':
+        sys.exit("--compact compares against float scores, but the index already stores compact vectors; run it on a float or normalized index")
+
+    backend = search.local_backend
+    if not backend.has_vectors():
+        # Only an ann index file saved before the block norms were kept lacks them
+        sys.exit(f"{search.ANN_INDEX_PATH} was saved without the raw block norms, so stored documents cannot be rebuilt as queries. Delete it, let the search server rebuild it, and run this again.")
+    feature_keys = [feature for feature in args.features.split(',') if feature]
+    fields = feature_fields(feature_keys)
+    cheap_fields = set(feature_fields(cheap_feature_keys))
+
+    rng = np.random.default_rng(args.seed)
+    files = [backend.files[i] for i in rng.choice(len(backend.files), min(args.queries, len(backend.files)), replace=False)]
+    queries = list(zip(files, backend.get_vectors(files, fields)))
+
+    exact = {}
+    start = time.perf_counter()
+    for file, query in queries:
+        exact[file] = without(LocalSearchBackend.search(backend, query, args.top_n + 1), file, args.top_n)
+    exact_ms = (time.perf_counter() - start) / max(len(queries), 1) * 1000
+
+    report = {
+        'documents': len(backend.files),
+        'features': feature_keys,
+        'queries': len(queries),
+        'top_n': args.top_n,
+        'exact_ms': exact_ms,
+        'shortlists': {},
+    }
+    for shortlist in [int(size) for size in args.shortlists.split(',') if size]:
+        hits = 0
+        start = time.perf_counter()
+        for file, query in queries:
+            cheap_query = {field: value for field, value in query.items() if field in cheap_fields}
+            results = backend.two_stage_search(cheap_query, query, args.top_n + 1, shortlist)
+            hits += len(set(exact[file]) & set(without(results, file, args.top_n)))
+        report['shortlists'][str(shortlist)] = {
+            'recall': hits / max(sum(len(files) for files in exact.values()), 1),
+            'two_stage_ms': (time.perf_counter() - start) / max(len(queries), 1) * 1000,
+        }
+
+    if nprobes or candidate_counts:
+        report['ann'] = {}
+        for nprobe in nprobes or [search.ANN_NPROBE]:
+            for candidates in candidate_counts or [search.ANN_CANDIDATES]:
+                backend.set_params(nprobe=nprobe, candidates=candidates)
+                result = backend.recall([query for _, query in queries], args.top_n, [file for file, _ in queries])
+                report['ann'][f"nprobe={nprobe},candidates={candidates}"] = {'recall': result['recall'], 'ann_ms': result['ann_ms']}
+
+    if args.compact:
+        compact = compact_copy(backend, fields)
+        overlaps = []
+        start = time.perf_counter()
+        for file, query in queries:
+            results = without(compact.search(compact_round_trip(query), args.top_n + 1), file, args.top_n)
+            overlaps.append(len(set(exact[file]) & set(results)) / max(len(exact[file]), 1))
+        report['compact'] = {
+            'overlap': float(np.mean(overlaps)) if overlaps else 0.0,
+            'min_overlap': float(np.min(overlaps)) if overlaps else 0.0,
+            'compact_ms': (time.perf_counter() - start) / max(len(queries), 1) * 1000,
+        }
+
+    print(json.dumps(report, indent=2))
+
+if __name__ == '__main__':
+    main()
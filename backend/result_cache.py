@@ -0,0 +1,57 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+import numpy as np
+
+def query_fingerprint(query_features):
+    """Stable hash of a query's fields and values."""
+    digest = hashlib.sha1()
+    for name in sorted(query_features):
+        value = query_features[name]
+        digest.update(name.encode())
+        digest.update(np.asarray(value, dtype=np.float64).tobytes())
+    return digest.hexdigest()
+
+class ResultCache:
+    """
+    LRU cache of search results with a TTL. Entries belong to an index
+    generation; when the generation changes every entry is dropped.
+    """
+
+    def __init__(self, max_entries=1000, ttl=300):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.generation = None
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, generation):
+        with self.lock:
+            if generation != self.generation:
+                self.entries.clear()
+                self.generation = generation
+
+            entry = self.entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                self.entries.pop(key, None)
+                self.misses += 1
+                return None
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+            # Callers decorate the items, so never hand out the cached ones
+            return [dict(item) for item in entry[1]]
+
+    def put(self, key, generation, results):
+        if self.max_entries <= 0:
+            return
+        with self.lock:
+            if generation != self.generation:
+                return
+            self.entries[key] = (time.monotonic() + self.ttl, [dict(item) for item in results])
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
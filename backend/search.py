@@ -1,8 +1,22 @@
-import cv2
+import hashlib
 import numpy as np
 import os
+import time
 from elasticsearch import Elasticsearch
-from image_processing import resize_image, denoise_image, color_intensity_mean, color_intensity_histogram, glcm_features_all_directions, compute_hog, compute_gist, extract_dct_features, extract_wavelet_features, harris_corners
+from image_processing import preprocess_image, preprocessing_manifest, ImageContext, extract_features
+
+from features import feature_map, feature_fields, cheap_feature_keys, parse_feature_weights
+from local_search import LocalSearchBackend
+from index_meta import check_preprocessing, check_vector_format, read_index_meta
+from compact_vectors import compact_query
+from normalized_vectors import normalized_query
+from vector_formats import stored_fields, read_document, bitset_groups
+from snapshot import read_snapshot, iter_snapshot_docs, check_snapshot_preprocessing
+from metrics import stage_seconds
+from result_cache import ResultCache, query_fingerprint
+from ann_index import ANNSearchBackend, IndexFormatError
+from visual_words import VisualWordIndex
+from near_duplicates import HashIndex
 
 from dotenv import load_dotenv
 load_dotenv()
@@ -16,372 +30,556 @@ print("ELASTIC_USERNAME:", ELASTIC_USERNAME)
 print("ELASTIC_PASSWORD:", ELASTIC_PASSWORD)
 print("ELASTIC_INDEX:", ELASTIC_INDEX)
 
+# orjson encodes the query vectors straight from the NumPy arrays, several
+# times faster than json with a tolist() per array
+try:
+    from elasticsearch import OrjsonSerializer
+    serializer = OrjsonSerializer()
+except ImportError:
+    serializer = None
+print("Request serializer:", 'orjson' if serializer is not None else 'json')
+
 es = Elasticsearch(ELASTIC_URL,
-    basic_auth=(ELASTIC_USERNAME, ELASTIC_PASSWORD)
+    basic_auth=(ELASTIC_USERNAME, ELASTIC_PASSWORD),
+    serializer=serializer
 )
 es.info()
 
-def search_similar_images(image, feature_keys=['mean', 'hist', 'glcm', 'hog', 'gist', 'dct', 'wavelet', 'corners'], top_n=10):
-    print("Using Features: ", feature_keys)
-    image_rgb = image.copy()
-    image_rgb = cv2.cvtColor(image_rgb, cv2.COLOR_BGR2RGB)
-    if image is None:
-        print("Error: Unable to read image.")
-        return []
+# Refuse to serve queries whose vectors would not be comparable with the index
+print("Preprocessing:", check_preprocessing(es, ELASTIC_INDEX))
+
+SEARCH_BACKEND = os.getenv('SEARCH_BACKEND', 'elastic')
+print("SEARCH_BACKEND:", SEARCH_BACKEND)
+
+# "local" rebuilds feedback vectors from the local backend instead of fetching them
+FEEDBACK_FEATURE_STORE = os.getenv('FEEDBACK_FEATURE_STORE', 'elastic')
+ANN_INDEX_PATH = os.getenv('ANN_INDEX_PATH', 'ann_index.npz')
+ANN_NLIST = int(os.getenv('ANN_NLIST', 256))
+ANN_NPROBE = int(os.getenv('ANN_NPROBE', 8))
+ANN_CANDIDATES = int(os.getenv('ANN_CANDIDATES', 200))
+
+# Two-stage search: shortlist this many documents with the cheap feature
+# groups, then rank only those with every selected group; 0 disables it
+SEARCH_SHORTLIST = int(os.getenv('SEARCH_SHORTLIST', 0))
+print("SEARCH_SHORTLIST:", SEARCH_SHORTLIST)
+cheap_fields = set(feature_fields(cheap_feature_keys))
+
+# "float" stores float vectors; "compact" stores int8 hog/gist/dct and bitset corners;
+# "normalized" stores one normalized vector per group and searches with knn
+VECTOR_FORMAT = os.getenv('VECTOR_FORMAT', 'float')
+print("Vector format:", check_vector_format(es, ELASTIC_INDEX, VECTOR_FORMAT))
+compact_format = VECTOR_FORMAT == 'compact'
+binary_groups = bitset_groups(VECTOR_FORMAT)
+all_fields = feature_fields(feature_map.keys())
+source_fields = ['file'] + stored_fields(all_fields, VECTOR_FORMAT)
+expand_source = (lambda source: read_document(source, VECTOR_FORMAT)) if VECTOR_FORMAT != 'float' else None
+# Weight of each group in the average score, e.g. "hog=2,corners=0.5"; unlisted groups weigh 1
+FEATURE_WEIGHTS = os.getenv('FEATURE_WEIGHTS', '')
+feature_weights = parse_feature_weights(FEATURE_WEIGHTS)
+print("Feature weights:", feature_weights)
+# Normalized format: nearest neighbours each group's knn clause considers per shard
+KNN_NUM_CANDIDATES = int(os.getenv('KNN_NUM_CANDIDATES', 500))
+
+# A feature snapshot (snapshot.py) the local / ann backends load instead of scanning the index
+SEARCH_SNAPSHOT = os.getenv('SEARCH_SNAPSHOT', '')
+
+def load_local_backend(backend):
+    if SEARCH_SNAPSHOT:
+        check_snapshot_preprocessing(read_snapshot(SEARCH_SNAPSHOT)[0], preprocessing_manifest())
+        backend.load_batches(iter_snapshot_docs(SEARCH_SNAPSHOT))
+    else:
+        backend.load_from_elastic(es, ELASTIC_INDEX, fields=source_fields, transform=expand_source)
+
+# Visual-word index of SIFT keypoints (visual_words.py), searched when a query selects "sift"
+SIFT_INDEX_PATH = os.getenv('SIFT_INDEX_PATH', 'sift_index.npz')
+# Visual-word matches re-ranked with the other selected groups of a query
+SIFT_CANDIDATES = int(os.getenv('SIFT_CANDIDATES', 1000))
+sift_index = VisualWordIndex.load(SIFT_INDEX_PATH) if os.path.isfile(SIFT_INDEX_PATH) else None
+
+# Perceptual hashes of the indexed images, kept by import_initial_data.py
+DUPLICATE_INDEX_PATH = os.getenv('DUPLICATE_INDEX_PATH', 'duplicate_index.npz')
+DUPLICATE_DISTANCE = int(os.getenv('DUPLICATE_DISTANCE', 4))
+# An upload within this many bits of an indexed image is searched with that
+# image's stored vectors instead of being extracted; -1 turns it off
+DUPLICATE_QUERY_DISTANCE = int(os.getenv('DUPLICATE_QUERY_DISTANCE', 2))
+# 1 keeps only the best result of each group of near-duplicates
+COLLAPSE_DUPLICATES = int(os.getenv('COLLAPSE_DUPLICATES', 0))
+print("COLLAPSE_DUPLICATES:", COLLAPSE_DUPLICATES)
+duplicate_index = None
+if os.path.isfile(DUPLICATE_INDEX_PATH):
+    duplicate_index = HashIndex.load(DUPLICATE_INDEX_PATH, max(DUPLICATE_DISTANCE, DUPLICATE_QUERY_DISTANCE))
+collapse_results = bool(COLLAPSE_DUPLICATES) and duplicate_index is not None
+duplicate_lookup = duplicate_index is not None and DUPLICATE_QUERY_DISTANCE >= 0
+
+local_backend = None
+if SEARCH_BACKEND == 'local':
+    local_backend = LocalSearchBackend(feature_map, binary_groups, feature_weights)
+    load_local_backend(local_backend)
+elif SEARCH_BACKEND == 'ann':
+    local_backend = ANNSearchBackend(feature_map, ANN_NLIST, ANN_NPROBE, ANN_CANDIDATES, binary_groups, feature_weights, VECTOR_FORMAT)
+    loaded = False
+    if os.path.isfile(ANN_INDEX_PATH):
+        try:
+            local_backend.load(ANN_INDEX_PATH)
+            loaded = True
+        except IndexFormatError as e:
+            print(f"{e}; rebuilding it")
+    if not loaded:
+        load_local_backend(local_backend)
+        local_backend.build()
+        local_backend.save(ANN_INDEX_PATH)
+
+RESULT_CACHE_SIZE = int(os.getenv('RESULT_CACHE_SIZE', 1000))
+RESULT_CACHE_TTL = int(os.getenv('RESULT_CACHE_TTL', 300))
+# Seconds between reads of the index generation; 0 reads it on every search
+RESULT_CACHE_GENERATION_CHECK = float(os.getenv('RESULT_CACHE_GENERATION_CHECK', 5))
+
+result_cache = ResultCache(RESULT_CACHE_SIZE, RESULT_CACHE_TTL)
+index_generation = None
+index_generation_checked = 0.0
+
+def current_generation():
+    """The index generation, bumped by every import that writes documents."""
+    global index_generation, index_generation_checked
+    now = time.monotonic()
+    if index_generation is None or now - index_generation_checked >= RESULT_CACHE_GENERATION_CHECK:
+        index_generation = read_index_meta(es, ELASTIC_INDEX).get('generation', 0)
+        index_generation_checked = now
+    return index_generation
+
+SCORE_SCRIPT = """
+    double total_cosineSimilarity = 0.0;
+    double total_weight = 0.0;
     
-    image = resize_image(image)
-    image = denoise_image(image)
+    if (params.containsKey('r_mean')) {
+        // Query values
+        double a1 = params.r_mean;
+        double a2 = params.g_mean;
+        double a3 = params.b_mean;
+        double a4 = params.i_mean;
+
+        // Document values
+        double b1 = params._source.r_mean;
+        double b2 = params._source.g_mean;
+        double b3 = params._source.b_mean;
+        double b4 = params._source.i_mean;
+
+        // Compute dot product
+        double dot_product = (a1 * b1) + (a2 * b2) + (a3 * b3) + (a4 * b4);
+
+        // Compute norms
+        double query_norm = Math.sqrt((a1 * a1) + (a2 * a2) + (a3 * a3) + (a4 * a4));
+        double doc_norm = Math.sqrt((b1 * b1) + (b2 * b2) + (b3 * b3) + (b4 * b4));
+
+        // Compute cosine similarity
+        total_cosineSimilarity += (query_norm * doc_norm == 0) ? 0 : params.weights.mean * dot_product / (query_norm * doc_norm);
+        total_weight += (query_norm * doc_norm == 0) ? 0 : params.weights.mean;
+    }
+    if (params.containsKey('r_hist')) {
+        total_cosineSimilarity += (cosineSimilarity(params.r_hist, 'r_hist') + cosineSimilarity(params.g_hist, 'g_hist') + cosineSimilarity(params.b_hist, 'b_hist') + cosineSimilarity(params.i_hist, 'i_hist')) / 4 * params.weights.hist;
+        total_weight += params.weights.hist;
+    }
+    if (params.containsKey('energy')) {
+        total_cosineSimilarity += (cosineSimilarity(params.energy, 'energy') + cosineSimilarity(params.contrast, 'contrast') + cosineSimilarity(params.entropy, 'entropy') + cosineSimilarity(params.dissimilarity, 'dissimilarity') + cosineSimilarity(params.homogeneity, 'homogeneity') + cosineSimilarity(params.correlation, 'correlation')) / 6 * params.weights.glcm;
+        total_weight += params.weights.glcm;
+    }
+    if (params.containsKey('hog')) {
+        total_cosineSimilarity += params.weights.hog * cosineSimilarity(params.hog, 'hog');
+        total_weight += params.weights.hog;
+    }
+    if (params.containsKey('gist')) {
+        total_cosineSimilarity += params.weights.gist * cosineSimilarity(params.gist, 'gist');
+        total_weight += params.weights.gist;
+    }
+    if (params.containsKey('dct')) {
+        total_cosineSimilarity += params.weights.dct * cosineSimilarity(params.dct, 'dct');
+        total_weight += params.weights.dct;
+    }
+    if (params.containsKey('wavelet')) {
+        total_cosineSimilarity += params.weights.wavelet * cosineSimilarity(params.wavelet, 'wavelet');
+        total_weight += params.weights.wavelet;
+    }
+    if (params.containsKey('corners')) {
+        total_cosineSimilarity += params.weights.corners * cosineSimilarity(params.corners, 'corners');
+        total_weight += params.weights.corners;
+    }
 
-    query_features = {}
+    // Compute the average similarity and add 1.0 for Elasticsearch ranking
+    return (total_weight > 0.0) ? (total_cosineSimilarity / total_weight) : 0.0;
+"""
+
+# Compact indexes keep corners as a bit vector plus its popcount; cosine
+# similarity of two 0/1 masks is |a & b| / sqrt(|a| * |b|) and
+# |a & b| = (|a| + |b| - hamming(a, b)) / 2
+FLOAT_CORNERS_SCRIPT = """
+    if (params.containsKey('corners')) {
+        total_cosineSimilarity += params.weights.corners * cosineSimilarity(params.corners, 'corners');
+        total_weight += params.weights.corners;
+    }
+"""
+COMPACT_CORNERS_SCRIPT = """
+    if (params.containsKey('corners')) {
+        double query_count = params.corners_count;
+        double doc_count = doc['corners_count'].value;
+        double common = (query_count + doc_count - hamming(params.corners, 'corners')) / 2;
+        total_cosineSimilarity += (query_count * doc_count == 0) ? 0 : params.weights.corners * common / Math.sqrt(query_count * doc_count);
+        total_weight += params.weights.corners;
+    }
+"""
+if compact_format:
+    SCORE_SCRIPT = SCORE_SCRIPT.replace(FLOAT_CORNERS_SCRIPT, COMPACT_CORNERS_SCRIPT)
+
+# Exact score of the normalized format: the stored group vectors are already
+# normalized, so each group is a single dot product. A zero mean adds no
+# weight, as in SCORE_SCRIPT.
+NORMALIZED_SCORE_SCRIPT = """
+    double total_similarity = 0.0;
+    double total_weight = 0.0;
+    for (String group : params.groups) {
+        if (group == 'mean' && doc['mean'].magnitude == 0) {
+            continue;
+        }
+        double weight = params.weights[group];
+        total_similarity += weight * dotProduct(params.vectors[group], group);
+        total_weight += weight;
+    }
+    return (total_weight > 0.0) ? (total_similarity / total_weight) : 0.0;
+"""
+
+# The scripts are stored in the cluster once and referenced by id, so a
+# request carries only the params and Elasticsearch compiles each script once.
+# The id ends in a hash of the source: an edited script gets a new id and
+# never runs against params meant for another version.
+def script_id(name, source):
+    return f"cbil-{name}-{hashlib.sha1(source.encode()).hexdigest()[:12]}"
+
+if VECTOR_FORMAT == 'normalized':
+    SCORE_SCRIPT_ID = script_id('normalized-score', NORMALIZED_SCORE_SCRIPT)
+    es.put_script(id=SCORE_SCRIPT_ID, script={"lang": "painless", "source": NORMALIZED_SCORE_SCRIPT})
+else:
+    SCORE_SCRIPT_ID = script_id(f'{VECTOR_FORMAT}-score', SCORE_SCRIPT)
+    es.put_script(id=SCORE_SCRIPT_ID, script={"lang": "painless", "source": SCORE_SCRIPT})
+print("Score script:", SCORE_SCRIPT_ID)
+
+def script_params(params):
+    """Query params with the feature weights added and float vectors as float32."""
+    encoded = {}
+    for field, value in params.items():
+        array = np.asarray(value) if isinstance(value, (list, np.ndarray)) else None
+        # float32 keeps every digit the script sees and prints about half as many
+        encoded[field] = array.astype(np.float32) if array is not None and array.dtype.kind == 'f' else value
+    encoded["weights"] = feature_weights
+    return encoded
+
+def exact_script(query_features):
+    """The stored score script with the params that score every group of the query."""
+    if VECTOR_FORMAT == 'normalized':
+        vectors = normalized_query(query_features)
+        return {"id": SCORE_SCRIPT_ID, "params": {"groups": list(vectors), "vectors": vectors, "weights": feature_weights}}
+    return {"id": SCORE_SCRIPT_ID, "params": script_params(compact_query(query_features) if compact_format else query_features)}
+
+def result_window(top_n):
+    # Collapsing drops results, so twice as many are scored as are shown
+    return 2 * top_n if collapse_results else top_n
+
+def collapse_duplicates(similar_images, top_n):
+    """Drops every result that is a near-duplicate of a better one."""
+    if not collapse_results:
+        return similar_images
+    kept = []
+    for item in similar_images:
+        if not any(duplicate_index.are_duplicates(item['file'], other['file'], DUPLICATE_DISTANCE) for other in kept):
+            kept.append(item)
+            if len(kept) == top_n:
+                break
+    return kept
+
+def run_query(query_features, top_n):
+    generation = current_generation()
+    key = ('query', query_fingerprint(query_features), top_n)
+    similar_images = result_cache.get(key, generation)
+    if similar_images is None:
+        with stage_seconds.time(stage='search'):
+            similar_images = collapse_duplicates(score_query(query_features, result_window(top_n)), top_n)
+        result_cache.put(key, generation, similar_images)
+    return similar_images
 
-    if 'mean' in feature_keys:
-        r_mean, g_mean, b_mean, i_mean = color_intensity_mean(image)
-        query_features['r_mean'] = r_mean
-        query_features['g_mean'] = g_mean
-        query_features['b_mean'] = b_mean
-        query_features['i_mean'] = i_mean
-
-    if 'hist' in feature_keys:
-        r_hist, g_hist, b_hist, i_hist = color_intensity_histogram(image)
-        query_features['r_hist'] = r_hist.tolist()
-        query_features['g_hist'] = g_hist.tolist()
-        query_features['b_hist'] = b_hist.tolist()
-        query_features['i_hist'] = i_hist.tolist()
-
-    if 'glcm' in feature_keys :
-        features = glcm_features_all_directions(image)
-        query_features['energy'] = features['energy'].tolist()
-        query_features['contrast'] = features['contrast'].tolist()
-        query_features['entropy'] = features['entropy'].tolist()
-        query_features['dissimilarity'] = features['dissimilarity'].tolist()
-        query_features['homogeneity'] = features['homogeneity'].tolist()
-        query_features['correlation'] = features['correlation'].tolist()
-
-    if 'hog' in feature_keys:
-        hog = compute_hog(image)
-        query_features['hog'] = hog
-
-    if 'gist' in feature_keys:
-        gist = compute_gist(image)
-        query_features['gist'] = gist
-
-    if 'dct' in feature_keys:
-        dct = extract_dct_features(image)
-        query_features['dct'] = dct
-
-    if 'wavelet' in feature_keys:
-        wavelet = extract_wavelet_features(image)
-        query_features['wavelet'] = wavelet
-
-    if 'corners' in feature_keys:
-        corners = harris_corners(image)
-        query_features['corners'] = corners
+def run_queries(queries, top_n):
+    """run_query for a list of queries; the ones not cached are scored in one batch."""
+    generation = current_generation()
+    keys = [('query', query_fingerprint(query_features), top_n) for query_features in queries]
+    results = [result_cache.get(key, generation) for key in keys]
+    misses = [i for i, result in enumerate(results) if result is None]
+    if misses:
+        with stage_seconds.time(stage='search_batch'):
+            scored = score_queries([queries[i] for i in misses], result_window(top_n))
+        for i, similar_images in zip(misses, scored):
+            similar_images = collapse_duplicates(similar_images, top_n)
+            results[i] = similar_images
+            result_cache.put(keys[i], generation, similar_images)
+    return results
+
+def two_stage_query(query_features, top_n):
+    """The cheap part of the query when two-stage search applies to it, else None."""
+    cheap_query = {field: value for field, value in query_features.items() if field in cheap_fields}
+    # Only worth it when the query mixes cheap and heavy groups
+    if SEARCH_SHORTLIST > top_n and 0 < len(cheap_query) < len(query_features):
+        return cheap_query
+    return None
+
+def knn_query_body(query_features, top_n):
+    """
+    Normalized format: one knn clause per group, each boosted by the group's
+    weight, finds the candidates; an exact rescore of them gives the scores.
+    """
+    script = exact_script(query_features)
+    vectors = script["params"]["vectors"]
+    total_weight = sum(feature_weights[group] for group in vectors) or 1
+    # A zero vector has no neighbours worth finding, it only adds weight
+    clauses = [{
+        "knn": {
+            "field": group,
+            "query_vector": vector,
+            "num_candidates": max(KNN_NUM_CANDIDATES, top_n),
+            "boost": feature_weights[group] / total_weight
+        }
+    } for group, vector in vectors.items() if np.any(vector) and feature_weights[group] > 0]
 
+    if not clauses:
+        return {"size": top_n, "query": {"script_score": {"query": {"match_all": {}}, "script": script}}}
+    return {
+        "size": top_n,
+        "query": {"bool": {"should": clauses}},
+        "rescore": {
+            "window_size": min(max(KNN_NUM_CANDIDATES, top_n) * len(clauses), 10000),
+            "query": {
+                "rescore_query": {"script_score": {"query": {"match_all": {}}, "script": script}},
+                "query_weight": 0,
+                "rescore_query_weight": 1
+            }
+        }
+    }
+
+def query_body(query_features, top_n):
+    if VECTOR_FORMAT == 'normalized':
+        return knn_query_body(query_features, top_n)
 
     query = {
         "size": top_n,
         "query": {
             "script_score": {
                 "query": { "match_all": {} },
-                "script": {
-                    "source": """
-                        double total_cosineSimilarity = 0.0;
-                        double total_weight = 0.0;
-                        
-                        if (params.containsKey('r_mean')) {
-                            // Query values
-                            double a1 = params.r_mean;
-                            double a2 = params.g_mean;
-                            double a3 = params.b_mean;
-                            double a4 = params.i_mean;
-
-                            // Document values
-                            double b1 = params._source.r_mean;
-                            double b2 = params._source.g_mean;
-                            double b3 = params._source.b_mean;
-                            double b4 = params._source.i_mean;
-
-                            // Compute dot product
-                            double dot_product = (a1 * b1) + (a2 * b2) + (a3 * b3) + (a4 * b4);
-
-                            // Compute norms
-                            double query_norm = Math.sqrt((a1 * a1) + (a2 * a2) + (a3 * a3) + (a4 * a4));
-                            double doc_norm = Math.sqrt((b1 * b1) + (b2 * b2) + (b3 * b3) + (b4 * b4));
-
-                            // Compute cosine similarity
-                            total_cosineSimilarity += (query_norm * doc_norm == 0) ? 0 : dot_product / (query_norm * doc_norm);
-                            total_weight += (query_norm * doc_norm == 0) ? 0 : 1;
-                        }
-                        if (params.containsKey('r_hist')) {
-                            total_cosineSimilarity += (cosineSimilarity(params.r_hist, 'r_hist') + cosineSimilarity(params.g_hist, 'g_hist') + cosineSimilarity(params.b_hist, 'b_hist') + cosineSimilarity(params.i_hist, 'i_hist')) / 4 * 1;
-                            total_weight += 1;
-                        }
-                        if (params.containsKey('energy')) {
-                            total_cosineSimilarity += (cosineSimilarity(params.energy, 'energy') + cosineSimilarity(params.contrast, 'contrast') + cosineSimilarity(params.entropy, 'entropy') + cosineSimilarity(params.dissimilarity, 'dissimilarity') + cosineSimilarity(params.homogeneity, 'homogeneity') + cosineSimilarity(params.correlation, 'correlation')) / 6 * 1;
-                            total_weight += 1;
-                        }
-                        if (params.containsKey('hog')) {
-                            total_cosineSimilarity += cosineSimilarity(params.hog, 'hog');
-                            total_weight += 1;
-                        }
-                        if (params.containsKey('gist')) {
-                            total_cosineSimilarity += cosineSimilarity(params.gist, 'gist');
-                            total_weight += 1;
-                        }
-                        if (params.containsKey('dct')) {
-                            total_cosineSimilarity += cosineSimilarity(params.dct, 'dct');
-                            total_weight += 1;
-                        }
-                        if (params.containsKey('wavelet')) {
-                            total_cosineSimilarity += cosineSimilarity(params.wavelet, 'wavelet');
-                            total_weight += 1;
-                        }
-                        if (params.containsKey('corners')) {
-                            total_cosineSimilarity += cosineSimilarity(params.corners, 'corners');
-                            total_weight += 1;
-                        }
-
-                        // Compute the average similarity and add 1.0 for Elasticsearch ranking
-                        return (total_weight > 0.0) ? (total_cosineSimilarity / total_weight) : 0.0;
-                    """,
-                    "params": query_features
-                }
+                "script": exact_script(query_features)
             }
         }
     }
 
-    response = es.search(index=ELASTIC_INDEX, body=query)
-    similar_images = [{
+    cheap_query = two_stage_query(query_features, top_n)
+    if cheap_query is not None:
+        # The script skips groups missing from params, so the first pass only
+        # scores the cheap groups; the rescore replaces the score of the top
+        # SEARCH_SHORTLIST hits with the full one
+        query["query"]["script_score"]["script"]["params"] = script_params(cheap_query)
+        query["rescore"] = {
+            "window_size": SEARCH_SHORTLIST,
+            "query": {
+                "rescore_query": {
+                    "script_score": {
+                        "query": { "match_all": {} },
+                        "script": exact_script(query_features)
+                    }
+                },
+                "query_weight": 0,
+                "rescore_query_weight": 1
+            }
+        }
+    return query
+
+def response_results(response):
+    return [{
         'file': hit["_source"]["file"],
         '_score': hit["_score"],
     } for hit in response["hits"]["hits"]]
+
+def score_files(query_features, files):
+    """{file: score} of the given documents only."""
+    if local_backend is not None:
+        rows = np.array([local_backend.positions[file] for file in files if file in local_backend.positions], dtype=np.int64)
+        scores = local_backend.score(query_features, rows)
+        return {local_backend.files[row]: float(score) for row, score in zip(rows, scores)}
+
+    body = {
+        "size": len(files),
+        "_source": ["file"],
+        "query": {"script_score": {"query": {"ids": {"values": files}}, "script": exact_script(query_features)}}
+    }
+    return {hit["_source"]["file"]: hit["_score"] for hit in es.search(index=ELASTIC_INDEX, body=body)["hits"]["hits"]}
+
+def sift_vector(value):
+    """Visual-word vector of a query's sift field: extracted descriptors, or a feedback centroid."""
+    value = np.asarray(value)
+    return sift_index.query_vector(value) if value.ndim == 2 else value
+
+def score_sift_query(query_features, top_n):
+    """
+    Candidates from the visual-word index, re-ranked with the other selected
+    groups when there are any, as if sift were one more group of the script.
+    """
+    other_features = {field: value for field, value in query_features.items() if field != 'sift'}
+    if sift_index is None:
+        print("Error: sift was selected but there is no visual-word index at", SIFT_INDEX_PATH)
+        return score_query(other_features, top_n) if other_features else []
+
+    candidates = sift_index.search(sift_vector(query_features['sift']), SIFT_CANDIDATES if other_features else top_n)
+    if not other_features:
+        return candidates
+    if not candidates:
+        # No keypoints, or none shared with any image
+        return score_query(other_features, top_n)
+
+    other_scores = score_files(other_features, [candidate['file'] for candidate in candidates])
+    sift_weight = feature_weights['sift']
+    other_weight = sum(feature_weights[feature] for feature, items in feature_map.items() if items[0]['name'] in other_features)
+    total_weight = (sift_weight + other_weight) or 1
+    results = [{
+        'file': candidate['file'],
+        '_score': (sift_weight * candidate['_score'] + other_weight * other_scores.get(candidate['file'], 0.0)) / total_weight,
+    } for candidate in candidates]
+    results.sort(key=lambda result: -result['_score'])
+    return results[:top_n]
+
+def score_query(query_features, top_n):
+    if 'sift' in query_features:
+        return score_sift_query(query_features, top_n)
+
+    if local_backend is not None:
+        cheap_query = two_stage_query(query_features, top_n)
+        if cheap_query is not None:
+            return local_backend.two_stage_search(cheap_query, query_features, top_n, SEARCH_SHORTLIST)
+        return local_backend.search(query_features, top_n)
+
+    response = es.search(index=ELASTIC_INDEX, body=query_body(query_features, top_n))
+    return response_results(response)
+
+def score_queries(queries, top_n):
+    """Scores a batch of queries with one msearch, or with matrix products in the local backend."""
+    # Visual-word queries go through the inverted file one at a time
+    if any('sift' in query_features for query_features in queries):
+        return [score_query(query_features, top_n) for query_features in queries]
+
+    if local_backend is not None:
+        if SEARCH_SHORTLIST > 0:
+            return [score_query(query_features, top_n) for query_features in queries]
+        return local_backend.search_many(queries, top_n)
+
+    searches = []
+    for query_features in queries:
+        searches += [{"index": ELASTIC_INDEX}, query_body(query_features, top_n)]
+    results = []
+    for response in es.msearch(searches=searches)["responses"]:
+        if "error" in response:
+            print("Error: Batch query failed:", response["error"])
+            results.append([])
+        else:
+            results.append(response_results(response))
+    return results
+
+def search_similar_images(image, feature_keys=['mean', 'hist', 'glcm', 'hog', 'gist', 'dct', 'wavelet', 'corners'], top_n=10):
+    if image is None:
+        print("Error: Unable to read image.")
+        return []
     
-    return similar_images
+    image = preprocess_image(image)
+
+    query_features = extract_features(ImageContext(image), feature_keys)
+
+    return run_query(query_features, top_n)
+
+
+def fetch_sources(keys, fields):
+    """{file: stored values of `fields`} for the documents in `keys` that exist."""
+    if FEEDBACK_FEATURE_STORE == 'local' and local_backend is not None and local_backend.has_vectors():
+        found = [key for key in dict.fromkeys(keys) if key in local_backend.positions]
+        return dict(zip(found, local_backend.get_vectors(found, fields)))
 
+    # Only the selected groups, not every stored vector of every document
+    docs = es.mget(index=ELASTIC_INDEX, ids=keys, _source_includes=stored_fields(fields, VECTOR_FORMAT))
+    return {doc["_id"]: read_document(doc["_source"], VECTOR_FORMAT) for doc in docs["docs"] if doc.get("found", False)}
+
+def centroid_query(sources, fields):
+    # Centroid of the selected documents, one stacked mean per field
+    query_features = {}
+    for field in fields:
+        values = [source[field] for source in sources if field in source]
+        if values:
+            query_features[field] = np.sum(np.array(values, dtype=np.float64), axis=0) / len(sources)
+    return query_features
+
+def add_sift_centroid(query_features, keys, feature_keys):
+    # Feedback on sift searches with the mean visual-word vector of the selection
+    if 'sift' in feature_keys and sift_index is not None:
+        vector = sift_index.centroid(keys)
+        if np.any(vector):
+            query_features['sift'] = vector
 
 def search_similar_images_from_keys(keys, feature_keys=['mean', 'hist', 'glcm', 'hog', 'gist', 'dct', 'wavelet', 'corners'], top_n=10):
-    print("Using Features: ", feature_keys)
-    
-    feature_map = {
-        'mean': [
-            {
-                'name': 'r_mean',
-                'type': 'number'
-            }, {
-                'name': 'g_mean',
-                'type': 'number'
-            }, {
-                'name': 'b_mean',
-                'type': 'number'
-            }, {
-                'name': 'i_mean',
-                'type': 'number'
-            }
-        ],
-        'hist': [
-            {
-                'name': 'r_hist',
-                'type': 'vector',
-                'length': 16
-            }, {
-                'name': 'g_hist',
-                'type': 'vector',
-                'length': 16
-            }, {
-                'name': 'b_hist',
-                'type': 'vector',
-                'length': 16
-            }, {
-                'name': 'i_hist',
-                'type': 'vector',
-                'length': 16
-            }
-        ],
-        'glcm': [
-            {
-                'name': 'energy',
-                'type': 'vector',
-                'length': 4
-            }, {
-                'name': 'contrast',
-                'type': 'vector',
-                'length': 4
-            }, {
-                'name': 'entropy',
-                'type': 'vector',
-                'length': 4
-            }, {
-                'name': 'dissimilarity',
-                'type': 'vector',
-                'length': 4
-            }, {
-                'name': 'homogeneity',
-                'type': 'vector',
-                'length': 4
-            }, {
-                'name': 'correlation',
-                'type': 'vector',
-                'length': 4
-            }
-        ],
-        'hog': [
-            {
-                'name': 'hog',
-                'type': 'vector',
-                'length': 1176
-            }
-        ],
-        'gist': [
-            {
-                'name': 'gist',
-                'type': 'vector',
-                'length': 1024
-            }
-        ], 
-        'dct': [
-            {
-                'name': 'dct',
-                'type': 'vector',
-                'length': 1280
-            }
-        ], 
-        'wavelet': [
-            {
-                'name': 'wavelet',
-                'type': 'vector',
-                'length': 12
-            }
-        ], 
-        'corners': [
-            {
-                'name': 'corners',
-                'type': 'vector',
-                'length': 1024
-            }
-        ]
-    }
-    
     if not keys:
         print("Error: No keys provided.")
         return []
+
+    # The same selection in a feedback round skips the mget as well
+    generation = current_generation()
+    cache_key = ('keys', tuple(sorted(keys)), tuple(feature_keys), top_n)
+    cached = result_cache.get(cache_key, generation)
+    if cached is not None:
+        return cached
     
-    docs = es.mget(index=ELASTIC_INDEX, body={"ids": keys})
-    
-    feature_sums = {}
-    for feature in feature_keys:
-        for item in feature_map[feature]:
-            if item['type'] == 'number':
-                feature_sums[item['name']] = 0
-            elif item['type'] == 'vector':
-                feature_sums[item['name']] = [0 for i in range(item['length'])]
-
-    valid_docs = 0
-
-    for doc in docs["docs"]:
-        if doc.get("found", False):
-            valid_docs += 1
-            source = doc["_source"]
-            
-            for field in feature_sums:
-                if field in source:
-                    if isinstance(source[field], (int, float)):
-                        feature_sums[field] += source[field]
-                    else:
-                        vector = np.array(source[field])
-                        if feature_sums[field] is None:
-                            feature_sums[field] = vector
-                        else:
-                            feature_sums[field] += vector
-
-    if valid_docs == 0:
+    fields = feature_fields([feature for feature in feature_keys if feature in feature_map])
+    with stage_seconds.time(stage='feature_fetch'):
+        sources = list(fetch_sources(keys, fields).values()) if fields else []
+
+    query_features = centroid_query(sources, fields) if sources else {}
+    add_sift_centroid(query_features, keys, feature_keys)
+    if not query_features:
         print("Error: No valid documents found.")
         return []
 
-    query_features = {}
-    for field in feature_sums:
-        query_features[feature] = {}
-        if valid_docs > 0:
-            if isinstance(feature_sums[field], (int, float)):
-                query_features[field] = feature_sums[field] / valid_docs
-            else:
-                query_features[field] = (feature_sums[field] / valid_docs).tolist()
-
-    query = {
-        "size": top_n,
-        "query": {
-            "script_score": {
-                "query": {"match_all": {}},
-                "script": {
-                    "source": """
-                        double total_cosineSimilarity = 0.0;
-                        double total_weight = 0.0;
-                        
-                        if (params.containsKey('r_mean')) {
-                            // Query values
-                            double a1 = params.r_mean;
-                            double a2 = params.g_mean;
-                            double a3 = params.b_mean;
-                            double a4 = params.i_mean;
-
-                            // Document values
-                            double b1 = params._source.r_mean;
-                            double b2 = params._source.g_mean;
-                            double b3 = params._source.b_mean;
-                            double b4 = params._source.i_mean;
-
-                            // Compute dot product
-                            double dot_product = (a1 * b1) + (a2 * b2) + (a3 * b3) + (a4 * b4);
-
-                            // Compute norms
-                            double query_norm = Math.sqrt((a1 * a1) + (a2 * a2) + (a3 * a3) + (a4 * a4));
-                            double doc_norm = Math.sqrt((b1 * b1) + (b2 * b2) + (b3 * b3) + (b4 * b4));
-
-                            // Compute cosine similarity
-                            total_cosineSimilarity += (query_norm * doc_norm == 0) ? 0 : dot_product / (query_norm * doc_norm);
-                            total_weight += (query_norm * doc_norm == 0) ? 0 : 1;
-                        }
-                        if (params.containsKey('r_hist')) {
-                            total_cosineSimilarity += (cosineSimilarity(params.r_hist, 'r_hist') + cosineSimilarity(params.g_hist, 'g_hist') + cosineSimilarity(params.b_hist, 'b_hist') + cosineSimilarity(params.i_hist, 'i_hist')) / 4 * 1;
-                            total_weight += 1;
-                        }
-                        if (params.containsKey('energy')) {
-                            total_cosineSimilarity += (cosineSimilarity(params.energy, 'energy') + cosineSimilarity(params.contrast, 'contrast') + cosineSimilarity(params.entropy, 'entropy') + cosineSimilarity(params.dissimilarity, 'dissimilarity') + cosineSimilarity(params.homogeneity, 'homogeneity') + cosineSimilarity(params.correlation, 'correlation')) / 6 * 1;
-                            total_weight += 1;
-                        }
-                        if (params.containsKey('hog')) {
-                            total_cosineSimilarity += cosineSimilarity(params.hog, 'hog');
-                            total_weight += 1;
-                        }
-                        if (params.containsKey('gist')) {
-                            total_cosineSimilarity += cosineSimilarity(params.gist, 'gist');
-                            total_weight += 1;
-                        }
-                        if (params.containsKey('dct')) {
-                            total_cosineSimilarity += cosineSimilarity(params.dct, 'dct');
-                            total_weight += 1;
-                        }
-                        if (params.containsKey('wavelet')) {
-                            total_cosineSimilarity += cosineSimilarity(params.wavelet, 'wavelet');
-                            total_weight += 1;
-                        }
-                        if (params.containsKey('corners')) {
-                            total_cosineSimilarity += cosineSimilarity(params.corners, 'corners');
-                            total_weight += 1;
-                        }
-
-                        // Compute the average similarity and add 1.0 for Elasticsearch ranking
-                        return (total_weight > 0.0) ? (total_cosineSimilarity / total_weight) : 0.0;
-                    """,
-                    "params": query_features
-                }
-            }
-        }
-    }
+    similar_images = run_query(query_features, top_n)
+    result_cache.put(cache_key, generation, similar_images)
+    return similar_images
 
-    response = es.search(index=ELASTIC_INDEX, body=query)
-    similar_images = [{
-        'file': hit["_source"]["file"],
-        '_score': hit["_score"],
-    } for hit in response["hits"]["hits"]]
-    
-    return similar_images
\ No newline at end of file
+def find_duplicate(phash, dhash):
+    """The indexed image closest to an upload's perceptual hashes, or None when none is within DUPLICATE_QUERY_DISTANCE."""
+    if not duplicate_lookup:
+        return None
+    matches = duplicate_index.find(phash, dhash, DUPLICATE_QUERY_DISTANCE)
+    return matches[0][0] if matches else None
+
+def search_duplicate(file, feature_keys, top_n=10):
+    """
+    Results for an upload that is a near-duplicate of the indexed `file`, made
+    from that image's stored vectors without extracting the upload; None when
+    the index no longer has the document, and the caller then extracts.
+    """
+    return search_similar_images_from_keys([file], feature_keys, top_n) or None
+
+def search_similar_images_from_key_sets(key_sets, feature_keys=['mean', 'hist', 'glcm', 'hog', 'gist', 'dct', 'wavelet', 'corners'], top_n=10):
+    """search_similar_images_from_keys for many selections, with one fetch and one batch search."""
+    fields = feature_fields([feature for feature in feature_keys if feature in feature_map])
+    unique_keys = list(dict.fromkeys(key for keys in key_sets for key in keys))
+    with stage_seconds.time(stage='feature_fetch'):
+        sources = fetch_sources(unique_keys, fields) if unique_keys and fields else {}
+
+    # Selections without a single known document get an empty result
+    queries = []
+    for keys in key_sets:
+        selected = [sources[key] for key in dict.fromkeys(keys) if key in sources]
+        query_features = centroid_query(selected, fields) if selected else {}
+        add_sift_centroid(query_features, keys, feature_keys)
+        queries.append(query_features or None)
+
+    results = [[] for _ in key_sets]
+    found = [i for i, query_features in enumerate(queries) if query_features is not None]
+    for i, similar_images in zip(found, run_queries([queries[i] for i in found], top_n) if found else []):
+        results[i] = similar_images
+    return results
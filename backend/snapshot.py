@@ -0,0 +1,150 @@
+"""
+Feature snapshots: every stored feature of the index on disk, so the index
+or a local search backend can be rebuilt without re-extracting any image.
+
+A snapshot is a directory with one memory-mappable .npy file per field
+(float32 rows for vectors, float64 for the scalar means), files.json with
+the file name of every row, and manifest.json with the field lengths and
+the preprocessing the features were extracted with.
+
+    python snapshot.py export snapshots/2026-10-17
+    python snapshot.py import snapshots/2026-10-17
+"""
+import argparse
+import json
+import os
+import time
+import numpy as np
+from elasticsearch import Elasticsearch, helpers
+from features import feature_map
+from vector_formats import stored_document, stored_fields, read_document
+from index_meta import check_preprocessing, check_vector_format, read_index_meta, stored_preprocessing, update_index_meta, bump_generation
+
+def snapshot_fields():
+    """{field: vector length, or None for scalars} for every stored field."""
+    return {item['name']: item.get('length') for items in feature_map.values() for item in items}
+
+def export_snapshot(es, index, path, vector_format='float', batch_size=1000):
+    fields = snapshot_fields()
+    count = es.count(index=index)['count']
+    os.makedirs(path, exist_ok=True)
+
+    # Written in place, so the snapshot never has to fit in memory
+    arrays = {}
+    for field, length in fields.items():
+        shape = (count,) if length is None else (count, length)
+        dtype = np.float64 if length is None else np.float32
+        arrays[field] = np.lib.format.open_memmap(os.path.join(path, f'{field}.npy'), mode='w+', dtype=dtype, shape=shape)
+
+    source_fields = ['file'] + stored_fields(list(fields), vector_format)
+    files = []
+    start = time.perf_counter()
+    for hit in helpers.scan(es, index=index, query={"query": {"match_all": {}}}, _source=source_fields, size=batch_size):
+        # Documents added since the count are left for the next snapshot
+        if len(files) == count:
+            break
+        source = read_document(hit['_source'], vector_format)
+        row = len(files)
+        for field, array in arrays.items():
+            array[row] = source[field]
+        files.append(source['file'])
+        if len(files) % 10000 == 0:
+            print(f"{len(files)}/{count} exported", end="\r")
+
+    for array in arrays.values():
+        array.flush()
+    with open(os.path.join(path, 'files.json'), 'w') as f:
+        json.dump(files, f)
+    manifest = {
+        'count': len(files),
+        'fields': fields,
+        'preprocessing': stored_preprocessing(es, index),
+        'index': index,
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    }
+    with open(os.path.join(path, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=2)
+    print(f"Exported {len(files)} documents to {path} in {time.perf_counter() - start:.1f}s")
+    return manifest
+
+def read_snapshot(path):
+    """Returns (manifest, files, {field: read-only memory-mapped array})."""
+    with open(os.path.join(path, 'manifest.json')) as f:
+        manifest = json.load(f)
+    with open(os.path.join(path, 'files.json')) as f:
+        files = json.load(f)
+    # Rows past `count` belong to documents that arrived during the export
+    arrays = {field: np.load(os.path.join(path, f'{field}.npy'), mmap_mode='r')[:manifest['count']] for field in manifest['fields']}
+    return manifest, files, arrays
+
+def iter_snapshot_docs(path, batch_size=5000):
+    """Yields lists of documents with NumPy field values, as LocalSearchBackend.add takes them."""
+    manifest, files, arrays = read_snapshot(path)
+    for start in range(0, len(files), batch_size):
+        end = min(start + batch_size, len(files))
+        batch = {field: np.asarray(array[start:end]) for field, array in arrays.items()}
+        docs = []
+        for i, file in enumerate(files[start:end]):
+            doc = {'file': file}
+            for field, values in batch.items():
+                doc[field] = float(values[i]) if values.ndim == 1 else values[i]
+            docs.append(doc)
+        yield docs
+
+def check_snapshot_preprocessing(manifest, current):
+    stored = manifest.get('preprocessing')
+    if stored is not None and stored != current:
+        raise ValueError(f"Snapshot was extracted with preprocessing {stored}, but the current settings are {current}. Change .env to match.")
+
+def import_snapshot(es, index, path, vector_format='float', chunk_size=500, threads=2):
+    manifest, files, _ = read_snapshot(path)
+    current = check_preprocessing(es, index)
+    check_snapshot_preprocessing(manifest, current)
+    update_index_meta(es, index, preprocessing=current, vector_format=check_vector_format(es, index, vector_format))
+
+    def actions():
+        for docs in iter_snapshot_docs(path, chunk_size):
+            for doc in docs:
+                doc = stored_document(doc, vector_format)
+                source = {field: value.tolist() if isinstance(value, np.ndarray) else value for field, value in doc.items()}
+                yield {"_index": index, "_id": source['file'], "_source": source}
+
+    start = time.perf_counter()
+    indexed = 0
+    failed = 0
+    for ok, info in helpers.parallel_bulk(es.options(request_timeout=60), actions(), thread_count=threads, chunk_size=chunk_size, raise_on_error=False, raise_on_exception=False):
+        if ok:
+            indexed += 1
+            if indexed % 10000 == 0:
+                print(f"{indexed}/{len(files)} imported", end="\r")
+        else:
+            failed += 1
+            print(f"Error: Failed to import {info['index']['_id']}: {info['index'].get('error')}")
+
+    if indexed:
+        bump_generation(es, index)
+    print(f"Imported {indexed} documents ({failed} failed) from {path} in {time.perf_counter() - start:.1f}s")
+    return indexed
+
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+    load_dotenv()
+    ELASTIC_URL = os.getenv('ELASTIC_URL')
+    ELASTIC_USERNAME = os.getenv('ELASTIC_USERNAME')
+    ELASTIC_PASSWORD = os.getenv('ELASTIC_PASSWORD')
+    ELASTIC_INDEX = os.getenv('ELASTIC_INDEX')
+    VECTOR_FORMAT = os.getenv('VECTOR_FORMAT', 'float')
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('command', choices=['export', 'import'])
+    parser.add_argument('path')
+    parser.add_argument('--chunk-size', type=int, default=500)
+    args = parser.parse_args()
+
+    es = Elasticsearch(ELASTIC_URL, basic_auth=(ELASTIC_USERNAME, ELASTIC_PASSWORD))
+    if args.command == 'export':
+        # The stored format decides how documents are read back
+        stored_format = read_index_meta(es, ELASTIC_INDEX).get('vector_format', 'float')
+        export_snapshot(es, ELASTIC_INDEX, args.path, stored_format)
+    else:
+        import_snapshot(es, ELASTIC_INDEX, args.path, VECTOR_FORMAT, args.chunk_size)
@@ -0,0 +1,52 @@
+import os
+import cv2
+import numpy as np
+import pytest
+
+# image_processing reads these at import; a .env, when present, wins
+os.environ.setdefault('BIN_COUNT', '16')
+os.environ.setdefault('IMG_SIZE_X', '128')
+os.environ.setdefault('IMG_SIZE_Y', '128')
+
+from image_processing import dct_coefficient_index, dct_matrix, extract_dct_features
+
+def zigzag_cells(rows, cols):
+    """JPEG zigzag walk of a rows x cols block: anti-diagonals, alternating direction."""
+    cells = []
+    for diagonal in range(rows + cols - 1):
+        line = [(i, diagonal - i) for i in range(rows) if 0 <= diagonal - i < cols]
+        cells += line if diagonal % 2 else line[::-1]
+    return cells
+
+def reference_dct_features(gray, block_size=16, num_coefficients=20, zigzag=False):
+    """One cv2.dct per block, edge blocks included, as the features were first extracted."""
+    features = []
+    for i in range(0, gray.shape[0], block_size):
+        for j in range(0, gray.shape[1], block_size):
+            block = cv2.dct(np.ascontiguousarray(gray[i:i+block_size, j:j+block_size]))
+            if zigzag:
+                features.extend(block[row, col] for row, col in zigzag_cells(*block.shape)[:num_coefficients])
+            else:
+                features.extend(block.flatten()[:num_coefficients])
+    return np.array(features)
+
+def test_dct_matrix_matches_cv2():
+    rng = np.random.default_rng(0)
+    block = rng.random((16, 16), dtype=np.float32)
+    basis = dct_matrix(16)
+    np.testing.assert_allclose(basis @ block @ basis.T, cv2.dct(block), atol=1e-5)
+
+@pytest.mark.parametrize('rows, cols', [(16, 16), (8, 8), (6, 4), (3, 5), (1, 16)])
+def test_zigzag_index_follows_the_walk(rows, cols):
+    expected = [i * cols + j for i, j in zigzag_cells(rows, cols)[:20]]
+    np.testing.assert_array_equal(dct_coefficient_index(rows, cols, 20, zigzag=True), expected)
+
+@pytest.mark.parametrize('zigzag', [False, True])
+@pytest.mark.parametrize('shape', [(128, 128), (64, 96), (72, 100), (50, 38)])
+def test_matches_per_block_cv2_dct(shape, zigzag):
+    rng = np.random.default_rng(shape[0] * shape[1])
+    gray = rng.integers(0, 256, shape, dtype=np.uint8)
+    features = extract_dct_features(gray, zigzag=zigzag)
+    expected = reference_dct_features(np.float32(gray) / 255.0, zigzag=zigzag)
+    assert features.shape == expected.shape
+    np.testing.assert_allclose(features, expected, atol=1e-4)
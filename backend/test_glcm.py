@@ -0,0 +1,38 @@
+import os
+import numpy as np
+import pytest
+import skimage.feature as skf
+
+# image_processing reads these at import; a .env, when present, wins
+os.environ.setdefault('BIN_COUNT', '16')
+os.environ.setdefault('IMG_SIZE_X', '128')
+os.environ.setdefault('IMG_SIZE_Y', '128')
+
+from image_processing import ImageContext, glcm_directions, glcm_features_all_directions
+
+def reference_glcm_features(image):
+    """The per-angle graycomatrix/graycoprops extraction that 256-level vectors were indexed with."""
+    gray = ImageContext(image).glcm_gray
+    features = {name: [] for name in ['energy', 'contrast', 'entropy', 'dissimilarity', 'homogeneity', 'correlation']}
+    for dx, dy in glcm_directions:
+        glcm = skf.graycomatrix(gray, distances=[1], angles=[np.arctan2(dy, dx)], levels=256, symmetric=True, normed=True)
+        for name in ['energy', 'contrast', 'dissimilarity', 'homogeneity', 'correlation']:
+            features[name].append(skf.graycoprops(glcm, name)[0, 0])
+        features['entropy'].append(-np.sum(glcm * np.log2(glcm + (glcm == 0))))
+    return {name: np.array(values) for name, values in features.items()}
+
+def assert_matches_reference(image):
+    features = glcm_features_all_directions(image, levels=256)
+    expected = reference_glcm_features(image)
+    for name, values in expected.items():
+        np.testing.assert_allclose(features[name], values, rtol=1e-9, atol=1e-12, err_msg=name)
+
+@pytest.mark.parametrize('seed', range(5))
+def test_random_images_match_per_angle_graycoprops(seed):
+    rng = np.random.default_rng(seed)
+    assert_matches_reference(rng.integers(0, 256, (64, 80, 3), dtype=np.uint8))
+
+def test_flat_image_has_constant_correlation():
+    image = np.full((64, 64, 3), 120, dtype=np.uint8)
+    assert_matches_reference(image)
+    np.testing.assert_array_equal(glcm_features_all_directions(image, levels=256)['correlation'], 1.0)
@@ -0,0 +1,136 @@
+import numpy as np
+import pytest
+
+from features import feature_map, feature_fields
+from local_search import LocalSearchBackend
+from ann_index import ANNSearchBackend, IndexFormatError
+
+weights = {'mean': 3.0, 'hog': 2.0, 'corners': 0.5}
+
+def random_doc(rng, file):
+    doc = {'file': file}
+    for items in feature_map.values():
+        for item in items:
+            if item['type'] == 'number':
+                doc[item['name']] = float(rng.uniform(0, 255))
+            elif item['name'] == 'corners':
+                doc[item['name']] = (rng.random(item['length']) < 0.1).astype(np.float32) * 255
+            else:
+                doc[item['name']] = rng.normal(size=item['length']).astype(np.float32)
+    return doc
+
+def random_docs(rng, count, prefix='doc'):
+    docs = [random_doc(rng, f'{prefix}{i}.jpg') for i in range(count)]
+    # A flat image: zero means add no weight for the mean group
+    for name in ['r_mean', 'g_mean', 'b_mean', 'i_mean']:
+        docs[0][name] = 0.0
+    return docs
+
+def query_of(doc, groups):
+    return {field: doc[field] for field in feature_fields(groups)}
+
+def cosine(a, b):
+    a = np.asarray(a, dtype=np.float64)
+    b = np.asarray(b, dtype=np.float64)
+    denominator = np.linalg.norm(a) * np.linalg.norm(b)
+    return a @ b / denominator if denominator else 0.0
+
+def script_score(query, doc):
+    """SCORE_SCRIPT of search.py for one document, written out with NumPy."""
+    total = 0.0
+    total_weight = 0.0
+    for group, items in feature_map.items():
+        if items[0]['name'] not in query:
+            continue
+        weight = weights.get(group, 1.0)
+        if group == 'mean':
+            a = [query[item['name']] for item in items]
+            b = [doc[item['name']] for item in items]
+            if np.linalg.norm(a) * np.linalg.norm(b) == 0:
+                continue
+            total += weight * cosine(a, b)
+        else:
+            total += weight * np.mean([cosine(query[item['name']], doc[item['name']]) for item in items])
+        total_weight += weight
+    return total / total_weight if total_weight else 0.0
+
+query_groups = [
+    list(feature_map),
+    ['mean', 'hist'],
+    ['hog', 'corners'],
+    ['glcm', 'gist', 'dct', 'wavelet'],
+]
+
+@pytest.mark.parametrize('binary_groups', [(), ('corners',)])
+def test_score_many_matches_script(binary_groups):
+    rng = np.random.default_rng(0)
+    docs = random_docs(rng, 50)
+    backend = LocalSearchBackend(feature_map, binary_groups, weights)
+    backend.add(docs)
+
+    # The flat image as query, too: its mean group adds no weight anywhere
+    queries = [query_of(docs[i], groups) for i, groups in zip([3, 0, 7, 11], query_groups)]
+    scores = backend.score_many(queries)
+    expected = np.array([[script_score(query, doc) for query in queries] for doc in docs])
+    np.testing.assert_allclose(scores, expected, atol=1e-5)
+    for i, query in enumerate(queries):
+        np.testing.assert_allclose(backend.score(query), expected[:, i], atol=1e-5)
+
+@pytest.mark.parametrize('binary_groups', [(), ('corners',)])
+def test_get_vectors_round_trip(binary_groups):
+    rng = np.random.default_rng(1)
+    docs = random_docs(rng, 20)
+    backend = LocalSearchBackend(feature_map, binary_groups, weights)
+    backend.add(docs)
+
+    fields = feature_fields(feature_map.keys())
+    files = [doc['file'] for doc in docs[::3]] + ['unknown.jpg']
+    for doc, vectors in zip(docs[::3], backend.get_vectors(files, fields)):
+        assert set(vectors) == set(fields)
+        for field in fields:
+            np.testing.assert_allclose(vectors[field], doc[field], rtol=1e-5, atol=1e-4, err_msg=field)
+
+def test_ann_matches_exact_after_updates(tmp_path):
+    rng = np.random.default_rng(2)
+    docs = random_docs(rng, 80)
+    # Every list probed and every row a candidate: ANN must equal the exhaustive scan
+    backend = ANNSearchBackend(feature_map, nlist=4, nprobe=4, candidates=1000, binary_groups=('corners',), weights=weights)
+    backend.add(docs)
+    backend.build()
+
+    backend.remove([doc['file'] for doc in docs[10:20]] + ['unknown.jpg'])
+    added = random_docs(rng, 15, 'new')
+    replaced = [random_doc(rng, doc['file']) for doc in docs[30:35]]
+    backend.add(added + replaced)
+    path = str(tmp_path / 'ann_index.npz')
+    backend.save(path)
+
+    loaded = ANNSearchBackend(feature_map, nlist=4, nprobe=4, candidates=1000, binary_groups=('corners',), weights=weights)
+    loaded.load(path)
+    assert loaded.files == backend.files
+
+    # The same documents, added once to an exhaustive backend
+    current = {doc['file']: doc for doc in docs[:10] + docs[20:] + added + replaced}
+    exhaustive = LocalSearchBackend(feature_map, ('corners',), weights)
+    exhaustive.add(list(current.values()))
+    assert sorted(loaded.files) == sorted(current)
+
+    for groups in query_groups:
+        for doc in docs[40:45] + replaced[:2] + added[:2]:
+            query = query_of(doc, groups)
+            expected = [item['file'] for item in exhaustive.search(query, 10)]
+            assert [item['file'] for item in loaded.search(query, 10)] == expected
+            assert [item['file'] for item in backend.search(query, 10)] == expected
+
+def test_ann_file_of_another_layout_is_refused(tmp_path):
+    rng = np.random.default_rng(3)
+    backend = ANNSearchBackend(feature_map, nlist=2, binary_groups=('corners',), vector_format='compact')
+    backend.add(random_docs(rng, 10))
+    backend.build()
+    path = str(tmp_path / 'ann_index.npz')
+    backend.save(path)
+
+    other = ANNSearchBackend(feature_map, nlist=2, vector_format='float')
+    with pytest.raises(IndexFormatError, match='compact'):
+        other.load(path)
+    assert other.files == []
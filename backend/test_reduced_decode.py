@@ -0,0 +1,49 @@
+import os
+from unittest import mock
+import cv2
+import numpy as np
+import pytest
+
+# image_processing reads these at import; a .env, when present, wins
+os.environ.setdefault('BIN_COUNT', '16')
+os.environ.setdefault('IMG_SIZE_X', '128')
+os.environ.setdefault('IMG_SIZE_Y', '128')
+os.environ.setdefault('ELASTIC_URL', 'http://localhost:9200')
+os.environ.setdefault('ELASTIC_USERNAME', 'elastic')
+os.environ.setdefault('ELASTIC_PASSWORD', 'elastic')
+
+import image_processing
+from image_processing import decode_image, extract_upload_features
+from features import feature_keys_all
+from thumbnails import ThumbnailCache
+
+@pytest.fixture
+def ingest(monkeypatch):
+    # The import checks the cluster on import; the worker code never uses it
+    with mock.patch('elasticsearch.Elasticsearch.info'):
+        import import_initial_data
+    monkeypatch.setattr(image_processing, 'reduced_decode', 1)
+    return import_initial_data
+
+def write_jpeg(path, width, height):
+    rng = np.random.default_rng(0)
+    image = cv2.resize(rng.integers(0, 256, (height // 20, width // 20, 3), dtype=np.uint8), (width, height), interpolation=cv2.INTER_CUBIC)
+    cv2.imwrite(str(path), image, [cv2.IMWRITE_JPEG_QUALITY, 90])
+    return path.read_bytes()
+
+def test_ingest_and_upload_give_identical_vectors(ingest, tmp_path, monkeypatch):
+    image_data = write_jpeg(tmp_path / 'photo.jpg', 1600, 1200)
+    # A pregenerated thumbnail wider than the feature decode must not change it
+    monkeypatch.setattr(ingest, 'THUMBNAIL_PREGENERATE', [512])
+    monkeypatch.setattr(ingest, 'thumbnail_cache', ThumbnailCache(str(tmp_path), str(tmp_path / 'thumbs'), widths=[512]))
+    monkeypatch.setattr(ingest, 'sift_vocabulary', None)
+
+    filename, _, feature, error = ingest.extract_file_features(str(tmp_path / 'photo.jpg'))
+    assert error is None
+    uploaded = extract_upload_features(image_data, feature_keys_all)
+    for field, value in uploaded.items():
+        np.testing.assert_array_equal(feature[field], value, err_msg=field)
+
+    assert decode_image(image_data).shape[:2] == (150, 200)
+    thumbnail = cv2.imread(ingest.thumbnail_cache.get(filename, 512))
+    assert thumbnail.shape[1] == 512
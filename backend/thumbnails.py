@@ -0,0 +1,133 @@
+import os
+import threading
+from collections import OrderedDict
+import cv2
+
+formats = {
+    'jpeg': ('.jpg', 'image/jpeg'),
+    'webp': ('.webp', 'image/webp'),
+}
+
+class ThumbnailCache:
+    """
+    Resized copies of the images in `image_folder`, kept in `cache_folder`.
+
+    Thumbnails are named after the source file, its mtime and the width, so a
+    changed source never serves a stale thumbnail. The folder is kept under
+    `max_bytes` by evicting the least recently used files; use is recorded in
+    the file mtime so the order survives restarts.
+    """
+
+    def __init__(self, image_folder, cache_folder, max_bytes=512 * 1024 * 1024, widths=(128, 256, 512), quality=85):
+        self.image_folder = image_folder
+        self.cache_folder = cache_folder
+        self.max_bytes = max_bytes
+        self.widths = sorted(widths)
+        self.quality = quality
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+        os.makedirs(cache_folder, exist_ok=True)
+        self.scan()
+
+    def scan(self):
+        with self.lock:
+            files = []
+            for name in os.listdir(self.cache_folder):
+                path = os.path.join(self.cache_folder, name)
+                if name.endswith('.tmp') or not os.path.isfile(path):
+                    continue
+                stat = os.stat(path)
+                files.append((stat.st_mtime, name, stat.st_size))
+            self.entries = OrderedDict((name, size) for _, name, size in sorted(files))
+            self.total_bytes = sum(self.entries.values())
+
+    def snap_width(self, width):
+        # Only a few widths are cached, so arbitrary ?w= values cannot fill the disk
+        for allowed in self.widths:
+            if width <= allowed:
+                return allowed
+        return self.widths[-1]
+
+    def thumbnail_name(self, filename, width, fmt, mtime_ns):
+        return f"{filename}.{mtime_ns:x}.{width}{formats[fmt][0]}"
+
+    def encode(self, image, width, fmt):
+        height, original_width = image.shape[:2]
+        if width < original_width:
+            image = cv2.resize(image, (width, max(1, round(height * width / original_width))), interpolation=cv2.INTER_AREA)
+        if fmt == 'webp':
+            ok, data = cv2.imencode('.webp', image, [cv2.IMWRITE_WEBP_QUALITY, self.quality])
+        else:
+            ok, data = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, self.quality])
+        return data.tobytes() if ok else None
+
+    def store(self, filename, image, width, fmt='jpeg'):
+        """Writes the thumbnail of an already decoded image; used at ingest and on a cache miss."""
+        width = self.snap_width(width)
+        mtime_ns = os.stat(os.path.join(self.image_folder, filename)).st_mtime_ns
+        name = self.thumbnail_name(filename, width, fmt, mtime_ns)
+        path = os.path.join(self.cache_folder, name)
+        if os.path.isfile(path):
+            self.register(name, os.path.getsize(path))
+            return path
+
+        data = self.encode(image, width, fmt)
+        if data is None:
+            return None
+
+        # Write then rename, so readers never see a half written file
+        temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temp_path, 'wb') as f:
+            f.write(data)
+        os.replace(temp_path, path)
+        self.register(name, len(data))
+        return path
+
+    def register(self, name, size):
+        with self.lock:
+            self.total_bytes += size - self.entries.pop(name, 0)
+            self.entries[name] = size
+
+    def get(self, filename, width, fmt='jpeg'):
+        """Path of the thumbnail for `filename`, generated on first request; None if the source is unreadable."""
+        width = self.snap_width(width)
+        source_path = os.path.join(self.image_folder, filename)
+        mtime_ns = os.stat(source_path).st_mtime_ns
+        name = self.thumbnail_name(filename, width, fmt, mtime_ns)
+        path = os.path.join(self.cache_folder, name)
+
+        with self.lock:
+            hit = name in self.entries
+            if hit:
+                self.entries.move_to_end(name)
+
+        if os.path.isfile(path):
+            if not hit:
+                # Written by another process, e.g. pregenerated by an import after startup
+                self.register(name, os.path.getsize(path))
+                self.evict()
+            os.utime(path)
+            self.hits += 1
+            return path
+
+        self.misses += 1
+        image = cv2.imread(source_path)
+        if image is None:
+            return None
+        path = self.store(filename, image, width, fmt)
+        self.evict()
+        return path
+
+    def evict(self):
+        with self.lock:
+            while self.total_bytes > self.max_bytes and len(self.entries) > 1:
+                name, size = self.entries.popitem(last=False)
+                self.total_bytes -= size
+                try:
+                    os.remove(os.path.join(self.cache_folder, name))
+                except FileNotFoundError:
+                    pass
@@ -0,0 +1,52 @@
+from features import feature_map
+from compact_vectors import binary_fields, compact_document, compact_fields, expand_document, compact_mapping
+from normalized_vectors import normalize_document, normalized_fields, expand_normalized, normalized_mapping
+
+# "float": one float vector per field, as extracted
+# "compact": int8 hog/gist/dct with a scale, bitset corners
+# "normalized": one pre-normalized vector per feature group
+vector_formats = ['float', 'compact', 'normalized']
+
+def stored_document(feature, vector_format):
+    """The document to index for an extracted feature dict; `feature` is left as is."""
+    if vector_format == 'compact':
+        return compact_document(dict(feature))
+    if vector_format == 'normalized':
+        return normalize_document(feature)
+    return feature
+
+def stored_fields(fields, vector_format):
+    """Source fields holding the given feature fields."""
+    if vector_format == 'compact':
+        return compact_fields(fields)
+    if vector_format == 'normalized':
+        return normalized_fields(fields)
+    return list(fields)
+
+def read_document(source, vector_format):
+    """Feature fields of a stored document, in place."""
+    if vector_format == 'compact':
+        return expand_document(source, feature_map)
+    if vector_format == 'normalized':
+        return expand_normalized(source)
+    return source
+
+def bitset_groups(vector_format):
+    """Groups the local backend should keep as bitsets for this format."""
+    return binary_fields if vector_format == 'compact' else ()
+
+def float_mapping():
+    """Index mapping of the float format, as in the README."""
+    properties = {'file': {'type': 'keyword'}}
+    for items in feature_map.values():
+        for item in items:
+            properties[item['name']] = {'type': 'float'} if item['type'] == 'number' else {'type': 'dense_vector', 'dims': item['length']}
+    return {'properties': properties}
+
+def index_mapping(vector_format):
+    """Mapping of a new index in this format."""
+    if vector_format == 'compact':
+        return compact_mapping()
+    if vector_format == 'normalized':
+        return normalized_mapping()
+    return float_mapping()
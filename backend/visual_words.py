@@ -0,0 +1,267 @@
+"""
+SIFT bag of visual words: an offline k-means vocabulary over SIFT
+descriptors, one TF-IDF visual-word histogram per image, and an inverted
+file from each word to the images containing it. A query only visits the
+posting lists of its own words, so it never scans the whole collection.
+
+    python visual_words.py vocabulary    # k-means over a sample of IMAGE_FOLDER
+    python visual_words.py index         # histograms of every image, saved to SIFT_INDEX_PATH
+"""
+import argparse
+import os
+import time
+import cv2
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from sklearn.cluster import MiniBatchKMeans
+from catalog import scan_folder
+from image_processing import preprocess_image, compute_sift, read_image
+
+class VisualVocabulary:
+    """k-means centroids of SIFT descriptors; each centroid is a visual word."""
+
+    def __init__(self, centers):
+        self.centers = np.ascontiguousarray(centers, dtype=np.float32)
+        self.center_norms = np.einsum('ij,ij->i', self.centers, self.centers)
+
+    def __len__(self):
+        return len(self.centers)
+
+    @classmethod
+    def build(cls, descriptors, size=1024, seed=0):
+        size = max(1, min(size, len(descriptors)))
+        kmeans = MiniBatchKMeans(n_clusters=size, batch_size=4096, n_init=3, random_state=seed)
+        kmeans.fit(np.asarray(descriptors, dtype=np.float32))
+        return cls(kmeans.cluster_centers_)
+
+    def words(self, descriptors, batch_size=4096):
+        """Nearest visual word of every descriptor."""
+        words = np.zeros(len(descriptors), dtype=np.int32)
+        for start in range(0, len(descriptors), batch_size):
+            batch = np.asarray(descriptors[start:start + batch_size], dtype=np.float32)
+            # |d - c|^2 without the |d|^2 term, which is the same for every word
+            words[start:start + batch_size] = np.argmin(self.center_norms - 2 * batch @ self.centers.T, axis=1)
+        return words
+
+    def word_counts(self, descriptors):
+        """(words, counts) histogram of an image's descriptors."""
+        words, counts = np.unique(self.words(descriptors), return_counts=True)
+        return words.astype(np.int32), counts.astype(np.float32)
+
+    def save(self, path):
+        temp_path = path + '.tmp.npz'
+        np.savez(temp_path, centers=self.centers)
+        os.replace(temp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(data['centers'])
+
+class VisualWordIndex:
+    """
+    Inverted file over the visual-word histograms of the indexed images.
+
+    Documents and queries are TF-IDF weighted and L2-normalized, so summing
+    query weight * document weight over the shared words gives their cosine
+    similarity. IDF comes from the current document frequencies; the posting
+    lists are rebuilt lazily after documents change.
+    """
+
+    def __init__(self, vocabulary):
+        self.vocabulary = vocabulary
+        self.files = []
+        self.positions = {}
+        self.doc_words = []
+        self.doc_counts = []
+        self.idf = None
+        self.order = None
+        self.offsets = None
+        self.rows = None
+        self.weights = None
+
+    def __len__(self):
+        return len(self.files)
+
+    def add(self, docs):
+        """Adds or replaces documents given as (file, (words, counts)) pairs."""
+        for file, (words, counts) in docs:
+            position = self.positions.get(file)
+            if position is None:
+                self.positions[file] = len(self.files)
+                self.files.append(file)
+                self.doc_words.append(words)
+                self.doc_counts.append(counts)
+            else:
+                self.doc_words[position] = words
+                self.doc_counts[position] = counts
+        self.order = None
+
+    def remove(self, files):
+        drop = {self.positions[file] for file in files if file in self.positions}
+        if not drop:
+            return
+        keep = [i for i in range(len(self.files)) if i not in drop]
+        self.files = [self.files[i] for i in keep]
+        self.doc_words = [self.doc_words[i] for i in keep]
+        self.doc_counts = [self.doc_counts[i] for i in keep]
+        self.positions = {file: position for position, file in enumerate(self.files)}
+        self.order = None
+
+    def postings(self):
+        if self.order is None:
+            lengths = np.array([len(words) for words in self.doc_words], dtype=np.int64)
+            words = np.concatenate(self.doc_words) if self.files else np.zeros(0, dtype=np.int32)
+            counts = np.concatenate(self.doc_counts) if self.files else np.zeros(0, dtype=np.float32)
+            rows = np.repeat(np.arange(len(self.files), dtype=np.int32), lengths)
+
+            frequency = np.bincount(words, minlength=len(self.vocabulary))
+            # Smoothed IDF; a word found in every image weighs next to nothing
+            self.idf = np.log((1 + len(self.files)) / (1 + frequency)).astype(np.float32)
+            weights = counts * self.idf[words]
+            norms = np.sqrt(np.bincount(rows, weights=weights * weights, minlength=len(self.files))).astype(np.float32)
+            weights = np.divide(weights, norms[rows], out=np.zeros_like(weights), where=norms[rows] > 0)
+
+            self.order = np.argsort(words, kind='stable')
+            self.offsets = np.searchsorted(words[self.order], np.arange(len(self.vocabulary) + 1))
+            self.rows = rows[self.order]
+            self.weights = weights[self.order]
+        return self.order, self.offsets
+
+    def normalized(self, vector):
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm > 0 else vector
+
+    def query_vector(self, descriptors):
+        """Dense TF-IDF vector of a query image's SIFT descriptors."""
+        self.postings()
+        vector = np.zeros(len(self.vocabulary), dtype=np.float32)
+        if len(descriptors):
+            words, counts = self.vocabulary.word_counts(descriptors)
+            vector[words] = counts * self.idf[words]
+        return self.normalized(vector)
+
+    def centroid(self, files):
+        """Normalized mean of the stored vectors of `files`, for relevance feedback."""
+        self.postings()
+        vector = np.zeros(len(self.vocabulary), dtype=np.float32)
+        for file in files:
+            position = self.positions.get(file)
+            if position is not None:
+                words = self.doc_words[position]
+                vector[words] += self.normalized(self.doc_counts[position] * self.idf[words])
+        return self.normalized(vector)
+
+    def search(self, query, top_n=10):
+        """Documents sharing words with a query_vector(), by cosine similarity."""
+        _, offsets = self.postings()
+        words = np.flatnonzero(query)
+        if len(words) == 0 or not self.files:
+            return []
+        slices = [slice(offsets[word], offsets[word + 1]) for word in words]
+        rows = np.concatenate([self.rows[s] for s in slices])
+        contributions = np.concatenate([self.weights[s] * query[word] for word, s in zip(words, slices)])
+        # Only the documents found in the posting lists are ever touched
+        touched, inverse = np.unique(rows, return_inverse=True)
+        scores = np.bincount(inverse, weights=contributions)
+
+        top_n = min(top_n, len(scores))
+        best = np.argpartition(-scores, top_n - 1)[:top_n]
+        best = best[np.argsort(-scores[best], kind='stable')]
+        return [{'file': self.files[touched[i]], '_score': float(scores[i])} for i in best]
+
+    def save(self, path):
+        lengths = np.array([len(words) for words in self.doc_words], dtype=np.int64)
+        arrays = {
+            'centers': self.vocabulary.centers,
+            'files': np.array(self.files),
+            'offsets': np.concatenate([[0], np.cumsum(lengths)]),
+            'words': np.concatenate(self.doc_words) if self.files else np.zeros(0, dtype=np.int32),
+            'counts': np.concatenate(self.doc_counts) if self.files else np.zeros(0, dtype=np.float32),
+        }
+        temp_path = path + '.tmp.npz'
+        np.savez(temp_path, **arrays)
+        os.replace(temp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        """Loads an index together with the vocabulary it was built with."""
+        with np.load(path) as data:
+            index = cls(VisualVocabulary(data['centers']))
+            files = data['files'].tolist()
+            offsets = data['offsets']
+            words = data['words']
+            counts = data['counts']
+        index.add((file, (words[offsets[i]:offsets[i + 1]], counts[offsets[i]:offsets[i + 1]])) for i, file in enumerate(files))
+        print(f"Loaded visual-word index with {len(index)} images and {len(index.vocabulary)} words from {path}")
+        return index
+
+def file_descriptors(image_path):
+    """SIFT descriptors of one image file, preprocessed as for every other feature; None if unreadable."""
+    image = read_image(image_path)
+    if image is None:
+        return None
+    return compute_sift(preprocess_image(image))
+
+def init_worker():
+    cv2.setNumThreads(1)
+
+def iter_folder_descriptors(folder_path, files, workers):
+    paths = [os.path.join(folder_path, file) for file in files]
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker) as executor:
+        yield from zip(files, executor.map(file_descriptors, paths, chunksize=16))
+
+def build_vocabulary(folder_path, size=1024, sample_images=2000, per_image=200, workers=None, seed=0):
+    rng = np.random.default_rng(seed)
+    files = sorted(scan_folder(folder_path))
+    if len(files) > sample_images:
+        files = sorted(rng.choice(files, sample_images, replace=False).tolist())
+
+    start = time.perf_counter()
+    sample = []
+    for _, descriptors in iter_folder_descriptors(folder_path, files, workers):
+        if descriptors is None or not len(descriptors):
+            continue
+        if len(descriptors) > per_image:
+            descriptors = descriptors[rng.choice(len(descriptors), per_image, replace=False)]
+        sample.append(descriptors)
+    if not sample:
+        raise ValueError(f"No SIFT keypoints found in {folder_path}")
+
+    sample = np.concatenate(sample)
+    vocabulary = VisualVocabulary.build(sample, size, seed)
+    print(f"Built {len(vocabulary)} visual words from {len(sample)} descriptors of {len(files)} images in {time.perf_counter() - start:.1f}s")
+    return vocabulary
+
+def build_index(folder_path, vocabulary, workers=None):
+    index = VisualWordIndex(vocabulary)
+    files = sorted(scan_folder(folder_path))
+    start = time.perf_counter()
+    for file, descriptors in iter_folder_descriptors(folder_path, files, workers):
+        if descriptors is None:
+            print(f"Error: Unable to read {file}")
+            continue
+        index.add([(file, vocabulary.word_counts(descriptors))])
+        if len(index) % 10000 == 0:
+            print(f"{len(index)}/{len(files)} indexed", end="\r")
+    print(f"Indexed visual words of {len(index)} images in {time.perf_counter() - start:.1f}s")
+    return index
+
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+    load_dotenv()
+    IMAGE_FOLDER = os.getenv('IMAGE_FOLDER', 'images')
+    SIFT_VOCABULARY_PATH = os.getenv('SIFT_VOCABULARY_PATH', 'sift_vocabulary.npz')
+    SIFT_VOCABULARY_SIZE = int(os.getenv('SIFT_VOCABULARY_SIZE', 1024))
+    SIFT_INDEX_PATH = os.getenv('SIFT_INDEX_PATH', 'sift_index.npz')
+    INGEST_WORKERS = int(os.getenv('INGEST_WORKERS', os.cpu_count()))
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('command', choices=['vocabulary', 'index'])
+    parser.add_argument('--sample-images', type=int, default=2000, help='images sampled for the vocabulary')
+    args = parser.parse_args()
+
+    if args.command == 'vocabulary':
+        build_vocabulary(IMAGE_FOLDER, SIFT_VOCABULARY_SIZE, args.sample_images, workers=INGEST_WORKERS).save(SIFT_VOCABULARY_PATH)
+    else:
+        build_index(IMAGE_FOLDER, VisualVocabulary.load(SIFT_VOCABULARY_PATH), INGEST_WORKERS).save(SIFT_INDEX_PATH)